@@ -1,4 +1,5 @@
-from clients.models import Client, Newsletter, Message, Log, User
+from clients.models import Client, Newsletter, Message, Log, User, Delivery, DeliveryStat, OutboxEmail
+from clients.search import search_clients
 from django.contrib import admin
 
 
@@ -12,12 +13,16 @@ class UserAdmin(admin.ModelAdmin):
 @admin.register(Client)
 class ClientAdmin(admin.ModelAdmin):
     list_display = ('id', 'email', 'full_name', 'comment', 'avatar', 'is_blocked')
-    search_fields = ('full_name',)
+    search_fields = ('full_name', 'email')
+
+    def get_search_results(self, request, queryset, search_term):
+        # поиск по индексу вместо LIKE '%...%' по всей таблице
+        return search_clients(queryset, search_term, ranked=False), False
 
 
 @admin.register(Newsletter)
 class NewsletterAdmin(admin.ModelAdmin):
-    list_display = ('id', 'time', 'period', 'status',)
+    list_display = ('id', 'time', 'period', 'status', 'next_run_at',)
     search_fields = ('period',)
 
 
@@ -32,3 +37,23 @@ class LogAdmin(admin.ModelAdmin):
     list_display = ('id', 'date_attempt', 'state', 'response_server',)
     search_fields = ('state',)
 
+
+@admin.register(Delivery)
+class DeliveryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'run', 'message', 'client', 'status', 'attempts', 'updated_at',)
+    list_filter = ('status',)
+    search_fields = ('run',)
+
+
+@admin.register(DeliveryStat)
+class DeliveryStatAdmin(admin.ModelAdmin):
+    list_display = ('id', 'day', 'newsletter', 'message', 'attempted', 'delivered', 'failed',)
+    list_filter = ('day',)
+
+
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('id', 'to', 'subject', 'status', 'attempts', 'created_at', 'sent_at',)
+    list_filter = ('status',)
+    search_fields = ('to',)
+    exclude = ('body',)  # пароли и коды подтверждения
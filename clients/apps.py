@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class ClientsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'clients'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+
+        import clients.signals  # noqa: F401
+        from clients import search
+
+        post_migrate.connect(search.setup, sender=self)
@@ -0,0 +1,20 @@
+from django.contrib.auth.backends import ModelBackend
+
+from clients import caching
+
+
+class CachedModelBackend(ModelBackend):
+    '''
+    ModelBackend, у которого набор прав пользователя (свои и групп) берётся из кеша:
+    проверка PermissionRequiredMixin не ходит в базу на каждом запросе.
+    Кеш сбрасывают сигналы при изменении прав, групп и пользователя
+    '''
+
+    def get_all_permissions(self, user_obj, obj=None):
+        if obj is not None or not user_obj.is_active or user_obj.is_anonymous:
+            return super().get_all_permissions(user_obj, obj=obj)
+        if not hasattr(user_obj, '_perm_cache'):
+            user_obj._perm_cache = caching.user_permissions(
+                user_obj, lambda: super(CachedModelBackend, self).get_all_permissions(user_obj),
+            )
+        return user_obj._perm_cache
@@ -0,0 +1,245 @@
+import datetime
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+
+from django.core import mail
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection
+from django.db.models import Q
+from django.test import override_settings
+
+from cw_dj.celery import app
+from clients import rendering, search
+from clients.mail_sender import iter_recipients, mail_send
+from clients.models import User, Client, Newsletter, Message, Delivery
+from clients.tasks import mailing
+
+BULK_BATCH_SIZE = 1000
+
+
+class QueryCounter:
+    '''
+    Считает запросы к базе, не сохраняя их текст (в отличие от CaptureQueriesContext,
+    который на больших прогонах сам раздувает память)
+    '''
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(func, trace_memory=True):
+    '''
+    Выполняет func и возвращает её результат и замеры:
+    время, пик памяти Python-объектов (tracemalloc) и количество запросов к базе.
+    tracemalloc заметно замедляет код, поэтому для замеров скорости его можно выключить
+    '''
+    counter = QueryCounter()
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with connection.execute_wrapper(counter):
+            start = time.perf_counter()
+            result = func()
+            wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return result, {
+        'wall_seconds': round(wall, 4),
+        'peak_memory_mb': round(peak / 2 ** 20, 3) if trace_memory else None,
+        'queries': counter.count,
+    }
+
+
+def generate_data(users=1, clients=100, newsletters=1, messages=1, prefix=None):
+    '''
+    Создаёт users пользователей, у каждого clients клиентов и newsletters рассылок
+    на всех его клиентов по messages сообщений, возвращает созданные рассылки
+    '''
+    prefix = prefix or f'gen{uuid.uuid4().hex[:8]}'
+    created = []
+    for u in range(users):
+        user = User.objects.create(email=f'{prefix}_user{u}@example.com', username=f'{prefix}_user{u}')
+        user_clients = Client.objects.bulk_create(
+            (
+                Client(
+                    email=f'{prefix}_{u}_{i}@example.com',
+                    full_name=f'Клиент {i}',
+                    comment='x' * 500,  # у настоящих клиентов комментарии не пустые
+                    user=user,
+                )
+                for i in range(clients)
+            ),
+            batch_size=BULK_BATCH_SIZE,
+        )
+        search.index_clients(client.pk for client in user_clients)  # bulk_create обходит сигналы
+        user_newsletters = Newsletter.objects.bulk_create(
+            Newsletter(
+                time=datetime.time(n % 24, 0),
+                period=Newsletter.PERIODS[n % len(Newsletter.PERIODS)][0],
+                status=Newsletter.STATUS_CREATED,
+                user=user,
+            )
+            for n in range(newsletters)
+        )
+        for newsletter in user_newsletters:
+            Newsletter.client.through.objects.bulk_create(
+                (Newsletter.client.through(newsletter=newsletter, client=client) for client in user_clients),
+                batch_size=BULK_BATCH_SIZE,
+            )
+            Message.objects.bulk_create(
+                Message(theme=f'Тема {m}', letter=f'{{{{ full_name }}}}, письмо {m}', newsletter=newsletter)
+                for m in range(messages)
+            )
+        created.extend(user_newsletters)
+    return created
+
+
+def create_fixture(clients_count, messages_count=1):
+    '''
+    Рассылка на clients_count клиентов с messages_count сообщениями
+    '''
+    return generate_data(clients=clients_count, messages=messages_count)[0]
+
+
+def bench_recipients(scale, trace_memory=True, **options):
+    '''
+    Перебор получателей рассылки: целыми моделями одним запросом и кусками по id
+    '''
+    newsletter = create_fixture(scale)
+    recipients = newsletter.client.filter(is_blocked=False)
+    rows = []
+    for mode, iterate in (
+            ('queryset', lambda: sum(1 for client in recipients.all())),
+            ('keyset', lambda: sum(1 for client in iter_recipients(recipients))),
+    ):
+        count, stats = measure(iterate, trace_memory)
+        rows.append(dict(stats, mode=mode, recipients=count))
+    return rows
+
+
+def bench_render(scale, trace_memory=True, **options):
+    '''
+    Персонализация письма: новый шаблон на каждого получателя и шаблон из кэша
+    '''
+    newsletter = create_fixture(scale)
+    message = newsletter.messages.get()
+    message.theme = '{{ full_name }}, новости недели'
+    message.letter = 'Здравствуйте, {{ full_name }}!\n' + 'Текст рассылки. ' * 50 + '\nАдрес: {{ email }}'
+    message.save()
+    recipients = list(iter_recipients(newsletter.client.all()))
+
+    def naive():
+        for client in recipients:
+            context = {field: getattr(client, field) for field in rendering.PERSONALIZATION_FIELDS}
+            rendering.compile_text(message.theme).render(context)
+            rendering.compile_text(message.letter).render(context)
+
+    def cached():
+        for client in recipients:
+            rendering.render_message(message, client)
+
+    rows = []
+    for mode, func in (('template_per_email', naive), ('cached_template', cached)):
+        result, stats = measure(func, trace_memory)
+        stats['us_per_recipient'] = round(stats['wall_seconds'] / len(recipients) * 10 ** 6, 2)
+        rows.append(dict(stats, mode=mode, recipients=len(recipients)))
+    return rows
+
+
+def bench_search(scale, trace_memory=True, **options):
+    '''
+    Поиск клиента: LIKE '%запрос%' по полям и поисковый индекс, первая страница из 20 результатов
+    '''
+    newsletter = create_fixture(scale)
+    clients = Client.objects.filter(user=newsletter.user)
+    queries = [f'Клиент {i * 7919 % scale}' for i in range(10)] + ['example', 'нет такого']
+
+    def like():
+        for query in queries:
+            list(clients.filter(Q(email__icontains=query) | Q(full_name__icontains=query)).order_by('pk')[:20])
+
+    def index():
+        for query in queries:
+            list(search.search_clients(clients, query, user=newsletter.user)[:20])
+
+    rows = []
+    for mode, func in (('like', like), ('index', index)):
+        result, stats = measure(func, trace_memory)
+        stats['ms_per_query'] = round(stats['wall_seconds'] / len(queries) * 1000, 2)
+        rows.append(dict(stats, mode=mode, clients=scale))
+    return rows
+
+
+class FakeSMTPBackend(BaseEmailBackend):
+    '''
+    Почтовый бэкенд для замеров: собирает письмо, как настоящий SMTP-бэкенд,
+    но никуда его не отправляет и не хранит, а только ждёт latency секунд
+    '''
+    latency = 0
+
+    def send_messages(self, email_messages):
+        for message in email_messages:
+            message.message().as_bytes()
+            if self.latency:
+                time.sleep(self.latency)
+        return len(email_messages)
+
+
+EMAIL_BACKENDS = {
+    'fake': 'clients.benchmarks.FakeSMTPBackend',
+    'locmem': 'django.core.mail.backends.locmem.EmailBackend',
+}
+
+
+@contextmanager
+def celery_eager():
+    always_eager = app.conf.task_always_eager
+    app.conf.task_always_eager = True
+    try:
+        yield
+    finally:
+        app.conf.task_always_eager = always_eager
+
+
+def bench_mailing(scale, trace_memory=True, backend='fake', latency=0, messages=2, **options):
+    '''
+    Полная отправка рассылки на scale клиентов: через mail_send и через задачу clients.tasks.mailing
+    (Celery в режиме eager, все пачки выполняются в этом же процессе)
+    '''
+    FakeSMTPBackend.latency = latency
+    runs = (
+        ('mail_send', lambda newsletter: mail_send(newsletters=[newsletter])),
+        ('celery_mailing', lambda newsletter: mailing.apply(args=(newsletter.pk,))),
+    )
+    rows = []
+    with override_settings(EMAIL_BACKEND=EMAIL_BACKENDS[backend], MAIL_RATE_LIMIT_ENABLED=False), celery_eager():
+        for mode, run in runs:
+            newsletter = create_fixture(scale, messages)
+            mail.outbox = []
+            result, stats = measure(lambda: run(newsletter), trace_memory)
+            emails = Delivery.objects.filter(message__newsletter=newsletter, status=Delivery.STATUS_SENT).count()
+            rows.append(dict(
+                stats,
+                mode=mode,
+                emails=emails,
+                emails_per_second=round(emails / stats['wall_seconds'], 1),
+                queries_per_email=round(stats['queries'] / max(emails, 1), 3),
+            ))
+    mail.outbox = []
+    return rows
+
+
+SUITES = {
+    'recipients': bench_recipients,
+    'render': bench_render,
+    'search': bench_search,
+    'mailing': bench_mailing,
+}
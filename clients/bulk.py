@@ -0,0 +1,80 @@
+from django.db import connections, transaction
+from django.db.models.constants import OnConflict
+
+from clients import caching, search, thumbnails
+from clients.models import Delivery, Log, Newsletter
+
+# Массовые операции над выборкой клиентов (QuerySet, уже ограниченный владельцем):
+# один UPDATE/DELETE/INSERT на всю выборку вместо запроса на каждого клиента,
+# каждая функция возвращает количество затронутых записей.
+BULK_BATCH_SIZE = 1000
+Membership = Newsletter.client.through
+
+
+def newsletters_of(clients):
+    return Membership.objects.filter(client__in=clients).values_list('newsletter_id', flat=True).distinct()
+
+
+def set_blocked(clients, is_blocked):
+    # получатели рассылок берутся с is_blocked=False при отправке, кеш карточек блокировку не хранит
+    return clients.exclude(is_blocked=is_blocked).update(is_blocked=is_blocked)
+
+
+def delete_clients(clients):
+    '''
+    Удаляет клиентов без сборщика Django (он загружает каждый объект и шлёт сигналы на каждого):
+    связи с рассылками, журнал доставок и самих клиентов - DELETE пачками по id, логи отвязываются
+    (SET_NULL) одним UPDATE на пачку. Кеш получателей, поисковый индекс и миниатюры аватаров чистятся здесь же
+    '''
+    client_ids = list(clients.values_list('pk', flat=True))
+    with_thumbnails = list(clients.exclude(thumbnails_for='').values_list('thumbnails_for', flat=True))
+    caching.invalidate_newsletters(list(newsletters_of(clients)), kinds=('recipients',))
+    deleted = 0
+    for start in range(0, len(client_ids), BULK_BATCH_SIZE):
+        batch = client_ids[start:start + BULK_BATCH_SIZE]
+        with transaction.atomic():
+            Membership.objects.filter(client_id__in=batch)._raw_delete(clients.db)
+            Delivery.objects.filter(client_id__in=batch)._raw_delete(clients.db)
+            Log.objects.filter(client_id__in=batch).update(client=None)
+            deleted += clients.model.objects.filter(pk__in=batch)._raw_delete(clients.db)
+        search.unindex_clients(batch)
+
+    def delete_files():  # файлы удаляются, только если удаление клиентов закоммичено
+        for name in with_thumbnails:
+            thumbnails.delete_thumbnails(name)
+
+    transaction.on_commit(delete_files)
+    return deleted
+
+
+def add_to_newsletter(clients, newsletter):
+    '''
+    Добавляет выборку в рассылку одним INSERT ... SELECT в таблицу связей: id клиентов
+    не выгружаются в Python, сколько бы их ни было. Уже состоящих в рассылке пропускает
+    (и при параллельном добавлении тоже), возвращает количество добавленных
+    '''
+    new_ids = clients.exclude(
+        pk__in=Membership.objects.filter(newsletter=newsletter).values('client_id'),
+    ).order_by().values('pk')
+    select, params = new_ids.query.sql_with_params()
+    connection = connections[clients.db]
+    ops, qn = connection.ops, connection.ops.quote_name
+    newsletter_column = Membership._meta.get_field('newsletter').column
+    client_column = Membership._meta.get_field('client').column
+    sql = (
+        f'{ops.insert_statement(on_conflict=OnConflict.IGNORE)} {qn(Membership._meta.db_table)} '
+        f'({qn(newsletter_column)}, {qn(client_column)}) '
+        f'SELECT %s, new_ids.{qn(clients.model._meta.pk.column)} FROM ({select}) new_ids '
+        f'{ops.on_conflict_suffix_sql([], OnConflict.IGNORE, [], [])}'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, (newsletter.pk, *params))
+        added = cursor.rowcount
+    caching.invalidate_newsletters([newsletter.pk], kinds=('recipients',))
+    return added
+
+
+def remove_from_newsletter(clients, newsletter):
+    deleted, by_model = Membership.objects.filter(newsletter=newsletter, client__in=clients).delete()
+    caching.invalidate_newsletters([newsletter.pk], kinds=('recipients',))
+    return deleted
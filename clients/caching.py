@@ -0,0 +1,220 @@
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CACHE_RETRY_INTERVAL = 30  # секунд работы без кеша после ошибки Redis
+
+# Ключи версионные: '<пространство>:<версия>:<имя>'. Чтобы сбросить всё пространство
+# (например, всё закешированное по одной рассылке), достаточно увеличить его версию,
+# старые ключи просто перестанут читаться и истекут сами.
+metrics = Counter()  # hits, misses, errors, invalidations
+_metrics_lock = threading.Lock()  # счётчики меняют потоки запросов и потоки отправки писем
+_counted = ContextVar('cache_events', default=None)  # счётчик событий текущего запроса (counting)
+_down_until = 0
+_pending = set()  # пространства, версию которых не удалось поднять: сбрасываются перед следующим чтением
+_pending_keys = set()  # ключи, которые не удалось удалить: удаляются перед следующим чтением
+_pending_lock = threading.Lock()
+
+
+def _available():
+    return settings.CACHE_ENABLED and time.monotonic() >= _down_until
+
+
+def count(event):
+    with _metrics_lock:
+        metrics[event] += 1
+    counted = _counted.get()
+    if counted is not None:
+        counted[event] += 1
+
+
+@contextmanager
+def counting():
+    '''
+    Отдельно считает события кеша, случившиеся внутри with в этом потоке (контексте):
+    замер запроса не должен получать события других запросов того же процесса
+    '''
+    counted = Counter()
+    token = _counted.set(counted)
+    try:
+        yield counted
+    finally:
+        _counted.reset(token)
+
+
+def events():
+    '''
+    Снимок счётчиков событий кеша
+    '''
+    with _metrics_lock:
+        return dict(metrics)
+
+
+def _failed(e):
+    global _down_until
+    count('errors')
+    _down_until = time.monotonic() + CACHE_RETRY_INTERVAL
+    logger.warning('Кеш недоступен, данные берутся из базы: %s', e)
+
+
+def _version(namespace):
+    key = f'version:{namespace}'
+    version = cache.get(key)
+    if version is None:
+        # версия с отметкой времени: если ключ версии вытеснили, старые данные не оживут
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def get_or_set(namespace, name, default, timeout=None):
+    '''
+    Значение из кеша или результат default(), который сразу кладётся в кеш на timeout секунд
+    (по умолчанию CACHE_TIMEOUT). Если кеш выключен или Redis недоступен, просто возвращает default()
+    '''
+    if not _available() or not _flush_pending():
+        return default()
+    try:
+        key = f'{namespace}:{_version(namespace)}:{name}'
+        value = cache.get(key)
+    except (redis.RedisError, OSError) as e:
+        _failed(e)
+        return default()
+    if value is not None:
+        count('hits')
+        return value
+    count('misses')
+    value = default()
+    try:
+        cache.set(key, value, timeout=timeout or settings.CACHE_TIMEOUT)
+    except (redis.RedisError, OSError) as e:
+        _failed(e)
+    return value
+
+
+def _flush_pending():
+    '''
+    Поднимает версии отложенных пространств и удаляет отложенные ключи,
+    возвращает False, если Redis снова не ответил
+    '''
+    with _pending_lock:
+        if _pending_keys:
+            try:
+                cache.delete_many(list(_pending_keys))
+            except (redis.RedisError, OSError) as e:
+                _failed(e)
+                return False
+            _pending_keys.clear()
+        while _pending:
+            namespace = next(iter(_pending))
+            try:
+                try:
+                    cache.incr(f'version:{namespace}')
+                except ValueError:  # версии ещё нет: и читать по этому пространству нечего
+                    pass
+            except (redis.RedisError, OSError) as e:
+                _failed(e)
+                return False
+            _pending.discard(namespace)
+            count('invalidations')
+    return True
+
+
+def invalidate(*namespaces):
+    '''
+    Сбрасывает пространства. Пробует даже тогда, когда кеш помечен недоступным: пропущенный сброс
+    оставил бы устаревшие данные после возвращения Redis. Не удавшийся сброс запоминается,
+    и до его повтора get_or_set в кеш не ходит
+    '''
+    if not settings.CACHE_ENABLED:
+        return
+    with _pending_lock:
+        _pending.update(namespaces)
+    _flush_pending()
+
+
+def store(key, value, timeout):
+    '''
+    Кладёт значение по ключу (без версий), возвращает False, если кеш выключен или недоступен
+    '''
+    if not _available():
+        return False
+    try:
+        cache.set(key, value, timeout=timeout)
+    except (redis.RedisError, OSError) as e:
+        _failed(e)
+        return False
+    return True
+
+
+def fetch(key):
+    if not _available() or not _flush_pending():
+        return None
+    try:
+        return cache.get(key)
+    except (redis.RedisError, OSError) as e:
+        _failed(e)
+        return None
+
+
+def discard(*keys):
+    '''
+    Удаляет ключи. Как и invalidate, пробует даже при недоступном кеше, а не удавшееся удаление
+    запоминает: до его повтора fetch и get_or_set в кеш не ходят и удалённое значение не вернут
+    '''
+    if not settings.CACHE_ENABLED:
+        return
+    with _pending_lock:
+        _pending_keys.update(keys)
+    _flush_pending()
+
+
+def hit(key, window):
+    '''
+    Считает событие в окне window секунд (окно начинается с первого события),
+    возвращает число событий в окне или None, если кеш выключен или недоступен
+    '''
+    if not _available():
+        return None
+    try:
+        cache.add(key, 0, timeout=window)
+        try:
+            return cache.incr(key)
+        except ValueError:  # окно истекло между add и incr
+            cache.set(key, 1, timeout=window)
+            return 1
+    except (redis.RedisError, OSError) as e:
+        _failed(e)
+        return None
+
+
+def user_permissions(user, default):
+    # права живут недолго: если сброс не дошёл до Redis, старый набор всё равно скоро истечёт
+    return get_or_set(f'perms:{user.pk}', 'all', default, timeout=settings.PERMISSIONS_CACHE_TIMEOUT)
+
+
+def newsletter_messages(newsletter):
+    return get_or_set(
+        f'messages:{newsletter.pk}', 'list',
+        lambda: list(newsletter.messages.all()),
+    )
+
+
+def newsletter_recipients(newsletter):
+    return get_or_set(
+        f'recipients:{newsletter.pk}', 'list',
+        lambda: list(newsletter.client.only('id', 'email', 'full_name')),
+    )
+
+
+def invalidate_newsletters(newsletter_ids, kinds=('messages', 'recipients')):
+    invalidate(*(f'{kind}:{pk}' for pk in newsletter_ids for kind in kinds))
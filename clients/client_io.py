@@ -0,0 +1,163 @@
+import codecs
+import csv
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+
+from clients import caching, search
+from clients.models import Client, Newsletter
+
+# Импорт и экспорт клиентов в CSV (заголовок email,full_name,comment) и JSONL (объект на строку).
+# Файл читается построчно и сохраняется пачками, экспорт отдаётся строками по мере чтения базы:
+# в памяти никогда не бывает больше одной пачки.
+FORMATS = ('csv', 'jsonl')
+EXPORT_FIELDS = ('email', 'full_name', 'comment', 'is_blocked')
+MAX_ERRORS = 20  # сколько ошибочных строк перечислить в результате
+
+
+def guess_format(filename):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    return 'jsonl' if extension in ('jsonl', 'ndjson', 'json') else 'csv'
+
+
+def iter_rows(fileobj, fmt):
+    '''
+    Читает двоичный файл построчно, отдаёт (номер строки, dict или None, если строку не разобрать)
+    '''
+    lines = codecs.getreader('utf-8-sig')(fileobj, errors='replace')
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_num, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_num, row if isinstance(row, dict) else None
+
+
+def normalize_email(email):
+    local, _, domain = str(email or '').strip().rpartition('@')
+    return f'{local}@{domain.lower()}' if local else ''
+
+
+def clean_row(row):
+    '''
+    Проверяет строку файла правилами модели клиента (как форма клиента),
+    возвращает поля клиента или выбрасывает ValidationError с сообщениями по полям.
+    Комментарий в файле необязателен, уникальность почты не проверяется: импорт обновляет существующих
+    '''
+    if row is None:
+        raise ValidationError('строку не удалось разобрать')
+    fields = {
+        'email': normalize_email(row.get('email')),
+        'full_name': str(row.get('full_name') or '').strip(),
+        'comment': str(row.get('comment') or ''),
+    }
+    try:
+        Client(**fields).full_clean(
+            exclude=[field.name for field in Client._meta.fields if field.name not in ('email', 'full_name')],
+            validate_unique=False,
+            validate_constraints=False,
+        )
+    except ValidationError as e:
+        raise ValidationError([
+            f'{Client._meta.get_field(name).verbose_name}: {message}'
+            for name, messages in e.message_dict.items() for message in messages
+        ])
+    return fields
+
+
+def save_batch(batch, user, result):
+    '''
+    Сохраняет пачку {email: поля} одним upsert по уникальной почте.
+    Почту, которая уже занята клиентом другого пользователя, пропускает
+    '''
+    owners = dict(Client.objects.filter(email__in=batch).values_list('email', 'user_id'))
+    clients = []
+    for email, fields in batch.items():
+        owner = owners.get(email, user.pk)
+        if owner != user.pk:
+            result['conflicts'] += 1
+            continue
+        result['updated' if email in owners else 'created'] += 1
+        clients.append(Client(user=user, **fields))
+    Client.objects.bulk_create(
+        clients,
+        update_conflicts=True,
+        unique_fields=('email',),
+        update_fields=('full_name', 'comment'),
+    )
+    # bulk_create обходит сигналы: поисковый индекс и кеш получателей обновляем сами
+    emails = [client.email for client in clients]
+    search.index_clients(Client.objects.filter(email__in=emails).values_list('pk', flat=True))
+    updated = [email for email in emails if email in owners]
+    if updated:
+        newsletter_ids = Newsletter.client.through.objects.filter(
+            client__email__in=updated,
+        ).values_list('newsletter_id', flat=True).distinct()
+        caching.invalidate_newsletters(newsletter_ids, kinds=('recipients',))
+
+
+def import_clients(fileobj, fmt, user, batch_size=None, progress=None):
+    '''
+    Импортирует клиентов пользователя user из файла,
+    progress(result) вызывается после каждой пачки
+    '''
+    batch_size = batch_size or settings.CLIENT_IMPORT_BATCH_SIZE
+    result = {'rows': 0, 'created': 0, 'updated': 0, 'conflicts': 0, 'invalid': 0, 'errors': []}
+    batch = {}  # по почте: повтор адреса в файле перезаписывает предыдущий
+    for line_num, row in iter_rows(fileobj, fmt):
+        result['rows'] += 1
+        try:
+            fields = clean_row(row)
+        except ValidationError as e:
+            result['invalid'] += 1
+            if len(result['errors']) < MAX_ERRORS:
+                result['errors'].append(f'строка {line_num}: {"; ".join(e.messages)}')
+            continue
+        batch[fields['email']] = fields
+        if len(batch) >= batch_size:
+            save_batch(batch, user, result)
+            batch = {}
+            if progress:
+                progress(result)
+    if batch:
+        save_batch(batch, user, result)
+    return result
+
+
+class Echo:
+    '''
+    Псевдофайл для csv.writer: write возвращает строку, а не пишет её
+    '''
+
+    def write(self, value):
+        return value
+
+
+def export_clients(clients, fmt, chunk_size=None):
+    '''
+    Отдаёт клиентов строками CSV или JSONL, читая базу кусками по id
+    '''
+    chunk_size = chunk_size or settings.CLIENT_IMPORT_BATCH_SIZE
+    writer = csv.writer(Echo())
+    if fmt == 'csv':
+        yield writer.writerow(EXPORT_FIELDS)
+    rows = clients.order_by('pk').values_list('pk', *EXPORT_FIELDS)
+    last_pk = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last_pk)[:chunk_size])
+        for pk, *values in chunk:
+            if fmt == 'csv':
+                yield writer.writerow(values)
+            else:
+                yield json.dumps(dict(zip(EXPORT_FIELDS, values)), ensure_ascii=False) + '\n'
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1][0]
@@ -0,0 +1,118 @@
+import smtplib
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.utils.module_loading import import_string
+
+from clients import metrics
+from clients.rate_limit import get_rate_limiter
+
+
+class MailEngine:
+    '''
+    Движок отправки писем:
+    одно SMTP-соединение на весь прогон,
+    отправка пачками через send_messages,
+    переподключение, если сервер разорвал соединение,
+    ограничение количества писем на одно соединение,
+    соблюдение лимита скорости отправки (rate_limiter).
+    Если max_wait задан, пачка, которой пришлось бы ждать лимита дольше,
+    не отправляется: admit выбрасывает RateLimitExceeded.
+    '''
+
+    def __init__(self, batch_size=None, messages_per_connection=None, reconnect_attempts=None, backend=None,
+                 rate_limiter=None, max_wait=None):
+        self.batch_size = batch_size or settings.MAIL_SENDER_BATCH_SIZE
+        if messages_per_connection is None:
+            messages_per_connection = settings.MAIL_SENDER_MESSAGES_PER_CONNECTION
+        self.messages_per_connection = messages_per_connection
+        if reconnect_attempts is None:
+            reconnect_attempts = settings.MAIL_SENDER_RECONNECT_ATTEMPTS
+        self.reconnect_attempts = reconnect_attempts
+        self.backend = backend
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.max_wait = max_wait
+        self.connection = None
+        self.sent_on_connection = 0  # сколько писем ушло через текущее соединение
+        self.connections_opened = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        if self.connection is None:
+            self.connection = get_connection(backend=self.backend, fail_silently=False)
+            self.connection.open()
+            self.sent_on_connection = 0
+            self.connections_opened += 1
+        return self.connection
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.close()
+        except Exception:  # соединение уже могло быть разорвано сервером
+            pass
+        finally:
+            self.connection = None
+
+    def admit(self, email_messages):
+        if self.rate_limiter is not None and email_messages:
+            self.rate_limiter.admit(email_messages[0].from_email, self.max_wait)
+
+    def send(self, email_messages):
+        '''
+        Отправляет письма пачками по batch_size,
+        возвращает список ошибок в порядке писем (None - письмо отправлено)
+        '''
+        email_messages = list(email_messages)
+        errors = []
+        for start in range(0, len(email_messages), self.batch_size):
+            errors.extend(self.send_batch(email_messages[start:start + self.batch_size]))
+        return errors
+
+    def send_batch(self, batch):
+        errors = []
+        for email_message in batch:
+            # каждое письмо отдаём отдельно, чтобы знать результат по каждому получателю,
+            # но соединение при этом остаётся открытым на всю пачку
+            try:
+                self._send_one(email_message)
+            except Exception as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+        return errors
+
+    def _send_one(self, email_message):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(email_message.from_email)
+        attempt = 0
+        start = time.perf_counter()
+        while True:
+            try:
+                self.open().send_messages([email_message])
+            except smtplib.SMTPServerDisconnected:
+                self.close()
+                attempt += 1
+                if attempt > self.reconnect_attempts:
+                    raise
+                continue
+            self.sent_on_connection += 1
+            metrics.record_smtp(1, time.perf_counter() - start)
+            if self.messages_per_connection and self.sent_on_connection >= self.messages_per_connection:
+                self.close()  # лимит писем на соединение исчерпан, следующее письмо откроет новое
+            return
+
+
+def get_engine(**kwargs):
+    '''
+    Создаёт движок отправки из настройки MAIL_SENDER_ENGINE
+    '''
+    return import_string(settings.MAIL_SENDER_ENGINE)(**kwargs)
@@ -1,6 +1,8 @@
 from django.forms import TimeInput
+from django.template import TemplateSyntaxError
 
-from clients.models import Client, Newsletter, Message
+from clients import rendering
+from clients.models import Client, Newsletter, Message, Log
 from django import forms
 
 from django.contrib.auth.forms import UserCreationForm, UserChangeForm, AuthenticationForm
@@ -39,11 +41,76 @@ class NewsletterForm(StyleFormMixin, forms.ModelForm):
             self.fields['client'].queryset = Client.objects.filter(user=user)
 
 
+class ClientImportForm(StyleFormMixin, forms.Form):
+    file = forms.FileField(label='Файл CSV или JSONL')
+    format = forms.ChoiceField(
+        choices=(('', 'По расширению файла'), ('csv', 'CSV'), ('jsonl', 'JSONL')),
+        required=False, label='Формат',
+    )
+
+
+class ClientBulkForm(forms.Form):
+    '''
+    Массовая операция над клиентами: отмеченные id или все, кто подходит под фильтр
+    '''
+    ACTIONS = (
+        ('block', 'Заблокировать'),
+        ('unblock', 'Разблокировать'),
+        ('delete', 'Удалить'),
+        ('add_to_newsletter', 'Добавить в рассылку'),
+        ('remove_from_newsletter', 'Убрать из рассылки'),
+    )
+    action = forms.ChoiceField(choices=ACTIONS, label='Действие')
+    # чекбоксы карточек шлют несколько значений ids, каждое может быть и списком через запятую
+    ids = forms.Field(required=False, widget=forms.MultipleHiddenInput, label='id клиентов')
+    select_all = forms.BooleanField(required=False, label='Все по фильтру')
+    q = forms.CharField(required=False, label='Поиск')
+    is_blocked = forms.NullBooleanField(required=False, label='Заблокирован')
+    newsletter = forms.ModelChoiceField(queryset=Newsletter.objects.none(), required=False, label='Рассылка')
+
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if user:
+            self.fields['newsletter'].queryset = Newsletter.objects.filter(user=user)
+
+    def clean_ids(self):
+        try:
+            return [int(pk) for value in self.cleaned_data['ids'] or [] for pk in value.replace(',', ' ').split()]
+        except ValueError:
+            raise forms.ValidationError('id клиентов должны быть числами')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('ids') and not cleaned_data.get('select_all'):
+            raise forms.ValidationError('Не выбраны клиенты')
+        if cleaned_data.get('action', '').endswith('_newsletter') and not cleaned_data.get('newsletter'):
+            raise forms.ValidationError('Не выбрана рассылка')
+        return cleaned_data
+
+
 class MessageForm(StyleFormMixin, forms.ModelForm):
     class Meta:
         model = Message
         fields = '__all__'
 
+    def clean_theme(self):
+        return self.clean_template('theme')
+
+    def clean_letter(self):
+        return self.clean_template('letter')
+
+    def clean_template(self, field):
+        '''
+        Тема и текст - шаблоны с подстановками ({{ full_name }}, {{ email }}), теги и фильтры запрещены,
+        ошибка в них видна сразу
+        '''
+        text = self.cleaned_data[field]
+        try:
+            rendering.compile_text(text)
+        except TemplateSyntaxError as e:
+            raise forms.ValidationError(f'Ошибка в шаблоне: {e}')
+        return text
+
 
 class LoginUserForm(StyleFormMixin, AuthenticationForm):
     username = forms.EmailField(widget=forms.TextInput(attrs={'autofocus': True}))
@@ -69,3 +136,23 @@ class UserProfileForm(StyleFormMixin, UserChangeForm):
         super().__init__(*args, **kwargs)
 
         self.fields['password'].widget = forms.HiddenInput()
+
+
+class LogFilterForm(StyleFormMixin, forms.Form):
+    newsletter = forms.ModelChoiceField(queryset=Newsletter.objects.none(), required=False, label='Рассылка')
+    message = forms.ModelChoiceField(queryset=Message.objects.none(), required=False, label='Сообщение')
+    state = forms.ChoiceField(choices=(('', 'Все'),) + Log.STATES, required=False, label='Статус попытки')
+    date_from = forms.DateField(required=False, label='С', widget=forms.DateInput(attrs={'type': 'date'}))
+    date_to = forms.DateField(required=False, label='По', widget=forms.DateInput(attrs={'type': 'date'}))
+    archive = forms.BooleanField(required=False, label='Включая архив')
+
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if user:
+            self.fields['newsletter'].queryset = Newsletter.objects.filter(user=user)
+            self.fields['message'].queryset = Message.objects.filter(newsletter__user=user)
+
+
+class StatsFilterForm(LogFilterForm):
+    state = None  # в дневной статистике попытки уже разложены по результату
+    archive = None  # статистика при переносе логов в архив не удаляется
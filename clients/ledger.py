@@ -0,0 +1,99 @@
+from django.conf import settings
+from django.db.models import Count, Exists, OuterRef, Max, Q
+
+from clients.models import Delivery, Message
+from clients.stats import StatsCollector
+
+
+class DeliveryLedger:
+    '''
+    Журнал доставок одного прогона рассылки:
+    при повторном запуске прогона уже доставленные письма пропускаются,
+    а письма с ошибкой отправляются заново.
+    Результаты пачек копятся в дневной статистике и сохраняются при выходе из with.
+    '''
+
+    def __init__(self, run):
+        self.run = run
+        # у нового прогона записей нет, и на каждую пачку не нужно спрашивать, что уже отправлено
+        self.resuming = Delivery.objects.filter(run=run).exists()
+        self.stats = StatsCollector()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stats.flush()
+
+    def pending(self, clients, messages):
+        '''
+        Оставляет клиентов, которым в этом прогоне доставлены ещё не все сообщения
+        '''
+        if not self.resuming:
+            return clients
+        sent = Delivery.objects.filter(
+            run=self.run,
+            status=Delivery.STATUS_SENT,
+            message=OuterRef('pk'),
+            client=OuterRef(OuterRef('pk')),
+        )
+        undelivered = Message.objects.filter(pk__in=[message.pk for message in messages]).exclude(Exists(sent))
+        return clients.filter(Exists(undelivered))
+
+    def previous(self, client_ids):
+        '''
+        Прошлые попытки клиентов пачки: {(id клиента, id сообщения): (статус, попыток)}
+        '''
+        if not self.resuming:
+            return {}
+        rows = Delivery.objects.filter(run=self.run, client_id__in=client_ids)
+        return {
+            (client_id, message_id): (status, attempts)
+            for client_id, message_id, status, attempts
+            in rows.values_list('client_id', 'message_id', 'status', 'attempts')
+        }
+
+    def record(self, letters, errors):
+        '''
+        Сохраняет результат отправки пачки одним запросом
+        '''
+        rows = [
+            Delivery(
+                run=self.run,
+                message=letter.message,
+                client=letter.client,
+                status=Delivery.STATUS_SENT if error is None else Delivery.STATUS_FAILED,
+                attempts=letter.attempt,
+                error='' if error is None else str(error)[:250],
+            )
+            for letter, error in zip(letters, errors)
+        ]
+        for letter, error in zip(letters, errors):
+            self.stats.add(letter.message, delivered=error is None)
+        Delivery.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=('run', 'message', 'client'),
+            update_fields=('status', 'attempts', 'error', 'updated_at'),
+        )
+
+    def progress(self):
+        '''
+        Сколько писем прогона доставлено и сколько с ошибкой на данный момент,
+        сколько из ошибок уже не будут повторяться (попытки исчерпаны) и когда прогон последний раз что-то записал
+        '''
+        return Delivery.objects.filter(run=self.run).aggregate(
+            sent=Count('pk', filter=Q(status=Delivery.STATUS_SENT)),
+            failed=Count('pk', filter=Q(status=Delivery.STATUS_FAILED)),
+            exhausted=Count('pk', filter=Q(
+                status=Delivery.STATUS_FAILED, attempts__gte=settings.MAIL_DELIVERY_MAX_ATTEMPTS,
+            )),
+            updated_at=Max('updated_at'),
+        )
+
+    def failed(self, clients):
+        '''
+        Количество писем с ошибкой у этих клиентов и наибольшее число попыток среди них
+        '''
+        rows = Delivery.objects.filter(run=self.run, client__in=clients, status=Delivery.STATUS_FAILED)
+        return rows.count(), rows.aggregate(attempts=Max('attempts'))['attempts'] or 0
@@ -0,0 +1,192 @@
+import datetime
+import gzip
+import json
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from clients.models import Log
+
+# Архив логов рассылки: логи старше LOG_RETENTION_DAYS дней переносятся из таблицы
+# в сжатые файлы JSONL, по файлу на день: <LOG_ARCHIVE_DIR>/ГГГГ/ММ/logs-ГГГГ-ММ-ДД.jsonl.gz.
+# Каждая пачка дописывается в файл отдельным gzip-блоком и только потом удаляется из базы,
+# поэтому после сбоя между записью и удалением строка может попасть в архив дважды -
+# читатель отбрасывает повторы по id.
+ARCHIVE_FIELDS = ('id', 'date_attempt', 'state', 'response_server', 'message_id', 'client_id')
+
+
+class ArchivedLog:
+    '''
+    Лог из архива: те же поля, что у Log, которые нужны страницам отчётов.
+    Тема сообщения и почта клиента сохранены в архиве на момент переноса
+    '''
+
+    def __init__(self, record):
+        self.pk = self.id = record['id']
+        self.date_attempt = parse_datetime(record['date_attempt'])
+        self.state = record['state']
+        self.response_server = record['response_server']
+        self.message_id = record['message_id']
+        self.newsletter_id = record['newsletter_id']
+        self.user_id = record['user_id']
+        self.client_id = record['client_id']
+        self.message = ArchivedMessage(record['message_id'], record['message_theme'])
+        self.client = ArchivedClient(record['client_id'], record['client_email']) if record['client_id'] else None
+        self.archived = True
+
+    def __str__(self):
+        return f'{self.date_attempt}, {self.state}, {self.response_server}'
+
+
+class ArchivedMessage:
+
+    def __init__(self, pk, theme):
+        self.pk = self.id = pk
+        self.theme = theme
+
+
+class ArchivedClient:
+
+    def __init__(self, pk, email):
+        self.pk = self.id = pk
+        self.email = email
+
+
+def archive_dir():
+    return Path(settings.LOG_ARCHIVE_DIR)
+
+
+def partition_path(day):
+    return archive_dir() / f'{day:%Y}' / f'{day:%m}' / f'logs-{day.isoformat()}.jsonl.gz'
+
+
+def archived_days():
+    '''
+    Дни, за которые есть архив, по возрастанию
+    '''
+    days = []
+    for path in archive_dir().glob('*/*/logs-*.jsonl.gz'):
+        try:
+            days.append(datetime.date.fromisoformat(path.name[len('logs-'):-len('.jsonl.gz')]))
+        except ValueError:
+            continue
+    return sorted(days)
+
+
+def retention_cutoff(days=None):
+    '''
+    Начало дня, раньше которого логи уходят в архив: архивируются только целые дни
+    '''
+    days = settings.LOG_RETENTION_DAYS if days is None else days
+    first_kept = timezone.localdate() - datetime.timedelta(days=days)
+    return timezone.make_aware(datetime.datetime.combine(first_kept, datetime.time.min))
+
+
+def _record(row):
+    record = dict(zip(ARCHIVE_FIELDS, row))
+    record['date_attempt'] = record['date_attempt'].isoformat()
+    theme, newsletter_id, user_id, client_email = row[len(ARCHIVE_FIELDS):]
+    record.update(message_theme=theme, newsletter_id=newsletter_id, user_id=user_id, client_email=client_email)
+    return record
+
+
+def write_partitions(records):
+    '''
+    Дописывает записи в файлы их дней, каждый файл - новым gzip-блоком
+    '''
+    by_day = {}
+    for record in records:
+        day = timezone.localdate(parse_datetime(record['date_attempt']))
+        by_day.setdefault(day, []).append(record)
+    for day, day_records in by_day.items():
+        path = partition_path(day)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(path, 'at', encoding='utf-8') as file:
+            file.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in day_records)
+            file.flush()
+            os.fsync(file.fileno())
+    return sorted(by_day)
+
+
+def archive_logs(days=None, batch_size=None, dry_run=False):
+    '''
+    Переносит логи старше days дней в архив пачками по batch_size строк.
+    Каждая пачка удаляется отдельной короткой транзакцией, чтобы не держать блокировку таблицы.
+    Возвращает (перенесено строк, затронутые дни)
+    '''
+    batch_size = batch_size or settings.LOG_ARCHIVE_BATCH_SIZE
+    logs = Log.objects.filter(date_attempt__lt=retention_cutoff(days))
+    if dry_run:
+        return logs.count(), []
+    rows = logs.order_by('date_attempt', 'pk').values_list(
+        *ARCHIVE_FIELDS, 'message__theme', 'message__newsletter_id', 'message__newsletter__user_id', 'client__email',
+    )
+    archived = 0
+    days_written = set()
+    while True:
+        batch = list(rows[:batch_size])
+        if not batch:
+            return archived, sorted(days_written)
+        days_written.update(write_partitions(_record(row) for row in batch))
+        with transaction.atomic():
+            Log.objects.filter(pk__in=[row[0] for row in batch]).delete()
+        archived += len(batch)
+
+
+def compact():
+    '''
+    Возвращает освободившееся после удаления логов место: VACUUM на SQLite и PostgreSQL.
+    На SQLite блокирует всю базу на время работы, поэтому запускается только вручную
+    '''
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('VACUUM')
+    elif connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'VACUUM ANALYZE {Log._meta.db_table}')
+
+
+def read_day(day):
+    '''
+    Записи архива за день (без повторов), новые первыми
+    '''
+    path = partition_path(day)
+    if not path.exists():
+        return []
+    records = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        for line in file:
+            record = json.loads(line)
+            records[record['id']] = record
+    logs = [ArchivedLog(record) for record in records.values()]
+    logs.sort(key=lambda log: (log.date_attempt, log.pk), reverse=True)
+    return logs
+
+
+def iter_archived(user=None, newsletter=None, message=None, state=None, date_from=None, date_to=None, before=None):
+    '''
+    Логи из архива, новые первыми, с теми же фильтрами, что у страницы логов.
+    before - курсор (дата и время, id): только записи раньше него.
+    Файлы читаются по одному дню, пока вызывающий берёт записи
+    '''
+    for day in reversed(archived_days()):
+        if date_to and day > date_to or before and day > timezone.localdate(before[0]):
+            continue
+        if date_from and day < date_from:
+            return
+        for log in read_day(day):
+            if user is not None and log.user_id != user.pk:
+                continue
+            if newsletter is not None and log.newsletter_id != newsletter.pk:
+                continue
+            if message is not None and log.message_id != message.pk:
+                continue
+            if state and log.state != state:
+                continue
+            if before and (log.date_attempt, log.pk) >= before:
+                continue
+            yield log
@@ -0,0 +1,81 @@
+import atexit
+import time
+import weakref
+
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from clients.models import Log
+
+_open_writers = weakref.WeakSet()  # незакрытые писатели, которые нужно сбросить при остановке процесса
+
+
+class LogWriter:
+    '''
+    Буферизованная запись логов рассылки:
+    строки копятся в памяти и сохраняются одним bulk_create
+    каждые flush_size строк, каждые flush_interval секунд и при закрытии.
+    '''
+
+    def __init__(self, flush_size=None, flush_interval=None):
+        self.flush_size = flush_size or settings.MAIL_LOG_FLUSH_SIZE
+        if flush_interval is None:
+            flush_interval = settings.MAIL_LOG_FLUSH_INTERVAL
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.written = 0
+        _open_writers.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()  # сбрасываем буфер и при ошибке, чтобы не потерять уже накопленные строки
+
+    def add(self, state, response_server, message, **fields):
+        fields.setdefault('date_attempt', timezone.now())
+        self.buffer.append(Log(state=state, response_server=str(response_server)[:250], message=message, **fields))
+        if len(self.buffer) >= self.flush_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            rows, self.buffer = self.buffer, []
+            Log.objects.bulk_create(rows, batch_size=self.flush_size)
+            self.written += len(rows)
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        _open_writers.discard(self)
+
+
+class DirectLogWriter(LogWriter):
+    '''
+    Запись каждой строки сразу, без буфера (поведение до буферизации)
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(flush_size=1, flush_interval=0)
+
+
+def get_log_writer(**kwargs):
+    '''
+    Создаёт писатель логов из настройки MAIL_LOG_WRITER
+    '''
+    return import_string(settings.MAIL_LOG_WRITER)(**kwargs)
+
+
+def flush_open_writers(**kwargs):
+    for writer in list(_open_writers):
+        try:
+            writer.flush()
+        except Exception:  # база может быть уже недоступна при остановке
+            pass
+
+
+atexit.register(flush_open_writers)
+worker_process_shutdown.connect(flush_open_writers)
@@ -1,47 +1,178 @@
-from datetime import datetime
+import uuid
+from collections import namedtuple
 
-from django.core.mail import send_mail
+from django.conf import settings
+from django.core.mail import EmailMessage
 
-from cw_dj import settings
-from clients.models import Newsletter, Log
+from clients.engine import get_engine
+from clients.ledger import DeliveryLedger
+from clients.log_writer import get_log_writer
+from clients.models import Newsletter, Delivery, Log, Client
+from clients.rate_limit import RateLimitExceeded
+from clients.rendering import render_message, PERSONALIZATION_FIELDS
 
+# поля клиента, которые нужны для отправки письма
+RECIPIENT_FIELDS = ('id',) + PERSONALIZATION_FIELDS
 
-def mail_send(period=None, newsletters=None):
-    if not period and not Newsletter:
+# письмо пачки: сообщение рассылки, получатель, готовое письмо и номер попытки
+Letter = namedtuple('Letter', 'message client email attempt')
+
+
+def build_email(message, client):
+    subject, body = render_message(message, client)
+    return EmailMessage(
+        subject=subject,
+        body=body,
+        from_email=settings.EMAIL_HOST_USER,
+        to=[client.email],
+    )
+
+
+def deliver(batch, engine, log_writer, ledger):
+    '''
+    Отправляет пачку писем через общее соединение движка,
+    пишет логи о начале и завершении отправки, отмечает результат в журнале доставок
+    и возвращает количество ошибок
+    '''
+    emails = [letter.email for letter in batch]
+    engine.admit(emails)  # до логов: если лимит не пускает пачку, она целиком уйдёт на повтор
+    for letter in batch:
+        log_writer.add(Newsletter.STATUS_STARTED, "200", letter.message, client=letter.client)  # логи о начале
+    # логи о начале сохраняем до обращения к SMTP: если процесс упадёт во время отправки,
+    # в базе останется след от каждого письма, которое могло уйти
+    log_writer.flush()
+    errors = engine.send(emails)
+    ledger.record(batch, errors)
+    for letter, error in zip(batch, errors):
+        if error is None:
+            log_writer.add(Newsletter.STATUS_DONE, "200", letter.message, client=letter.client)  # логи о завершении
+        else:  # если произошла ошибка при отправке
+            log_writer.add(Log.STATE_ERROR, error, letter.message, client=letter.client)
+    return sum(error is not None for error in errors)
+
+
+def iter_recipients(clients, chunk_size=None):
+    '''
+    Перебирает получателей кусками по chunk_size, читая только нужные для письма поля.
+    Следующий кусок выбирается по последнему id (keyset), поэтому в памяти
+    всегда не больше одного куска, сколько бы клиентов ни было в рассылке
+    '''
+    chunk_size = chunk_size or settings.MAIL_RECIPIENTS_CHUNK_SIZE
+    clients = clients.only(*RECIPIENT_FIELDS).order_by('pk')
+    last_pk = None
+    while True:
+        chunk = clients if last_pk is None else clients.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1].pk
+
+
+def make_batch(clients, messages, ledger):
+    '''
+    Готовит письма группе клиентов, пропуская уже доставленные в этом прогоне
+    '''
+    previous = ledger.previous([client.pk for client in clients])
+    batch = []
+    for client in clients:
+        for message in messages:
+            status, attempts = previous.get((client.pk, message.pk), (None, 0))
+            if status != Delivery.STATUS_SENT:
+                batch.append(Letter(message, client, build_email(message, client), attempts + 1))
+    return [client.pk for client in clients], batch
+
+
+def iter_batches(clients, messages, batch_size, ledger):
+    '''
+    Собирает пачки примерно по batch_size писем, не разрывая письма одного клиента между пачками,
+    отдаёт (id клиентов пачки, [Letter, ...])
+    '''
+    if not messages:
+        return
+    clients_per_batch = max(1, batch_size // len(messages))
+    group = []
+    for client in iter_recipients(ledger.pending(clients, messages)):  # перебираем всех пользователей рассылки
+        group.append(client)
+        if len(group) >= clients_per_batch:
+            yield make_batch(group, messages, ledger)
+            group = []
+    if group:
+        yield make_batch(group, messages, ledger)
+
+
+def send_to_clients(clients, messages, engine, log_writer, ledger):
+    '''
+    Отправляет каждому клиенту все сообщения рассылки, ещё не доставленные в прогоне ledger,
+    возвращает словарь {'sent': отправлено, 'failed': с ошибкой}
+    '''
+    total = failed = 0
+    for client_ids, batch in iter_batches(clients, messages, engine.batch_size, ledger):
+        if not batch:
+            continue
+        try:
+            failed += deliver(batch, engine, log_writer, ledger)
+        except RateLimitExceeded as e:
+            # пачка не отправлялась: возвращаем её и всех следующих клиентов вызывающему коду.
+            # Следующих берём тем же порядком по id, что и iter_recipients, одним запросом по id -
+            # без сборки их писем
+            rest = ledger.pending(clients, messages).filter(pk__gt=client_ids[-1]).order_by('pk')
+            e.remaining_client_ids = client_ids + list(rest.values_list('pk', flat=True))
+            e.result = {'sent': total - failed, 'failed': failed}
+            raise
+        total += len(batch)
+    return {'sent': total - failed, 'failed': failed}
+
+
+def send_newsletter(newsletter, engine, log_writer, ledger):
+    messages = list(newsletter.messages.all())  # получаем список сообщений для этой рассылки
+    # сохраняем только статус: отправка идёт долго, и пока она идёт, рассылку могут выключить
+    # или перенести - полный save() вернул бы next_run_at, прочитанный до отправки
+    newsletter.status = Newsletter.STATUS_STARTED
+    newsletter.save(update_fields=['status'])
+    result = send_to_clients(newsletter.client.filter(is_blocked=False), messages, engine, log_writer, ledger)
+    newsletter.status = Newsletter.STATUS_DONE
+    newsletter.save(update_fields=['status'])
+    return result
+
+
+def send_chunk(newsletter_id, client_ids, run, batch_size=None, dry_run=False):
+    '''
+    Отправляет сообщения рассылки группе её клиентов в прогоне run (для пакетной отправки вне Celery).
+    С dry_run письма только собираются, без SMTP, логов и журнала доставок.
+    Возвращает {'sent': отправлено (или собрано), 'failed': с ошибкой, 'bytes': размер собранных писем}
+    '''
+    messages = list(Newsletter.objects.get(pk=newsletter_id).messages.all())
+    clients = Client.objects.filter(pk__in=client_ids, is_blocked=False)
+    ledger = DeliveryLedger(run)
+    if dry_run:
+        result = {'sent': 0, 'failed': 0, 'bytes': 0}
+        for _, batch in iter_batches(clients, messages, batch_size or settings.MAIL_SENDER_BATCH_SIZE, ledger):
+            result['sent'] += len(batch)
+            result['bytes'] += sum(len(letter.email.message().as_bytes()) for letter in batch)
+        return result
+    engine = get_engine(batch_size=batch_size)
+    with engine, get_log_writer() as log_writer, ledger:
+        return dict(send_to_clients(clients, messages, engine, log_writer, ledger), bytes=0)
+
+
+def new_run():
+    return uuid.uuid4().hex
+
+
+def mail_send(period=None, newsletters=None, engine=None, log_writer=None, run=None):
+    '''
+    Отправляет рассылки; если передать run прерванного прогона,
+    уже доставленные в нём письма повторно не отправляются
+    '''
+    if not period and not newsletters:
         return None
     if not newsletters:
         newsletters = Newsletter.objects.filter(period=period)
-    for newsletter in newsletters:  # перебираем каждую
-        messages = newsletter.messages.all()  # получаем список сообщений для этой рассылки
-        newsletter.status = Newsletter.STATUS_STARTED
-        newsletter.save()
-        for client in newsletter.client.filter(is_blocked=False):  # перебираем всех пользователей этой рассылки
-            for message in messages:  # перебираем все сообщения для этой рассылки
-                try:
-                    Log.objects.create(  # логи о начале отправки
-                        date_attempt=datetime.now(),
-                        state=Newsletter.STATUS_STARTED,
-                        response_server="200",
-                        message=message
-                    )
-                    send_mail(  # делаем рассылку
-                        subject=message.theme,
-                        message=message.letter,
-                        from_email=settings.EMAIL_HOST_USER,
-                        recipient_list=[client.email],
-                    )
-                    Log.objects.create(  # логи о завершении отправки
-                        date_attempt=datetime.now(),
-                        state=Newsletter.STATUS_DONE,
-                        response_server="200",
-                        message=message
-                    )
-                except Exception as e:  # если произошла ошибка при отправке
-                    Log.objects.create(
-                        date_attempt=datetime.now(),
-                        state='1',
-                        response_server=str(e),
-                        message=message
-                    )
-        newsletter.status = Newsletter.STATUS_DONE
-        newsletter.save()
+    engine = engine or get_engine()
+    log_writer = log_writer or get_log_writer()
+    ledger = DeliveryLedger(run or new_run())
+    with engine, log_writer, ledger:  # одно соединение, один буфер логов и одна запись статистики на весь прогон
+        for newsletter in newsletters:  # перебираем каждую
+            send_newsletter(newsletter, engine, log_writer, ledger)
+    return ledger.run
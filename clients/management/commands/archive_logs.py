@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from clients.log_archive import archive_logs, archive_dir, compact
+
+
+class Command(BaseCommand):
+    help = 'Переносит старые логи рассылки в сжатый архив по дням и удаляет их из базы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.LOG_RETENTION_DAYS,
+                            help='сколько последних дней логов оставить в базе')
+        parser.add_argument('--batch-size', type=int, default=settings.LOG_ARCHIVE_BATCH_SIZE,
+                            help='строк в одной пачке переноса')
+        parser.add_argument('--dry-run', action='store_true', help='только посчитать логи для переноса')
+        parser.add_argument('--vacuum', action='store_true',
+                            help='после переноса сжать базу (на SQLite блокирует её на время работы)')
+
+    def handle(self, *args, **options):
+        archived, days = archive_logs(days=options['days'], batch_size=options['batch_size'],
+                                      dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write(f'Логов для переноса в архив: {archived}')
+            return
+        self.stdout.write(f'Перенесено в архив {archive_dir()}: {archived}')
+        if days:
+            self.stdout.write(f'Дни: {days[0]} - {days[-1]}')
+        if options['vacuum']:
+            compact()
+            self.stdout.write('База сжата')
@@ -0,0 +1,69 @@
+import json
+import platform
+import subprocess
+
+import django
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from clients.benchmarks import SUITES, EMAIL_BACKENDS
+
+
+class Command(BaseCommand):
+    help = 'Замеры производительности рассылки на синтетических данных (данные после замера откатываются)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('suites', nargs='+', choices=sorted(SUITES))
+        parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--backend', choices=sorted(EMAIL_BACKENDS), default='fake')
+        parser.add_argument('--latency', type=float, default=0, help='задержка fake SMTP на письмо, секунд')
+        parser.add_argument('--messages', type=int, default=2, help='сообщений в рассылке (mailing)')
+        parser.add_argument('--no-memory', action='store_true', help='не замерять память (tracemalloc замедляет код)')
+        parser.add_argument('--output', help='файл для результатов в JSON')
+
+    def handle(self, *args, **options):
+        results = []
+        for name in options['suites']:
+            for scale in options['scales']:
+                with transaction.atomic():
+                    rows = SUITES[name](
+                        scale,
+                        trace_memory=not options['no_memory'],
+                        backend=options['backend'],
+                        latency=options['latency'],
+                        messages=options['messages'],
+                    )
+                    transaction.set_rollback(True)
+                for row in rows:
+                    row = dict(row, suite=name, scale=scale)
+                    results.append(row)
+                    self.stdout.write(', '.join(f'{key}={value}' for key, value in row.items()))
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump({'environment': self.environment(options), 'results': results}, file,
+                          ensure_ascii=False, indent=2)
+            self.stdout.write(f'Результаты записаны в {options["output"]}')
+
+    def environment(self, options):
+        '''
+        Условия замера, чтобы результаты разных версий можно было сравнивать
+        '''
+        try:
+            revision = subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True,
+            ).stdout.strip()
+        except OSError:
+            revision = ''
+        return {
+            'created_at': timezone.now().isoformat(),
+            'revision': revision,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': settings.DATABASES['default']['ENGINE'],
+            'backend': options['backend'],
+            'latency': options['latency'],
+            'engine': settings.MAIL_SENDER_ENGINE,
+            'batch_size': settings.MAIL_SENDER_BATCH_SIZE,
+        }
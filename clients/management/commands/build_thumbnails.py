@@ -0,0 +1,28 @@
+from django.core.management import BaseCommand
+from django.db.models import F
+
+from clients.models import Client
+from clients.tasks import make_avatar_thumbnails
+
+
+class Command(BaseCommand):
+    help = 'Строит миниатюры аватаров клиентов, для которых их ещё нет'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='перестроить и уже готовые миниатюры')
+        parser.add_argument('--sync', action='store_true', help='строить в этом процессе, а не задачами Celery')
+
+    def handle(self, *args, **options):
+        clients = Client.objects.exclude(avatar='').exclude(avatar__isnull=True)
+        if options['force']:
+            clients.update(thumbnails_for='')
+        else:
+            clients = clients.exclude(thumbnails_for=F('avatar'))
+        count = 0
+        for pk in clients.values_list('pk', flat=True).iterator():
+            if options['sync']:
+                make_avatar_thumbnails(pk)
+            else:
+                make_avatar_thumbnails.delay(pk)
+            count += 1
+        self.stdout.write(f'Клиентов с аватаром в обработке: {count}')
@@ -0,0 +1,26 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from clients.benchmarks import generate_data
+
+
+class Command(BaseCommand):
+    help = 'Создаёт синтетических пользователей, клиентов, рассылки и сообщения'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1)
+        parser.add_argument('--clients', type=int, default=1000, help='клиентов у каждого пользователя')
+        parser.add_argument('--newsletters', type=int, default=1, help='рассылок у каждого пользователя')
+        parser.add_argument('--messages', type=int, default=1, help='сообщений в каждой рассылке')
+        parser.add_argument('--prefix', help='префикс почтовых адресов (по умолчанию случайный)')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            newsletters = generate_data(
+                users=options['users'],
+                clients=options['clients'],
+                newsletters=options['newsletters'],
+                messages=options['messages'],
+                prefix=options['prefix'],
+            )
+        self.stdout.write(f'Создано рассылок: {len(newsletters)}, id: {", ".join(str(n.pk) for n in newsletters)}')
@@ -1,45 +1,136 @@
-from datetime import datetime
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from django.core.mail import send_mail
+import django
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
 
-from clients.models import Newsletter, Log
-from CW_6_Django import settings
+from clients.mail_sender import send_chunk, new_run
+from clients.models import Newsletter, Delivery
 
-from django.core.management import BaseCommand
+
+def init_worker():
+    '''
+    Процесс пула: Django настраивается заново (если процесс запущен через spawn),
+    соединения с базой, унаследованные от родителя через fork, не используются
+    '''
+    django.setup()
+    connections.close_all()
 
 
 class Command(BaseCommand):
+    help = 'Пакетная отправка рассылок вне Celery на нескольких процессах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--newsletter', type=int, action='append', dest='newsletters',
+                            help='id рассылки (можно указать несколько раз)')
+        parser.add_argument('--period', choices=[period for period, _ in Newsletter.PERIODS],
+                            help='отправить все рассылки с этой периодичностью')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='процессов отправки (по умолчанию - по числу ядер)')
+        parser.add_argument('--batch-size', type=int, default=settings.MAIL_SENDER_BATCH_SIZE,
+                            help='писем в одной пачке отправки')
+        parser.add_argument('--chunk-size', type=int, default=settings.MAILING_CHUNK_SIZE,
+                            help='получателей в задании одного процесса')
+        parser.add_argument('--limit', type=int, help='отправить не больше стольких получателей')
+        parser.add_argument('--run', help='продолжить прерванный прогон: доставленное в нём не отправляется')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='только собрать и посчитать письма, без SMTP и записи в базу')
 
     def handle(self, *args, **options):
-        newsletters = Newsletter.objects.all()  # получаем все рассылки
-        for newsletter in newsletters:  # перебираем каждую
-            messages = newsletter.messages.all()  # получаем список сообщений для этой рассылки
-            for client in newsletter.client.all():  # перебираем всех пользователей этой рассылки
-                for message in messages:  # перебираем все сообщения для этой рассылки
+        newsletters = Newsletter.objects.order_by('pk')
+        if options['newsletters']:
+            newsletters = newsletters.filter(pk__in=options['newsletters'])
+        elif options['period']:
+            newsletters = newsletters.filter(period=options['period'])
+        elif options['run']:
+            newsletters = newsletters.filter(
+                pk__in=Delivery.objects.filter(run=options['run']).values('message__newsletter'),
+            )
+        else:
+            raise CommandError('Укажите --newsletter, --period или --run')
+        run = options['run'] or new_run()
+        self.verbosity = options['verbosity']
+        dry_run = options['dry_run']
+        chunk_size = options['chunk_size']
+        limit = options['limit']
+
+        jobs = []
+        newsletter_ids = []
+        self.messages_count = {}  # писем на получателя: пачка с ошибкой считается недоставленной целиком
+        for newsletter in newsletters:
+            client_ids = list(newsletter.client.filter(is_blocked=False).order_by('pk').values_list('pk', flat=True))
+            if limit is not None:
+                client_ids = client_ids[:limit - sum(len(ids) for _, ids in jobs)]
+            if not client_ids:
+                continue
+            newsletter_ids.append(newsletter.pk)
+            self.messages_count[newsletter.pk] = newsletter.messages.count()
+            jobs.extend((newsletter.pk, client_ids[i:i + chunk_size]) for i in range(0, len(client_ids), chunk_size))
+        if not jobs:
+            self.stdout.write('Получателей нет')
+            return
+        if not dry_run:
+            Newsletter.objects.filter(pk__in=newsletter_ids).update(status=Newsletter.STATUS_STARTED)
+
+        totals = {'sent': 0, 'failed': 0, 'bytes': 0}
+        self.failed_chunks = 0
+        workers = max(1, min(options['workers'], len(jobs)))
+        start = time.monotonic()
+        try:
+            if workers == 1:
+                for newsletter_id, ids in jobs:
                     try:
-                        Log.objects.create(  # логи о начале отправки
-                            date_attempt=datetime.now(),
-                            state=Newsletter.STATUS_STARTED,
-                            response_server="200",
-                            message=message
-                        )
-                        send_mail(  # делаем рассылку
-                            subject=message.theme,
-                            message=message.letter,
-                            from_email=settings.EMAIL_HOST_USER,
-                            recipient_list=[client.email],
-                        )
-                        Log.objects.create(  # логи о завершении отправки
-                            date_attempt=datetime.now(),
-                            state=Newsletter.STATUS_DONE,
-                            response_server="200",
-                            message=message
-                        )
-                    except Exception as e:  # если произошла ошибка при отправке
-                        Log.objects.create(
-                            date_attempt=datetime.now(),
-                            state='1',
-                            response_server=str(e),
-                            message=message
-                        )
+                        result = send_chunk(newsletter_id, ids, run, options['batch_size'], dry_run)
+                    except Exception as e:
+                        result = self.chunk_failed(newsletter_id, ids, e)
+                    self.add_result(totals, result, start)
+            else:
+                connections.close_all()  # процессы пула откроют свои соединения
+                with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+                    futures = {}
+                    for newsletter_id, ids in jobs:
+                        future = pool.submit(send_chunk, newsletter_id, ids, run, options['batch_size'], dry_run)
+                        futures[future] = newsletter_id, ids
+                    for future in as_completed(futures):
+                        try:
+                            result = future.result()
+                        except Exception as e:  # ошибка в пачке или упавший процесс пула
+                            result = self.chunk_failed(*futures[future], e)
+                        self.add_result(totals, result, start)
+        finally:
+            # итог и статус - даже если прогон прервали: недоставленное дошлёт --run
+            elapsed = time.monotonic() - start
+            if not dry_run:
+                Newsletter.objects.filter(pk__in=newsletter_ids).update(status=Newsletter.STATUS_DONE)
+            self.report(totals, elapsed, workers, run, dry_run, newsletter_ids, jobs)
+
+    def report(self, totals, elapsed, workers, run, dry_run, newsletter_ids, jobs):
+        letters = totals['sent'] + totals['failed']
+        self.stdout.write(
+            f'{"Собрано" if dry_run else "Отправлено"} писем: {totals["sent"]}, с ошибкой: {totals["failed"]}, '
+            f'рассылок: {len(newsletter_ids)}, получателей: {sum(len(ids) for _, ids in jobs)}'
+        )
+        if self.failed_chunks:
+            self.stdout.write(f'Пачек с ошибкой: {self.failed_chunks}')
+        self.stdout.write(
+            f'Время: {elapsed:.1f} с, процессов: {workers}, {letters / elapsed if elapsed else 0:.1f} писем/с'
+        )
+        if dry_run:
+            self.stdout.write(f'Объём писем: {totals["bytes"] / 1024 / 1024:.1f} МБ')
+        else:
+            self.stdout.write(f'Прогон: {run} (повтор недоставленного: --run {run})')
+
+    def chunk_failed(self, newsletter_id, client_ids, error):
+        self.failed_chunks += 1
+        self.stderr.write(f'Пачка рассылки {newsletter_id} ({len(client_ids)} получателей) не отправлена: {error!r}')
+        return {'sent': 0, 'failed': len(client_ids) * self.messages_count[newsletter_id], 'bytes': 0}
 
+    def add_result(self, totals, result, start):
+        for key in totals:
+            totals[key] += result[key]
+        if self.verbosity > 1:
+            elapsed = time.monotonic() - start
+            self.stdout.write(f'... {totals["sent"] + totals["failed"]} писем за {elapsed:.1f} с')
@@ -0,0 +1,39 @@
+import json
+
+from django.core.management import BaseCommand
+from django.db import transaction
+from django_celery_beat.models import PeriodicTask, CrontabSchedule
+
+from clients.models import Newsletter
+from clients.scheduling import schedule
+
+
+class Command(BaseCommand):
+    help = 'Переводит рассылки с отдельных задач clients.tasks.mailing на общее расписание (next_run_at)'
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        newsletters = Newsletter.objects.in_bulk()
+        scheduled = disabled = deleted = 0
+        tasks = PeriodicTask.objects.filter(task='clients.tasks.mailing')
+        for task in tasks:
+            args = json.loads(task.args or '[]')
+            # имя задачи - id рассылки, для которой она создавалась (старые задачи передают периодичность)
+            newsletter_id = args[0] if args and args[0] not in dict(Newsletter.PERIODS) else task.name
+            newsletter = newsletters.get(int(newsletter_id)) if str(newsletter_id).isdigit() else None
+            if newsletter is None:
+                deleted += 1  # рассылки больше нет, отправлять нечего
+                continue
+            if task.enabled:
+                schedule(newsletter)
+                scheduled += 1
+            else:
+                newsletter.next_run_at = None
+                disabled += 1
+            newsletter.save(update_fields=['next_run_at'])
+        crontab_ids = list(tasks.values_list('crontab_id', flat=True))
+        tasks.delete()
+        # расписания, которые создавались под каждую рассылку, больше никому не нужны
+        CrontabSchedule.objects.filter(pk__in=crontab_ids, periodictask__isnull=True).delete()
+        self.stdout.write(f'Рассылок по расписанию: {scheduled}, отключено: {disabled}, '
+                          f'удалено задач без рассылки: {deleted}')
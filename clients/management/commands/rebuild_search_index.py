@@ -0,0 +1,12 @@
+from django.core.management import BaseCommand
+
+from clients import search
+
+
+class Command(BaseCommand):
+    help = 'Создаёт и заново заполняет поисковый индекс клиентов'
+
+    def handle(self, *args, **options):
+        search.setup()
+        count = search.rebuild()
+        self.stdout.write(f'Клиентов в индексе: {count}')
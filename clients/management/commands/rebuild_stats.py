@@ -0,0 +1,17 @@
+import datetime
+
+from django.core.management import BaseCommand
+
+from clients.stats import rebuild_stats
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает дневную статистику отправки по логам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=datetime.date.fromisoformat,
+                            help='день (ГГГГ-ММ-ДД), начиная с которого пересчитать статистику (по умолчанию вся)')
+
+    def handle(self, *args, **options):
+        count = rebuild_stats(since=options['since'])
+        self.stdout.write(f'Записей статистики: {count}')
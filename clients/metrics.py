@@ -0,0 +1,264 @@
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from celery.signals import task_prerun, task_postrun
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from clients import caching
+
+logger = logging.getLogger(__name__)
+
+# Метрики запросов и задач рассылки в памяти процесса. Раз в METRICS_PUBLISH_INTERVAL секунд
+# процесс кладёт свой снимок в общий кеш, а страница метрик складывает снимки всех процессов
+# (веб-воркеров и воркеров Celery) и отдаёт их в текстовом формате Prometheus.
+PROCESSES_KEY = 'metrics:processes'
+PROCESS_KEY = f'metrics:{socket.gethostname()}:{os.getpid()}'
+PROCESS_TTL = 600  # снимок процесса, который перестал обновляться, пропадает из сумм
+
+# имя метрики -> (тип, описание); значения хранятся как {метки: число}
+METRICS = {
+    'requests_total': ('counter', 'Обработано запросов (из выборки)'),
+    'request_seconds_total': ('counter', 'Суммарное время обработки запросов'),
+    'request_queries_total': ('counter', 'Запросов к базе при обработке запросов'),
+    'request_query_seconds_total': ('counter', 'Суммарное время запросов к базе'),
+    'request_cache_hits_total': ('counter', 'Попаданий в кеш при обработке запросов'),
+    'request_cache_misses_total': ('counter', 'Промахов кеша при обработке запросов'),
+    'slow_requests_total': ('counter', 'Запросов дольше METRICS_SLOW_REQUEST_SECONDS'),
+    'task_runs_total': ('counter', 'Выполнено задач рассылки'),
+    'task_seconds_total': ('counter', 'Суммарное время задач рассылки'),
+    'task_queries_total': ('counter', 'Запросов к базе в задачах рассылки'),
+    'task_emails_sent_total': ('counter', 'Писем отправлено задачами рассылки'),
+    'task_smtp_seconds_total': ('counter', 'Суммарное время отправки писем по SMTP'),
+    'slow_tasks_total': ('counter', 'Задач дольше METRICS_SLOW_TASK_SECONDS'),
+    'cache_events_total': ('counter', 'События кеша clients.caching'),
+    'rate_limit_events_total': ('counter', 'События ограничителя скорости отправки'),
+}
+
+_lock = threading.Lock()
+_values = defaultdict(lambda: defaultdict(float))
+_published_at = 0
+_local = threading.local()
+
+
+def sampled():
+    rate = settings.METRICS_SAMPLE_RATE
+    return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def add(name, labels, value=1):
+    with _lock:
+        _values[name][labels] += value
+
+
+class QueryTimer:
+    '''
+    execute_wrapper: считает запросы к базе и их время
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+    '''
+    Для доли запросов METRICS_SAMPLE_RATE собирает время ответа, число и время запросов к базе,
+    попадания и промахи кеша по имени view; запросы дольше бюджета пишет в лог.
+    Если выборка выключена, запрос проходит без замеров.
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not sampled():
+            return self.get_response(request)
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(timer), caching.counting() as cache_events:
+            response = self.get_response(request)
+        seconds = time.perf_counter() - start
+        match = getattr(request, 'resolver_match', None)
+        labels = (('view', match.view_name if match else 'unresolved'),)
+        add('requests_total', labels)
+        add('request_seconds_total', labels, seconds)
+        add('request_queries_total', labels, timer.count)
+        add('request_query_seconds_total', labels, timer.seconds)
+        add('request_cache_hits_total', labels, cache_events['hits'])
+        add('request_cache_misses_total', labels, cache_events['misses'])
+        if seconds > settings.METRICS_SLOW_REQUEST_SECONDS:
+            add('slow_requests_total', labels)
+            logger.warning(
+                'Медленный запрос %s %s (%s): %.0f мс, запросов к базе %s (%.0f мс)',
+                request.method, request.path, labels[0][1], seconds * 1000, timer.count, timer.seconds * 1000,
+            )
+        publish()
+        return response
+
+
+def task_started(task_name):
+    '''
+    Начинает замер задачи рассылки в этом потоке (если она попала в выборку).
+    Задачи в режиме eager выполняются вложенно, поэтому замеры лежат стеком
+    '''
+    stack = _local.__dict__.setdefault('tasks', [])
+    if not sampled():
+        stack.append(None)
+        return
+    timer = QueryTimer()
+    wrapper = connection.execute_wrapper(timer)
+    wrapper.__enter__()
+    stack.append({
+        'name': task_name, 'start': time.perf_counter(), 'timer': timer, 'wrapper': wrapper,
+        'sent': 0, 'smtp_seconds': 0.0,
+    })
+
+
+def current_task():
+    '''
+    Замер задачи, которая выполняется в этом потоке (None - замера нет)
+    '''
+    stack = getattr(_local, 'tasks', None)
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def in_task(task):
+    '''
+    Отправка в этом потоке учитывается в замере task, начатом в другом потоке
+    (сессии ThreadedMailEngine работают в потоках пула, а задача - в потоке воркера)
+    '''
+    stack = _local.__dict__.setdefault('tasks', [])
+    stack.append(task)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def record_smtp(sent, seconds):
+    '''
+    Отправка писем движком: учитывается в замере текущей задачи, если он идёт.
+    Замер могут пополнять несколько потоков сразу, поэтому под блокировкой
+    '''
+    task = current_task()
+    if task is not None:
+        with _lock:
+            task['sent'] += sent
+            task['smtp_seconds'] += seconds
+
+
+def task_finished(state):
+    stack = getattr(_local, 'tasks', None)
+    task = stack.pop() if stack else None
+    if task is None:
+        return
+    task['wrapper'].__exit__(None, None, None)
+    seconds = time.perf_counter() - task['start']
+    with _lock:  # потоки отправки уже закончили, но их записи должны быть видны целиком
+        sent, smtp_seconds = task['sent'], task['smtp_seconds']
+    labels = (('task', task['name']),)
+    add('task_runs_total', labels + (('state', state),))
+    add('task_seconds_total', labels, seconds)
+    add('task_queries_total', labels, task['timer'].count)
+    add('task_emails_sent_total', labels, sent)
+    add('task_smtp_seconds_total', labels, smtp_seconds)
+    if seconds > settings.METRICS_SLOW_TASK_SECONDS:
+        add('slow_tasks_total', labels)
+        logger.warning(
+            'Долгая задача %s: %.1f с, писем %s (SMTP %.1f с), запросов к базе %s',
+            task['name'], seconds, sent, smtp_seconds, task['timer'].count,
+        )
+    publish()
+
+
+@task_prerun.connect
+def on_task_prerun(sender=None, **kwargs):
+    if sender.name.startswith(settings.METRICS_TASK_PREFIX):
+        task_started(sender.name)
+
+
+@task_postrun.connect
+def on_task_postrun(sender=None, state=None, **kwargs):
+    if sender.name.startswith(settings.METRICS_TASK_PREFIX):
+        task_finished(state or 'UNKNOWN')
+
+
+def snapshot():
+    from clients.rate_limit import get_rate_limiter
+
+    with _lock:
+        values = {name: dict(series) for name, series in _values.items()}
+    # счётчики, которые ведут сами модули, тоже попадают в снимок процесса
+    values['cache_events_total'] = {(('event', event),): count for event, count in caching.events().items()}
+    rate_limiter = get_rate_limiter()
+    if rate_limiter is not None:
+        values['rate_limit_events_total'] = {
+            (('event', event),): value for event, value in rate_limiter.metrics.items()
+        }
+    return values
+
+
+def publish(force=False):
+    global _published_at
+    now = time.monotonic()
+    if not settings.CACHE_ENABLED or (not force and now - _published_at < settings.METRICS_PUBLISH_INTERVAL):
+        return
+    _published_at = now
+    try:
+        cache.set(PROCESS_KEY, snapshot(), timeout=PROCESS_TTL)
+        processes = cache.get(PROCESSES_KEY) or set()
+        if PROCESS_KEY not in processes:
+            cache.set(PROCESSES_KEY, processes | {PROCESS_KEY}, timeout=None)
+    except Exception as e:  # метрики не должны ронять запрос, если кеш недоступен
+        logger.warning('Не удалось опубликовать метрики: %s', e)
+
+
+def collect():
+    '''
+    Суммы по всем процессам, опубликовавшим снимок, или только по текущему, если кеш недоступен
+    '''
+    snapshots = {PROCESS_KEY: snapshot()}
+    if settings.CACHE_ENABLED:
+        try:
+            processes = cache.get(PROCESSES_KEY) or set()
+            found = cache.get_many([key for key in processes if key != PROCESS_KEY])
+            snapshots.update(found)
+            if len(found) + 1 < len(processes | {PROCESS_KEY}):  # убираем процессы с истёкшим снимком
+                cache.set(PROCESSES_KEY, set(found) | {PROCESS_KEY}, timeout=None)
+        except Exception as e:
+            logger.warning('Не удалось прочитать метрики других процессов: %s', e)
+    totals = defaultdict(lambda: defaultdict(float))
+    for values in snapshots.values():
+        for name, series in values.items():
+            for labels, value in series.items():
+                totals[name][labels] += value
+    return totals
+
+
+def render(totals):
+    lines = []
+    for name, series in sorted(totals.items()):
+        kind, help_text = METRICS.get(name, ('counter', ''))
+        lines.append(f'# HELP {name} {help_text}'.rstrip())
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(series.items()):
+            label_text = ','.join(f'{key}="{value_}"' for key, value_ in labels)
+            lines.append(f'{name}{{{label_text}}} {value:.15g}' if label_text else f'{name} {value:.15g}')
+    return '\n'.join(lines) + '\n'
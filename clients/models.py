@@ -43,6 +43,9 @@ class Client(models.Model):
     full_name = models.CharField(max_length=100, verbose_name='ФИО')
     comment = models.TextField(verbose_name='комментарий')
     avatar = models.ImageField(upload_to='users/', verbose_name='Аватар', **NULLABLE)
+    # аватар, для которого уже построены миниатюры: пока не совпадает с avatar, показывается оригинал
+    thumbnails_for = models.CharField(max_length=100, blank=True, default='', editable=False,
+                                      verbose_name='миниатюры построены для')
     user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Пользователь (Создатель)")
     is_blocked = models.BooleanField(default=False, verbose_name="Блокировка")
 
@@ -87,6 +90,7 @@ class Newsletter(models.Model):
     status = models.CharField(max_length=30, choices=STATUSES, verbose_name='статус рассылки')
     client = models.ManyToManyField(Client, verbose_name='Клиент')
     user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Пользователь (Создатель)")
+    next_run_at = models.DateTimeField(verbose_name='следующий запуск', editable=False, **NULLABLE)
 
     def __str__(self):
         return f'{self.time}, {self.period}, {self.status}'
@@ -95,6 +99,10 @@ class Newsletter(models.Model):
         verbose_name = 'рассылка'
         verbose_name_plural = 'рассылки'
         ordering = ('id',)
+        indexes = [
+            # тик расписания выбирает наступившие запуски диапазоном по этому индексу
+            models.Index(fields=('next_run_at',), name='newsletter_next_run_idx'),
+        ]
 
 
 class Message(models.Model):
@@ -124,10 +132,19 @@ class Log(models.Model):
     статус попытки;
     ответ почтового сервера, если он был.
     '''
+    STATE_ERROR = '1'
+
+    STATES = (
+        (Newsletter.STATUS_STARTED, 'Отправка начата'),
+        (Newsletter.STATUS_DONE, 'Отправлено'),
+        (STATE_ERROR, 'Ошибка'),
+    )
+
     date_attempt = models.DateTimeField(verbose_name='дата и время последней попытки')
     state = models.CharField(max_length=50, verbose_name='статус попытки')
     response_server = models.CharField(max_length=250, verbose_name='ответ почтового сервера')
     message = models.ForeignKey(Message, on_delete=models.CASCADE, verbose_name="сообщение")
+    client = models.ForeignKey(Client, on_delete=models.SET_NULL, verbose_name="клиент", **NULLABLE)
 
     def __str__(self):
         return f'{self.date_attempt}, {self.state}, {self.response_server}'
@@ -136,3 +153,114 @@ class Log(models.Model):
         verbose_name = 'лог'
         verbose_name_plural = 'логи'
         ordering = ('id',)
+        indexes = [
+            # страницы отчётов выбираются диапазоном по дате внутри сообщения или статуса
+            models.Index(fields=('message', 'date_attempt'), name='log_message_date_idx'),
+            models.Index(fields=('state', 'date_attempt'), name='log_state_date_idx'),
+            # перенос старых логов в архив выбирает их по дате
+            models.Index(fields=('date_attempt',), name='log_date_idx'),
+        ]
+
+
+class Delivery(models.Model):
+    '''
+    Журнал доставки сообщения клиенту в рамках одного прогона рассылки:
+    прогон, сообщение, клиент,
+    статус доставки, количество попыток, последняя ошибка.
+    '''
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+
+    STATUSES = (
+        (STATUS_SENT, 'Доставлено'),
+        (STATUS_FAILED, 'Ошибка'),
+    )
+
+    run = models.CharField(max_length=64, verbose_name='прогон рассылки')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, verbose_name='сообщение')
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, verbose_name='клиент')
+    status = models.CharField(max_length=30, choices=STATUSES, verbose_name='статус доставки')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='количество попыток')
+    error = models.CharField(max_length=250, blank=True, verbose_name='последняя ошибка')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='дата и время последней попытки')
+
+    def __str__(self):
+        return f'{self.run}, {self.message_id}, {self.client_id}, {self.status}'
+
+    class Meta:
+        verbose_name = 'доставка'
+        verbose_name_plural = 'доставки'
+        ordering = ('id',)
+        constraints = [
+            # уникальность заодно даёт индекс (run, message, client) для поиска уже доставленного
+            models.UniqueConstraint(fields=('run', 'message', 'client'), name='unique_delivery'),
+        ]
+
+
+class DeliveryStat(models.Model):
+    '''
+    Статистика отправки за день:
+    рассылка, сообщение, день,
+    попыток отправки, доставлено, с ошибкой.
+    '''
+    newsletter = models.ForeignKey(Newsletter, on_delete=models.CASCADE, verbose_name='рассылка')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, verbose_name='сообщение')
+    day = models.DateField(verbose_name='день')
+    attempted = models.PositiveIntegerField(default=0, verbose_name='попыток отправки')
+    delivered = models.PositiveIntegerField(default=0, verbose_name='доставлено')
+    failed = models.PositiveIntegerField(default=0, verbose_name='с ошибкой')
+
+    def __str__(self):
+        return f'{self.day}, {self.message_id}, {self.attempted}, {self.delivered}, {self.failed}'
+
+    class Meta:
+        verbose_name = 'статистика отправки'
+        verbose_name_plural = 'статистика отправки'
+        ordering = ('day', 'id')
+        constraints = [
+            models.UniqueConstraint(fields=('message', 'day'), name='unique_delivery_stat'),
+        ]
+        indexes = [
+            models.Index(fields=('newsletter', 'day'), name='delivery_stat_newsletter_idx'),
+        ]
+
+
+class OutboxEmail(models.Model):
+    '''
+    Служебное письмо пользователю (код подтверждения, новый пароль):
+    пишется в той же транзакции, что и изменения пользователя,
+    отправляется задачей Celery из отдельной очереди с повторами.
+    '''
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+
+    STATUSES = (
+        (STATUS_PENDING, 'Ожидает отправки'),
+        (STATUS_SENDING, 'Отправляется'),
+        (STATUS_SENT, 'Отправлено'),
+        (STATUS_FAILED, 'Ошибка'),
+    )
+
+    to = models.EmailField(verbose_name='получатель')
+    subject = models.CharField(max_length=250, verbose_name='тема письма')
+    body = models.TextField(verbose_name='тело письма')
+    status = models.CharField(max_length=30, choices=STATUSES, default=STATUS_PENDING, verbose_name='статус')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='количество попыток')
+    error = models.CharField(max_length=250, blank=True, verbose_name='последняя ошибка')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='дата и время создания')
+    next_attempt_at = models.DateTimeField(verbose_name='дата и время следующей попытки')
+    sent_at = models.DateTimeField(verbose_name='дата и время отправки', **NULLABLE)
+
+    def __str__(self):
+        return f'{self.to}, {self.subject}, {self.status}'
+
+    class Meta:
+        verbose_name = 'служебное письмо'
+        verbose_name_plural = 'служебные письма'
+        ordering = ('id',)
+        indexes = [
+            # подборщик зависших писем ищет ожидающие с прошедшей попыткой
+            models.Index(fields=('status', 'next_attempt_at'), name='outbox_status_attempt_idx'),
+        ]
@@ -0,0 +1,88 @@
+import datetime
+import logging
+
+from django.conf import settings
+from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from clients.models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+# Служебные письма (регистрация, новый пароль) не отправляются из запроса:
+# enqueue пишет письмо в таблицу в транзакции запроса, после коммита задача
+# send_outbox_email из очереди ACCOUNT_EMAIL_QUEUE отправляет его с повторами.
+# Эту очередь слушает отдельный воркер, поэтому большая рассылка не задерживает код подтверждения.
+# Если после коммита поставить задачу не удалось (брокер недоступен),
+# письмо подберёт периодическая задача drain_outbox.
+# В теле письма пароль или код, поэтому после отправки или последней неудачной попытки
+# тело стирается: в таблице остаётся только журнал (кому, тема, статус).
+
+
+def enqueue(to, subject, body):
+    '''
+    Кладёт письмо в очередь отправки; вызывать внутри транзакции, которая меняет пользователя
+    '''
+    email = OutboxEmail.objects.create(to=to, subject=subject, body=body, next_attempt_at=timezone.now())
+    transaction.on_commit(lambda: dispatch(email.pk))
+    return email
+
+
+def dispatch(email_id):
+    from clients.tasks import send_outbox_email
+
+    try:
+        send_outbox_email.apply_async((email_id,), queue=settings.ACCOUNT_EMAIL_QUEUE)
+    except Exception as e:  # письмо уже в таблице, его отправит drain_outbox
+        logger.warning('Служебное письмо %s не поставлено в очередь: %s', email_id, e)
+
+
+def deliver(email_id):
+    '''
+    Отправляет письмо, если оно ещё ждёт отправки. При ошибке отмечает попытку и время следующей
+    и выбрасывает исключение (повтор делает задача). Возвращает True, если письмо отправлено сейчас
+    '''
+    # письмо забирается условным UPDATE: из двух задач с одним письмом (повтор и drain_outbox)
+    # отправит только та, что первой перевела его из ожидания в отправку
+    claimed = OutboxEmail.objects.filter(pk=email_id, status=OutboxEmail.STATUS_PENDING).update(
+        status=OutboxEmail.STATUS_SENDING, attempts=F('attempts') + 1, next_attempt_at=timezone.now(),
+    )
+    if not claimed:
+        return False  # уже отправляется или отправлено (например, повтором из drain_outbox), или попытки исчерпаны
+    email = OutboxEmail.objects.get(pk=email_id)
+    try:
+        send_mail(
+            subject=email.subject,
+            message=email.body,
+            from_email=settings.EMAIL_HOST_USER,
+            recipient_list=[email.to],
+        )
+    except Exception as e:
+        email.error = str(e)[:250]
+        delay = settings.ACCOUNT_EMAIL_RETRY_DELAY * 2 ** (email.attempts - 1)
+        email.next_attempt_at = timezone.now() + datetime.timedelta(seconds=delay)
+        email.status = OutboxEmail.STATUS_PENDING
+        if email.attempts >= settings.ACCOUNT_EMAIL_MAX_ATTEMPTS:
+            email.status = OutboxEmail.STATUS_FAILED
+            email.body = ''
+        email.save(update_fields=['error', 'next_attempt_at', 'status', 'body'])
+        raise
+    email.status = OutboxEmail.STATUS_SENT
+    email.sent_at = timezone.now()
+    email.error = ''
+    email.body = ''
+    email.save(update_fields=['error', 'status', 'sent_at', 'body'])
+    return True
+
+
+def stale_emails():
+    '''
+    Ожидающие письма, попытка которых должна была пройти больше ACCOUNT_EMAIL_STALE_AFTER секунд назад,
+    и письма, отправка которых началась так же давно и не закончилась (воркер упал)
+    '''
+    overdue = timezone.now() - datetime.timedelta(seconds=settings.ACCOUNT_EMAIL_STALE_AFTER)
+    return OutboxEmail.objects.filter(
+        status__in=(OutboxEmail.STATUS_PENDING, OutboxEmail.STATUS_SENDING), next_attempt_at__lt=overdue,
+    )
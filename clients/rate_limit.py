@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Ведро пополняется со скоростью rate токенов в секунду до capacity. Токены берутся сразу,
+# даже в долг: отрицательный остаток - это очередь писем, которые уже заняли своё время отправки,
+# а возвращаемое время ожидания = долг / rate. Если n = 0, скрипт только сообщает текущий долг.
+# KEYS - вёдра (общее и аккаунта отправителя), ARGV - n, затем rate и capacity каждого ведра.
+TOKEN_BUCKET_SCRIPT = '''
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local n = tonumber(ARGV[1])
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local capacity = tonumber(ARGV[i * 2 + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate) - n
+    if tokens < 0 then
+        wait = math.max(wait, -tokens / rate)
+    end
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil((capacity - tokens) / rate) + 60)
+end
+return tostring(wait)
+'''
+
+
+REDIS_RETRY_INTERVAL = 30  # секунд работы на локальном ведре после ошибки Redis
+
+
+class RateLimitExceeded(Exception):
+    '''
+    Ожидание свободного места превысило допустимое: пачку нужно вернуть в очередь
+    '''
+
+    def __init__(self, retry_after):
+        super().__init__(f'Превышен лимит отправки, повтор через {retry_after:.1f} с')
+        self.retry_after = retry_after
+        self.remaining_client_ids = []  # заполняет send_to_clients: кому ещё не отправляли
+        self.result = {'sent': 0, 'failed': 0}  # что успели отправить до остановки
+
+
+class LocalTokenBucket:
+    '''
+    Ведро токенов в памяти процесса, используется, если Redis недоступен
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = {}
+
+    def take(self, buckets, n):
+        now = time.monotonic()
+        wait = 0
+        with self.lock:
+            for key, rate, capacity in buckets:
+                tokens, ts = self.state.get(key, (capacity, now))
+                tokens = min(capacity, tokens + max(0, now - ts) * rate) - n
+                if tokens < 0:
+                    wait = max(wait, -tokens / rate)
+                self.state[key] = (tokens, now)
+        return wait
+
+
+class RateLimiter:
+    '''
+    Ограничение скорости отправки писем:
+    общее количество писем в секунду и отдельно для каждого аккаунта отправителя.
+    Состояние хранится в Redis и общее для всех воркеров Celery.
+    '''
+
+    def __init__(self, global_rate=None, sender_rate=None, burst=None, redis_url=None, client=None):
+        self.global_rate = global_rate or settings.MAIL_RATE_LIMIT_GLOBAL
+        self.sender_rate = sender_rate or settings.MAIL_RATE_LIMIT_PER_SENDER
+        self.burst = burst or settings.MAIL_RATE_LIMIT_BURST
+        redis_url = redis_url or settings.MAIL_RATE_LIMIT_REDIS_URL
+        if client is None and redis_url:
+            client = redis.Redis.from_url(redis_url, socket_connect_timeout=1, socket_timeout=1)
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT) if client is not None else None
+        self.local = LocalTokenBucket()
+        self.redis_down_until = 0  # после ошибки Redis какое-то время не дёргаем его на каждое письмо
+        # acquire вызывают потоки ThreadedMailEngine, поэтому счётчики меняются под блокировкой
+        self.lock = threading.Lock()
+        self.metrics = {
+            'acquired': 0,  # писем пропущено
+            'throttled': 0,  # из них пришлось ждать
+            'wait_seconds': 0.0,  # суммарное ожидание
+            'requeued': 0,  # пачек возвращено в очередь
+            'redis_errors': 0,  # обращений к Redis с ошибкой (использовалось локальное ведро)
+        }
+
+    def count(self, **deltas):
+        with self.lock:
+            for name, delta in deltas.items():
+                self.metrics[name] += delta
+
+    def buckets(self, sender):
+        return [
+            ('mail_rate:global', self.global_rate, self.global_rate * self.burst),
+            (f'mail_rate:sender:{sender}', self.sender_rate, self.sender_rate * self.burst),
+        ]
+
+    def take(self, sender, n):
+        buckets = self.buckets(sender)
+        if self.script is not None and time.monotonic() >= self.redis_down_until:
+            args = [n]
+            for key, rate, capacity in buckets:
+                args.extend((rate, capacity))
+            try:
+                return float(self.script(keys=[key for key, rate, capacity in buckets], args=args))
+            except redis.RedisError as e:
+                self.count(redis_errors=1)
+                self.redis_down_until = time.monotonic() + REDIS_RETRY_INTERVAL
+                logger.warning('Ограничитель отправки работает без Redis: %s', e)
+        return self.local.take(buckets, n)
+
+    def acquire(self, sender):
+        '''
+        Занимает место для одного письма и ждёт, пока подойдёт его очередь
+        '''
+        wait = self.take(sender, 1)
+        if wait > 0:
+            self.count(acquired=1, throttled=1, wait_seconds=wait)
+            time.sleep(wait)
+        else:
+            self.count(acquired=1)
+
+    def admit(self, sender, max_wait):
+        '''
+        Проверяет перед пачкой писем, что очередь к лимиту (письма других воркеров,
+        уже занявшие своё время) рассосётся за max_wait секунд,
+        иначе выбрасывает RateLimitExceeded, чтобы пачку переотправили позже
+        '''
+        if max_wait is None:
+            return
+        wait = self.take(sender, 0)
+        if wait > max_wait:
+            self.count(requeued=1)
+            raise RateLimitExceeded(retry_after=wait - max_wait)
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    '''
+    Общий для процесса ограничитель или None, если ограничение выключено
+    '''
+    global _rate_limiter
+    if not settings.MAIL_RATE_LIMIT_ENABLED:
+        return None
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter()
+    return _rate_limiter
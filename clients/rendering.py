@@ -0,0 +1,112 @@
+import hashlib
+import logging
+import re
+from collections import OrderedDict
+
+from django.template import TemplateSyntaxError
+
+logger = logging.getLogger(__name__)
+
+# поля клиента, доступные в теме и тексте письма: {{ full_name }}, {{ email }}
+PERSONALIZATION_FIELDS = ('full_name', 'email')
+
+# Шаблоны пишут пользователи, поэтому это не шаблоны Django: только подстановка полей клиента
+# {{ поле }}, без тегов и фильтров ({% debug %} выдал бы в письмо контекст и модули процесса,
+# фильтры вроде ljust позволяют занять воркер). Письма текстовые, значения не экранируются
+VARIABLE = re.compile(r'{{\s*(\w+)\s*}}')
+
+_cache = OrderedDict()  # (id сообщения, хэш текста) -> (шаблон темы, шаблон текста)
+CACHE_SIZE = 1000
+
+
+class PlainText:
+    '''
+    Текст без подстановок: рендер ничего не стоит
+    '''
+
+    def __init__(self, text):
+        self.text = text
+
+    def render(self, context):
+        return self.text
+
+
+class Substitution:
+    '''
+    Текст с подстановками {{ поле }}: части текста и имена полей вперемешку
+    '''
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def render(self, context):
+        return ''.join(part if i % 2 == 0 else str(context[part]) for i, part in enumerate(self.parts))
+
+
+def compile_text(text):
+    '''
+    Шаблон из текста. Если в тексте есть что-то кроме подстановок известных полей
+    (теги, фильтры, незакрытые скобки), выбрасывает TemplateSyntaxError
+    '''
+    if '{{' not in text and '{%' not in text:
+        return PlainText(text)
+    parts = VARIABLE.split(text)  # чётные - текст, нечётные - имена полей
+    unknown = sorted(set(parts[1::2]) - set(PERSONALIZATION_FIELDS))
+    if unknown:
+        raise TemplateSyntaxError(f'неизвестные поля: {", ".join(unknown)}')
+    if any('{{' in part or '{%' in part for part in parts[::2]):
+        fields = ', '.join(f'{{{{ {field} }}}}' for field in PERSONALIZATION_FIELDS)
+        raise TemplateSyntaxError(f'поддерживаются только подстановки {fields}')
+    return Substitution(parts)
+
+
+def compile_or_plain(message, text):
+    '''
+    Шаблон для отправки: сообщение с ошибкой в шаблоне (сохранённое до проверки в форме)
+    уходит как есть, без подстановок, а не останавливает всю рассылку
+    '''
+    try:
+        return compile_text(text)
+    except TemplateSyntaxError as e:
+        logger.warning('Ошибка в шаблоне сообщения %s, отправляется без подстановок: %s', message.pk, e)
+        return PlainText(text)
+
+
+def get_templates(message):
+    '''
+    Шаблоны темы и текста сообщения, скомпилированные один раз на процесс.
+    Хэш текста в ключе не даёт взять устаревший шаблон, даже если сигнал
+    об изменении сообщения пришёл в другой процесс
+    '''
+    templates = message.__dict__.get('_templates')
+    if templates is not None:  # это сообщение уже рендерилось в текущем прогоне
+        return templates
+    digest = hashlib.sha1(f'{message.theme}\0{message.letter}'.encode()).hexdigest()
+    key = (message.pk, digest)
+    templates = _cache.get(key)
+    if templates is None:
+        templates = compile_or_plain(message, message.theme), compile_or_plain(message, message.letter)
+        invalidate(message.pk)
+        _cache[key] = templates
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(key)
+    message._templates = templates
+    return templates
+
+
+def invalidate(message_pk, message=None):
+    if message is not None:
+        message.__dict__.pop('_templates', None)
+    for key in [key for key in _cache if key[0] == message_pk]:
+        del _cache[key]
+
+
+def render_message(message, client):
+    '''
+    Возвращает тему и текст письма с подставленными данными клиента
+    '''
+    subject, body = get_templates(message)
+    context = {field: getattr(client, field) for field in PERSONALIZATION_FIELDS}
+    return subject.render(context), body.render(context)
@@ -0,0 +1,103 @@
+import calendar
+import datetime
+import logging
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from clients.models import Newsletter
+
+logger = logging.getLogger(__name__)
+
+# Расписание рассылок без PeriodicTask на каждую: у рассылки есть next_run_at (индекс),
+# раз в минуту одна задача beat выбирает наступившие запуски одним запросом по индексу,
+# забирает их под блокировкой (select_for_update с skip_locked - параллельный тик пропустит
+# уже занятые строки), переносит next_run_at на следующий запуск и после коммита ставит задачи.
+# Рассылка без next_run_at не отправляется по расписанию (отключена).
+
+
+def _at(day, time):
+    return timezone.make_aware(datetime.datetime.combine(day, time))
+
+
+def next_run(newsletter, after=None):
+    '''
+    Ближайший запуск рассылки строго позже after (по умолчанию - сейчас).
+    День недели или месяца берётся из текущего next_run_at, у новой рассылки - из сегодняшнего дня.
+    Ежемесячная рассылка на 29-31 число пропускает месяцы без этого дня, как crontab
+    '''
+    after = after or timezone.now()
+    today = timezone.localdate(after)
+    anchor = timezone.localdate(newsletter.next_run_at) if newsletter.next_run_at else today
+    if newsletter.period == Newsletter.PERIOD_DAILY:
+        day = today
+        step = datetime.timedelta(days=1)
+    elif newsletter.period == Newsletter.PERIOD_WEEKLY:
+        day = today + datetime.timedelta(days=(anchor.weekday() - today.weekday()) % 7)
+        step = datetime.timedelta(days=7)
+    else:
+        year, month = today.year, today.month
+        while True:
+            if anchor.day <= calendar.monthrange(year, month)[1]:
+                run_at = _at(datetime.date(year, month, anchor.day), newsletter.time)
+                if run_at > after:
+                    return run_at
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    run_at = _at(day, newsletter.time)
+    return run_at if run_at > after else _at(day + step, newsletter.time)
+
+
+def schedule(newsletter):
+    '''
+    Включает рассылку по расписанию (не сохраняет)
+    '''
+    newsletter.next_run_at = next_run(newsletter)
+
+
+def scheduled_run(newsletter_id, due_at):
+    '''
+    Id прогона запуска по расписанию - он же id задачи: повторная постановка того же запуска
+    (после сбоя брокера или отката) не отправит уже доставленные письма второй раз
+    '''
+    return f'newsletter-{newsletter_id}-{int(due_at.timestamp())}'
+
+
+def _enqueue(dispatch, newsletter_id, due_at, next_run_at):
+    try:
+        dispatch(newsletter_id, scheduled_run(newsletter_id, due_at))
+    except Exception as e:
+        # брокер недоступен: возвращаем запуск, его поставит следующий тик
+        logger.warning('Рассылка %s не поставлена в очередь: %s', newsletter_id, e)
+        Newsletter.objects.filter(pk=newsletter_id, next_run_at=next_run_at).update(next_run_at=due_at)
+
+
+def dispatch_due(dispatch, now=None, batch_size=None):
+    '''
+    Отправляет все наступившие к now рассылки: пачками по batch_size забирает их,
+    переносит next_run_at и после коммита вызывает dispatch(id рассылки, id прогона).
+    Если поставить задачу не удалось, запуск возвращается и останется наступившим до следующего тика.
+    Пропущенные запуски (если beat стоял) не догоняются: рассылка уйдёт один раз.
+    Возвращает количество отправленных рассылок
+    '''
+    now = now or timezone.now()
+    batch_size = batch_size or settings.NEWSLETTER_SCHEDULER_BATCH_SIZE
+    dispatched = 0
+    while True:
+        with transaction.atomic():
+            due = list(
+                Newsletter.objects.select_for_update(skip_locked=True).filter(
+                    next_run_at__lte=now,
+                ).order_by('next_run_at').only('id', 'time', 'period', 'next_run_at')[:batch_size]
+            )
+            for newsletter in due:
+                due_at = newsletter.next_run_at
+                newsletter.next_run_at = next_run(newsletter, after=now)
+                # задача ставится только после коммита: иначе воркер может взять её раньше,
+                # чем перенос next_run_at станет виден, а при откате запуск ушёл бы дважды
+                transaction.on_commit(partial(_enqueue, dispatch, newsletter.pk, due_at, newsletter.next_run_at))
+            Newsletter.objects.bulk_update(due, ['next_run_at'])
+        dispatched += len(due)
+        if len(due) < batch_size:
+            return dispatched
@@ -0,0 +1,155 @@
+import re
+
+from django.db import connections, router
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from clients.models import Client
+
+# Поиск клиентов по почте и ФИО.
+# SQLite: теневая таблица FTS5 (rowid = id клиента), её синхронизируют сигналы и bulk-операции
+# через index_clients/unindex_clients. Каждое слово запроса ищется как префикс, порядок - bm25.
+# Владелец клиента тоже лежит в индексе (слово u<id пользователя>), чтобы поиск по своим
+# клиентам не перебирал совпадения чужих.
+# PostgreSQL: триграммный GIN-индекс по UPPER(поле), его использует icontains,
+# порядок - по триграммному сходству.
+FTS_TABLE = 'clients_client_fts'
+TRGM_INDEX = 'clients_client_search_trgm'
+INDEX_BATCH_SIZE = 5000
+# Сколько совпадений ранжируется и показывается в поиске: слишком общий запрос
+# не должен заставлять сортировать по bm25 всю базу. Фильтр (админка, массовые операции) не ограничен
+RANK_LIMIT = 1000
+
+WORD_RE = re.compile(r'[^\W_]+')  # как токенизатор unicode61: подчёркивание - разделитель
+INDEX_FIELDS = ('pk', 'email', 'full_name', 'user_id')
+
+
+def _connection():
+    return connections[router.db_for_write(Client)]
+
+
+def uses_fts():
+    return _connection().vendor == 'sqlite'
+
+
+def setup(using=None, **kwargs):
+    '''
+    Создаёт поисковый индекс, если его ещё нет (вызывается после migrate)
+    '''
+    connection = connections[using] if using else _connection()
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            # выражения совпадают с тем, что Django строит для icontains
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {TRGM_INDEX} ON clients_client USING gin '
+                f'((UPPER(email::text)) gin_trgm_ops, (UPPER(full_name::text)) gin_trgm_ops)'
+            )
+        return
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        if cursor.fetchone():
+            return
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            f"email, full_name, owner, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+    rebuild()
+
+
+def rebuild():
+    '''
+    Заполняет таблицу FTS5 заново по всем клиентам, возвращает их количество
+    '''
+    if not uses_fts():
+        return Client.objects.count()
+    with _connection().cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+    count = 0
+    last_pk = 0
+    while True:
+        rows = list(Client.objects.filter(pk__gt=last_pk).order_by('pk').values_list(*INDEX_FIELDS)[:INDEX_BATCH_SIZE])
+        _insert(rows)
+        count += len(rows)
+        if len(rows) < INDEX_BATCH_SIZE:
+            return count
+        last_pk = rows[-1][0]
+
+
+def _insert(rows):
+    if rows:
+        with _connection().cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {FTS_TABLE} (rowid, email, full_name, owner) VALUES (%s, %s, %s, %s)',
+                [(pk, email, full_name, f'u{user_id}') for pk, email, full_name, user_id in rows],
+            )
+
+
+def unindex_clients(client_ids):
+    client_ids = list(client_ids)
+    if not uses_fts() or not client_ids:
+        return
+    with _connection().cursor() as cursor:
+        for start in range(0, len(client_ids), INDEX_BATCH_SIZE):
+            ids = client_ids[start:start + INDEX_BATCH_SIZE]
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid IN ({", ".join(["%s"] * len(ids))})', ids)
+
+
+def index_clients(client_ids):
+    '''
+    Обновляет записи клиентов в таблице FTS5 (для bulk-операций, которые обходят сигналы)
+    '''
+    client_ids = list(client_ids)
+    if not uses_fts() or not client_ids:
+        return
+    unindex_clients(client_ids)
+    for start in range(0, len(client_ids), INDEX_BATCH_SIZE):
+        ids = client_ids[start:start + INDEX_BATCH_SIZE]
+        _insert(list(Client.objects.filter(pk__in=ids).values_list(*INDEX_FIELDS)))
+
+
+def fts_query(query, user=None):
+    # каждое слово - префикс в почте или ФИО, слова через пробел должны встретиться все
+    words = ' '.join(f'"{word}"*' for word in WORD_RE.findall(query))
+    match = f'{{email full_name}} : ({words})'
+    if user is not None:
+        match = f'owner : "u{user.pk}" AND {match}'
+    return match
+
+
+def search_clients(clients, query, user=None, ranked=True):
+    '''
+    Оставляет клиентов, подходящих под запрос.
+    ranked - самые похожие первыми, не больше RANK_LIMIT; иначе все совпадения без сортировки.
+    user - владелец клиентов: с ним поиск по индексу сразу ограничен его клиентами
+    '''
+    query = query.strip()
+    if not WORD_RE.search(query):
+        return clients
+    connection = _connection()
+    if connection.vendor == 'sqlite':
+        if not ranked:
+            return clients.filter(pk__in=RawSQL(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [fts_query(query, user)],
+            ))
+        with connection.cursor() as cursor:
+            # ORDER BY rank с LIMIT FTS5 выполняет сам, не сортируя все совпадения
+            cursor.execute(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rank, rowid LIMIT %s',
+                           [fts_query(query, user), RANK_LIMIT])
+            ids = [str(pk) for pk, in cursor.fetchall()]
+        # порядок ранжирования - позиция id в строке ',id1,id2,...,': одна функция на строку вместо CASE
+        position = RawSQL("instr(%s, ',' || clients_client.id || ',')", [f',{",".join(ids)},'])
+        return clients.filter(pk__in=ids).order_by(position.asc(), 'pk')
+    matches = clients.filter(Q(email__icontains=query) | Q(full_name__icontains=query))
+    if not ranked:
+        return matches
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import TrigramSimilarity
+        from django.db.models.functions import Greatest
+
+        return matches.annotate(
+            rank=Greatest(TrigramSimilarity('email', query), TrigramSimilarity('full_name', query)),
+        ).order_by('-rank', 'pk')
+    return matches.order_by('pk')
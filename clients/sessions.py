@@ -0,0 +1,40 @@
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+
+from clients import caching
+
+
+class SessionStore(CachedDBStore):
+    '''
+    Сессии cached_db: читаются из кеша, база - основное хранилище.
+    Кеш используется через clients.caching: при недоступном Redis сессии читаются и пишутся
+    только в базу, а не удавшееся удаление из кеша (выход, смена ключа) повторяется перед
+    следующим чтением, поэтому удалённая сессия не вернётся из кеша
+    '''
+
+    def load(self):
+        data = caching.fetch(self.cache_key)
+        if data is None:
+            session = self._get_session_from_db()
+            if not session:
+                return {}
+            data = self.decode(session.session_data)
+            caching.store(self.cache_key, data, self.get_expiry_age(expiry=session.expire_date))
+        return data
+
+    def exists(self, session_key):
+        return bool(session_key) and (
+            caching.fetch(self.cache_key_prefix + session_key) is not None or DBStore.exists(self, session_key)
+        )
+
+    def save(self, must_create=False):
+        DBStore.save(self, must_create)
+        caching.store(self.cache_key, self._session, self.get_expiry_age())
+
+    def delete(self, session_key=None):
+        DBStore.delete(self, session_key)
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        caching.discard(self.cache_key_prefix + session_key)
@@ -0,0 +1,143 @@
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.contrib.auth.models import Group, Permission
+from django.db.models import Q
+from django.dispatch import receiver
+
+from clients import caching, rendering, search, thumbnails
+from clients.models import Client, Message, Newsletter, User
+
+_state = threading.local()
+
+
+@contextmanager
+def bulk_changes():
+    '''
+    Отключает пообъектные обработчики клиентов на время массовой операции:
+    индекс поиска и кеш она обновляет сама, одним запросом на всю выборку
+    '''
+    _state.muted = True
+    try:
+        yield
+    finally:
+        _state.muted = False
+
+
+def muted():
+    return getattr(_state, 'muted', False)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def invalidate_message_templates(sender, instance, **kwargs):
+    rendering.invalidate(instance.pk, instance)
+    caching.invalidate_newsletters([instance.newsletter_id], kinds=('messages',))
+
+
+@receiver(post_save, sender=Client)
+@receiver(pre_delete, sender=Client)  # после удаления связи клиента с рассылками уже не найти
+def invalidate_client_newsletters(sender, instance, **kwargs):
+    if muted():
+        return
+    newsletter_ids = instance.newsletter_set.values_list('pk', flat=True)
+    caching.invalidate_newsletters(newsletter_ids, kinds=('recipients',))
+
+
+@receiver(m2m_changed, sender=Newsletter.client.through)
+def invalidate_recipients(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        newsletter_ids = [instance.pk]
+    elif action == 'pre_clear':
+        newsletter_ids = instance.newsletter_set.values_list('pk', flat=True)
+    else:
+        newsletter_ids = pk_set
+    caching.invalidate_newsletters(newsletter_ids, kinds=('recipients',))
+
+
+def invalidate_permissions(user_ids):
+    caching.invalidate(*(f'perms:{pk}' for pk in user_ids))
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_permissions(sender, instance, **kwargs):
+    # is_superuser и is_active тоже влияют на набор прав
+    invalidate_permissions([instance.pk])
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_user_permission_links(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        invalidate_permissions([instance.pk])
+    elif action == 'pre_clear':  # у права или группы убирают всех пользователей
+        invalidate_permissions(instance.user_set.values_list('pk', flat=True))
+    else:
+        invalidate_permissions(pk_set)
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_group_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        group_ids = [instance.pk]
+    elif action == 'pre_clear':  # у права убирают все группы
+        group_ids = instance.group_set.values_list('pk', flat=True)
+    else:
+        group_ids = pk_set
+    invalidate_permissions(User.objects.filter(groups__in=group_ids).values_list('pk', flat=True).distinct())
+
+
+@receiver(pre_delete, sender=Group)  # после удаления участников группы уже не найти
+def invalidate_deleted_group(sender, instance, **kwargs):
+    invalidate_permissions(list(instance.user_set.values_list('pk', flat=True)))
+
+
+@receiver(pre_delete, sender=Permission)
+def invalidate_deleted_permission(sender, instance, **kwargs):
+    users = User.objects.filter(Q(user_permissions=instance) | Q(groups__permissions=instance))
+    invalidate_permissions(list(users.values_list('pk', flat=True).distinct()))
+
+
+@receiver(post_delete, sender=Newsletter)
+def invalidate_newsletter(sender, instance, **kwargs):
+    caching.invalidate_newsletters([instance.pk])
+
+
+@receiver(post_save, sender=Client)
+def index_client(sender, instance, **kwargs):
+    if muted():
+        return
+    search.index_clients([instance.pk])
+
+
+@receiver(post_delete, sender=Client)
+def unindex_client(sender, instance, **kwargs):
+    if muted():
+        return
+    search.unindex_clients([instance.pk])
+
+
+@receiver(post_delete, sender=Client)
+def delete_avatar_thumbnails(sender, instance, **kwargs):
+    if muted() or not instance.thumbnails_for:
+        return
+    name = instance.thumbnails_for
+    transaction.on_commit(lambda: thumbnails.delete_thumbnails(name))
+
+
+@receiver(post_save, sender=Client)
+def schedule_avatar_thumbnails(sender, instance, **kwargs):
+    if muted() or not instance.avatar or instance.thumbnails_for == instance.avatar.name:
+        return
+    from clients.tasks import make_avatar_thumbnails
+
+    pk = instance.pk
+    transaction.on_commit(lambda: make_avatar_thumbnails.delay(pk))
@@ -0,0 +1,82 @@
+import datetime
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from clients.models import DeliveryStat, Log, Newsletter
+
+
+class StatsCollector:
+    '''
+    Копит счётчики отправки в памяти и добавляет их к дневной статистике в конце прогона:
+    одна запись на сообщение и день, сколько бы писем ни ушло
+    '''
+
+    def __init__(self):
+        self.counts = {}  # (id рассылки, id сообщения, день) -> Counter
+
+    def add(self, message, delivered):
+        key = (message.newsletter_id, message.pk, timezone.localdate())
+        self.counts.setdefault(key, Counter()).update(
+            attempted=1, delivered=int(delivered), failed=int(not delivered),
+        )
+
+    def flush(self):
+        counts, self.counts = self.counts, {}
+        for (newsletter_id, message_id, day), counter in counts.items():
+            increment = {field: F(field) + counter[field] for field in ('attempted', 'delivered', 'failed')}
+            rows = DeliveryStat.objects.filter(message_id=message_id, day=day)
+            if rows.update(**increment):
+                continue
+            try:
+                with transaction.atomic():
+                    DeliveryStat.objects.create(
+                        newsletter_id=newsletter_id, message_id=message_id, day=day, **counter,
+                    )
+            except IntegrityError:  # запись за этот день успел создать другой воркер
+                rows.update(**increment)
+
+
+def rebuild_stats(since=None):
+    '''
+    Пересчитывает дневную статистику по логам (начиная с дня since или целиком),
+    возвращает количество записей статистики.
+    Дни раньше первого лога в базе уже перенесены в архив, их статистика не трогается
+    '''
+    first_log = Log.objects.order_by('date_attempt').values_list('date_attempt', flat=True).first()
+    if first_log is None:
+        return 0
+    first_day = timezone.localdate(first_log)
+    since = max(since, first_day) if since else first_day
+    logs = Log.objects.all()
+    stats = DeliveryStat.objects.all()
+    if since:
+        logs = logs.filter(date_attempt__gte=timezone.make_aware(datetime.datetime.combine(since, datetime.time.min)))
+        stats = stats.filter(day__gte=since)
+    rows = logs.annotate(day=TruncDate('date_attempt')).values(
+        'message_id', 'message__newsletter_id', 'day',
+    ).annotate(
+        attempted=Count('pk', filter=Q(state=Newsletter.STATUS_STARTED)),
+        delivered=Count('pk', filter=Q(state=Newsletter.STATUS_DONE)),
+        failed=Count('pk', filter=Q(state=Log.STATE_ERROR)),
+    ).order_by()
+    with transaction.atomic():
+        stats.delete()
+        created = DeliveryStat.objects.bulk_create(
+            (
+                DeliveryStat(
+                    newsletter_id=row['message__newsletter_id'],
+                    message_id=row['message_id'],
+                    day=row['day'],
+                    attempted=row['attempted'],
+                    delivered=row['delivered'],
+                    failed=row['failed'],
+                )
+                for row in rows.iterator()
+            ),
+            batch_size=1000,
+        )
+    return len(created)
@@ -1,8 +1,224 @@
+import logging
+
+from celery import chain, chord
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
 from cw_dj.celery import app
-from clients.mail_sender import mail_send
+from clients import outbox
+from clients.client_io import import_clients
+from clients.engine import get_engine
+from clients.ledger import DeliveryLedger
+from clients.log_archive import archive_logs as archive_old_logs
+from clients.log_writer import get_log_writer
+from clients.mail_sender import mail_send, send_to_clients, new_run
+from clients.models import Newsletter, Client, User, OutboxEmail
+from clients.rate_limit import RateLimitExceeded
+from clients.scheduling import dispatch_due
+from clients.thumbnails import make_thumbnails, delete_thumbnails
+
+logger = logging.getLogger(__name__)
 
 
 @app.task
-def mailing(period):
-    mail_send(period=period)
+def dispatch_due_newsletters():
+    '''
+    Тик расписания (раз в минуту): ставит в очередь рассылки, чей next_run_at наступил
+    '''
+    return dispatch_due(lambda newsletter_id, run: mailing.apply_async((newsletter_id,), task_id=run))
+
+
+# задачи отправки подтверждаются брокеру только после выполнения (acks_late), а если воркер убит
+# посреди работы (SIGKILL, OOM), сообщение возвращается в очередь (reject_on_worker_lost):
+# повторно доставленная задача продолжает тот же прогон, и журнал доставок пропускает отправленное
+SENDING_TASK_OPTIONS = {'acks_late': True, 'reject_on_worker_lost': True}
+
+
+@app.task(bind=True, **SENDING_TASK_OPTIONS)
+def mailing(self, newsletter_id, run=None):
+    '''
+    Отправляет одну рассылку (по расписанию её ставит dispatch_due_newsletters).
+    run - id прогона, если вызывающему коду нужно следить за ходом отправки; по умолчанию -
+    id этой задачи, чтобы повторная доставка задачи не отправила письма второй раз
+    '''
+    if newsletter_id in dict(Newsletter.PERIODS):
+        # задачи, созданные до перехода на id рассылки, передают периодичность:
+        # шлём по-старому, пока их не перепишет команда migrate_mailing_tasks
+        logger.warning('mailing вызвана с периодичностью %r, запустите migrate_mailing_tasks', newsletter_id)
+        mail_send(period=newsletter_id)
+        return "Done"
+    run = run or self.request.id
+    if settings.MAILING_FANOUT:
+        return mailing_newsletter(newsletter_id, run=run)
+    newsletter = Newsletter.objects.filter(pk=newsletter_id).first()
+    if newsletter is None:
+        return "Missing"
+    mail_send(newsletters=[newsletter], run=run)
     return "Done"
+
+
+def split_chunks(client_ids, chunk_size, concurrency):
+    '''
+    Режет получателей на пачки по chunk_size и раскладывает их по concurrency цепочкам:
+    пачки одной цепочки идут друг за другом, цепочки - параллельно
+    '''
+    chunks = [client_ids[i:i + chunk_size] for i in range(0, len(client_ids), chunk_size)]
+    return [chunks[i::concurrency] for i in range(min(concurrency, len(chunks)))]
+
+
+@app.task(bind=True, **SENDING_TASK_OPTIONS)
+def mailing_newsletter(self, newsletter_id, chunk_size=None, concurrency=None, run=None):
+    '''
+    Раскладывает получателей рассылки на пачки и отправляет их на нескольких воркерах,
+    по завершении всех пачек mailing_finish выставляет рассылке статус "Завершена".
+    Id задачи служит прогоном журнала доставок: повторная доставка той же задачи
+    не отправит письма второй раз.
+    '''
+    run = run or self.request.id or new_run()
+    chunk_size = chunk_size or settings.MAILING_CHUNK_SIZE
+    concurrency = concurrency or settings.MAILING_CONCURRENCY
+    newsletter = Newsletter.objects.filter(pk=newsletter_id).first()
+    if newsletter is None:
+        return "Missing"
+    client_ids = list(newsletter.client.filter(is_blocked=False).order_by('pk').values_list('pk', flat=True))
+    newsletter.status = Newsletter.STATUS_STARTED
+    newsletter.save(update_fields=['status'])
+    lanes = split_chunks(client_ids, chunk_size, concurrency)
+    if not lanes:
+        return mailing_finish([], newsletter_id)
+    header = []
+    for lane in lanes:
+        # первая пачка цепочки начинает счёт с нуля, следующие получают итог предыдущей
+        first, *rest = lane
+        header.append(chain(
+            mailing_chunk.s({'sent': 0, 'failed': 0}, newsletter_id, first, run),
+            *(mailing_chunk.s(newsletter_id, chunk, run) for chunk in rest),
+        ))
+    # если пачка упала окончательно (или результат пачки потерян), тело хорды не выполнится:
+    # тогда рассылку завершает mailing_failed с итогами из журнала доставок
+    chord(header)(mailing_finish.s(newsletter_id).on_error(mailing_failed.s(newsletter_id, run)))
+    return "Dispatched"
+
+
+@app.task(bind=True, max_retries=None, **SENDING_TASK_OPTIONS)
+def mailing_chunk(self, totals, newsletter_id, client_ids, run):
+    newsletter = Newsletter.objects.get(pk=newsletter_id)
+    messages = list(newsletter.messages.all())
+    clients = Client.objects.filter(pk__in=client_ids, is_blocked=False).order_by('pk')
+    engine = get_engine(max_wait=settings.MAIL_RATE_LIMIT_MAX_WAIT)
+    ledger = DeliveryLedger(run)
+    try:
+        with engine, get_log_writer() as log_writer, ledger:
+            result = send_to_clients(clients, messages, engine, log_writer, ledger)
+    except RateLimitExceeded as e:
+        # лимит отправки исчерпан надолго: не держим воркер, а возвращаем остаток пачки в очередь
+        totals = {key: totals[key] + e.result[key] for key in totals}
+        raise self.retry(args=(totals, newsletter_id, e.remaining_client_ids, run), countdown=e.retry_after)
+    failed, attempts = ledger.failed(clients)
+    if failed and attempts < settings.MAIL_DELIVERY_MAX_ATTEMPTS:
+        # доставленное журнал при повторе пропустит, заново уйдут только письма с ошибкой
+        totals = dict(totals, sent=totals['sent'] + result['sent'])
+        countdown = settings.MAIL_DELIVERY_RETRY_DELAY * 2 ** (attempts - 1)
+        raise self.retry(args=(totals, newsletter_id, client_ids, run), countdown=countdown)
+    return {key: totals[key] + result[key] for key in totals}
+
+
+@app.task
+def mailing_finish(results, newsletter_id):
+    totals = {'sent': sum(r['sent'] for r in results), 'failed': sum(r['failed'] for r in results)}
+    Newsletter.objects.filter(pk=newsletter_id).update(status=Newsletter.STATUS_DONE)
+    return totals
+
+
+@app.task
+def mailing_failed(request, exc, traceback, newsletter_id, run):
+    '''
+    Errback хорды mailing_newsletter: завершает рассылку, если какая-то пачка упала окончательно,
+    и возвращает итоги из журнала доставок - сколько писем успело уйти до сбоя
+    '''
+    progress = DeliveryLedger(run).progress()
+    totals = {'sent': progress['sent'], 'failed': progress['failed']}
+    finished = Newsletter.objects.filter(pk=newsletter_id, status=Newsletter.STATUS_STARTED).update(
+        status=Newsletter.STATUS_DONE,
+    )
+    if finished:
+        logger.error('Рассылка %s (прогон %s) прервана: %s, доставлено %s, с ошибкой %s',
+                     newsletter_id, run, exc, totals['sent'], totals['failed'])
+    return totals
+
+
+@app.task(bind=True)
+def import_clients_file(self, path, fmt, user_id):
+    '''
+    Импортирует клиентов из загруженного файла, после каждой пачки
+    публикует прогресс в состоянии задачи (PROGRESS), файл затем удаляет
+    '''
+    user = User.objects.get(pk=user_id)
+    try:
+        with default_storage.open(path, 'rb') as fileobj:
+            return import_clients(
+                fileobj, fmt, user,
+                progress=lambda result: self.update_state(state='PROGRESS', meta=result),
+            )
+    finally:
+        default_storage.delete(path)
+
+
+@app.task
+def make_avatar_thumbnails(client_id):
+    '''
+    Строит миниатюры текущего аватара клиента и удаляет миниатюры предыдущего
+    '''
+    client = Client.objects.filter(pk=client_id).only('avatar', 'thumbnails_for').first()
+    if client is None or not client.avatar or client.thumbnails_for == client.avatar.name:
+        return "Skipped"
+    name = client.avatar.name
+    make_thumbnails(name)
+    # аватар могли сменить, пока строились миниатюры: тогда отметку поставит следующая задача
+    Client.objects.filter(pk=client_id, avatar=name).update(thumbnails_for=name)
+    if client.thumbnails_for:
+        delete_thumbnails(client.thumbnails_for)
+    return "Done"
+
+
+@app.task
+def archive_logs():
+    '''
+    Ежедневный перенос логов старше LOG_RETENTION_DAYS дней в архив
+    '''
+    archived, days = archive_old_logs()
+    if archived:
+        logger.info('В архив перенесено логов: %s (дни %s - %s)', archived, days[0], days[-1])
+    return archived
+
+
+@app.task(bind=True, max_retries=None)
+def send_outbox_email(self, email_id):
+    '''
+    Отправка служебного письма из outbox (очередь ACCOUNT_EMAIL_QUEUE),
+    повторы с удвоением задержки, пока не исчерпаны ACCOUNT_EMAIL_MAX_ATTEMPTS
+    '''
+    try:
+        return outbox.deliver(email_id)
+    except Exception as e:
+        email = OutboxEmail.objects.get(pk=email_id)
+        if email.status != OutboxEmail.STATUS_PENDING:
+            logger.error('Служебное письмо %s не отправлено после %s попыток: %s', email_id, email.attempts, e)
+            return False
+        countdown = max(settings.ACCOUNT_EMAIL_RETRY_DELAY, (email.next_attempt_at - timezone.now()).total_seconds())
+        raise self.retry(countdown=countdown, queue=settings.ACCOUNT_EMAIL_QUEUE)
+
+
+@app.task
+def drain_outbox():
+    '''
+    Ставит в очередь служебные письма, задача которых потерялась (брокер был недоступен, воркер упал)
+    '''
+    email_ids = list(outbox.stale_emails().values_list('pk', flat=True)[:settings.ACCOUNT_EMAIL_DRAIN_BATCH_SIZE])
+    OutboxEmail.objects.filter(pk__in=email_ids).update(
+        status=OutboxEmail.STATUS_PENDING, next_attempt_at=timezone.now(),
+    )
+    for email_id in email_ids:
+        outbox.dispatch(email_id)
+    return len(email_ids)
@@ -1,5 +1,9 @@
 import datetime
 from django import template
+from django.conf import settings
+from django.utils.html import format_html, format_html_join
+
+from clients.thumbnails import MIME_TYPES, thumbnail_name
 
 register = template.Library()
 
@@ -16,4 +20,27 @@ def my_media(val):
     if val:
         return f'/media/{val}'
     else:
-        return '#'
\ No newline at end of file
+        return '#'
+
+
+@register.simple_tag
+def avatar(client, size='small'):
+    '''
+    Аватар клиента нужного размера: миниатюры в форматах AVATAR_THUMBNAIL_FORMATS,
+    последний формат - запасной для браузеров без остальных; пока миниатюры не построены - оригинал
+    '''
+    if not client.avatar:
+        return ''
+    name = client.avatar.name
+    if client.thumbnails_for != name:
+        return format_html('<img src="{}" alt="" loading="lazy">', my_media(name))
+    width, height = settings.AVATAR_THUMBNAIL_SIZES[size]
+    *sources, fallback = settings.AVATAR_THUMBNAIL_FORMATS
+    return format_html(
+        '<picture>{}<img src="{}" width="{}" height="{}" alt="" loading="lazy"></picture>',
+        format_html_join('', '<source srcset="{}" type="{}">', (
+            (my_media(thumbnail_name(name, size, fmt)), MIME_TYPES[fmt]) for fmt in sources
+        )),
+        my_media(thumbnail_name(name, size, fallback)),
+        width, height,
+    )
@@ -1,3 +1,1034 @@
-from django.test import TestCase
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import redis
+from celery import group
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import QuerySet
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django_celery_beat.models import CrontabSchedule, PeriodicTask
+from PIL import Image
+
+from cw_dj.celery import app
+from clients import bulk, caching, log_archive, metrics, outbox, search, verification
+from clients.forms import MessageForm
+from clients.mail_sender import build_email, mail_send, send_chunk, send_to_clients
+from clients.models import User, Client, Newsletter, Message, Log, Delivery, DeliveryStat, Code, OutboxEmail
+from clients.rendering import render_message
+from clients.rate_limit import RateLimiter, RateLimitExceeded
+from clients.scheduling import next_run
+from clients.sessions import SessionStore
+from clients.tasks import mailing, mailing_chunk, mailing_newsletter, dispatch_due_newsletters, drain_outbox
+from clients.templatetags.mytag import avatar
+from clients.threaded_engine import ThreadedMailEngine
+from clients.thumbnails import thumbnail_name
+from clients.views import LogListView
+
+
+def create_newsletter(user, clients_count, messages_count=1, period=Newsletter.PERIOD_DAILY):
+    newsletter = Newsletter.objects.create(
+        time=datetime.time(10, 0),
+        period=period,
+        status=Newsletter.STATUS_CREATED,
+        user=user,
+    )
+    clients = [
+        Client.objects.create(
+            email=f'client{i}_{newsletter.pk}@example.com',
+            full_name=f'Клиент {i}',
+            comment='',
+            user=user,
+        )
+        for i in range(clients_count)
+    ]
+    newsletter.client.set(clients)
+    for i in range(messages_count):
+        Message.objects.create(theme=f'Тема {i}', letter=f'Письмо {i}', newsletter=newsletter)
+    return newsletter
+
+
+class FlakyEmailBackend(EmailBackend):
+    '''
+    Первая попытка отправки на адреса из failing заканчивается ошибкой
+    '''
+    failing = set()
+
+    def send_messages(self, messages):
+        for message in messages:
+            if message.to[0] in self.failing:
+                self.failing.discard(message.to[0])
+                raise ConnectionError('temporary failure')
+        return super().send_messages(messages)
+
+
+class BarrierEmailBackend(EmailBackend):
+    '''
+    Письмо уходит, только когда barrier.parties сессий отправляют одновременно
+    '''
+    barrier = None
+
+    def send_messages(self, messages):
+        self.barrier.wait()
+        return super().send_messages(messages)
+
+
+class WorkerKilled(BaseException):
+    '''
+    Воркер убит посреди задачи (SIGKILL, OOM): не Exception, задача не успевает ничего обработать
+    '''
+
+
+class KilledEmailBackend(EmailBackend):
+    '''
+    Воркер умирает перед отправкой письма номер kill_at (считая с нуля)
+    '''
+    kill_at = None
+    sent = 0
+
+    def send_messages(self, messages):
+        for message in messages:
+            if KilledEmailBackend.sent == self.kill_at:
+                raise WorkerKilled
+            KilledEmailBackend.sent += 1
+            super().send_messages([message])
+        return len(messages)
+
+
+def chord_on_worker(header):
+    '''
+    chord как на воркере: упавшая часть не выбрасывает ошибку, а вызывает errback тела хорды
+    (в режиме eager Celery errback тела хорды не вызывает)
+    '''
+    def apply(body):
+        body.freeze()
+        try:
+            return body.apply((group(header).apply().get(),))
+        except Exception as e:
+            return app.backend.chord_error_from_stack(body, e)
+    return apply
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', MAIL_RATE_LIMIT_ENABLED=False)
+class CeleryEagerTestCase(TestCase):
+
+    def setUp(self):
+        self._always_eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        self.user = User.objects.create(email='owner@example.com', username='owner')
+
+    def tearDown(self):
+        app.conf.task_always_eager = self._always_eager
+
+
+class MailingFanoutTestCase(CeleryEagerTestCase):
+
+    def test_every_recipient_is_sent_exactly_once(self):
+        newsletter = create_newsletter(self.user, clients_count=23, messages_count=2)
+        blocked = newsletter.client.first()
+        blocked.is_blocked = True
+        blocked.save()
+
+        result = mailing_newsletter.delay(newsletter.pk, chunk_size=4, concurrency=3)
+
+        sent_to = Counter((email.subject, email.to[0]) for email in mail.outbox)
+        expected = {
+            (message.theme, client.email)
+            for message in newsletter.messages.all()
+            for client in newsletter.client.filter(is_blocked=False)
+        }
+        self.assertEqual(set(sent_to), expected)
+        self.assertEqual(set(sent_to.values()), {1})
+        self.assertEqual(result.get(), 'Dispatched')
+        newsletter.refresh_from_db()
+        self.assertEqual(newsletter.status, Newsletter.STATUS_DONE)
+        self.assertEqual(Log.objects.filter(state=Newsletter.STATUS_DONE).count(), 44)
+
+    def test_failed_chunk_finishes_newsletter_with_partial_totals(self):
+        newsletter = create_newsletter(self.user, clients_count=6)
+        broken_id = sorted(newsletter.client.values_list('pk', flat=True))[2]
+
+        def send_or_fail(clients, *args):
+            if clients.filter(pk=broken_id).exists():
+                raise RuntimeError('база недоступна')
+            return send_to_clients(clients, *args)
+
+        # пачки по 2 клиента в 2 цепочки: [0, 1], [4, 5] и [2, 3] - вторая цепочка падает
+        with mock.patch('clients.tasks.chord', chord_on_worker), \
+                mock.patch('clients.tasks.send_to_clients', side_effect=send_or_fail), \
+                self.assertLogs('clients.tasks', 'ERROR') as logs:
+            mailing_newsletter.apply((newsletter.pk,), {'chunk_size': 2, 'concurrency': 2}, task_id='broken')
+
+        self.assertEqual(len(mail.outbox), 4)
+        newsletter.refresh_from_db()
+        self.assertEqual(newsletter.status, Newsletter.STATUS_DONE)
+        self.assertIn('доставлено 4, с ошибкой 0', logs.output[0])
+
+
+class MailingTaskTestCase(CeleryEagerTestCase):
+
+    def test_trigger_sends_only_its_newsletter(self):
+        newsletters = [create_newsletter(self.user, clients_count=3) for _ in range(3)]
+
+        for newsletter in newsletters:
+            sent_before = len(mail.outbox)
+            mailing.delay(newsletter.pk)
+            sent = mail.outbox[sent_before:]
+            self.assertEqual(len(sent), 3)
+            self.assertEqual(
+                {email.to[0] for email in sent},
+                set(newsletter.client.values_list('email', flat=True)),
+            )
+        self.assertEqual(len(mail.outbox), 9)
+
+    def test_redelivered_task_does_not_resend(self):
+        newsletter = create_newsletter(self.user, clients_count=3)
+        for fanout in (True, False):
+            with override_settings(MAILING_FANOUT=fanout):
+                mail.outbox = []
+                mailing.apply((newsletter.pk,), task_id=f'redelivered-{fanout}')
+                mailing.apply((newsletter.pk,), task_id=f'redelivered-{fanout}')
+                self.assertEqual(len(mail.outbox), 3)
+
+    @override_settings(EMAIL_BACKEND='clients.tests.KilledEmailBackend', MAIL_SENDER_BATCH_SIZE=1)
+    def test_chunk_killed_midway_is_redelivered_and_resumed(self):
+        for task in (mailing, mailing_newsletter, mailing_chunk):
+            self.assertTrue(task.acks_late and task.reject_on_worker_lost)
+        newsletter = create_newsletter(self.user, clients_count=6)
+        client_ids = sorted(newsletter.client.values_list('pk', flat=True))
+        args = ({'sent': 0, 'failed': 0}, newsletter.pk, client_ids, 'killed')
+        KilledEmailBackend.sent, KilledEmailBackend.kill_at = 0, 2
+
+        with self.assertRaises(WorkerKilled):
+            mailing_chunk.apply(args, task_id='killed-chunk')
+        self.assertEqual(len(mail.outbox), 2)
+
+        # брокер возвращает неподтверждённое сообщение: та же задача с теми же аргументами
+        KilledEmailBackend.kill_at = None
+        result = mailing_chunk.apply(args, task_id='killed-chunk').get()
+
+        self.assertEqual(result, {'sent': 4, 'failed': 0})
+        self.assertEqual(
+            Counter(email.to[0] for email in mail.outbox),
+            Counter(newsletter.client.values_list('email', flat=True)),
+        )
+
+    def test_migrate_mailing_tasks(self):
+        newsletter = create_newsletter(self.user, clients_count=1)
+        crontab = CrontabSchedule.objects.create(minute='0', hour='10')
+        PeriodicTask.objects.create(
+            name=str(newsletter.pk), task='clients.tasks.mailing', crontab=crontab,
+            args=json.dumps([newsletter.period]),
+        )
+        PeriodicTask.objects.create(
+            name='999999', task='clients.tasks.mailing', crontab=crontab,
+            args=json.dumps([Newsletter.PERIOD_DAILY]),
+        )
+
+        call_command('migrate_mailing_tasks', stdout=StringIO())
+
+        newsletter.refresh_from_db()
+        self.assertIsNotNone(newsletter.next_run_at)
+        self.assertFalse(PeriodicTask.objects.filter(task='clients.tasks.mailing').exists())
+        self.assertFalse(CrontabSchedule.objects.filter(pk=crontab.pk).exists())
+
+
+class SchedulerTestCase(CeleryEagerTestCase):
+
+    def test_next_run(self):
+        def at(*args):
+            return timezone.make_aware(datetime.datetime(*args))
+
+        newsletter = Newsletter(time=datetime.time(10, 0), period=Newsletter.PERIOD_MONTHLY)
+        newsletter.next_run_at = at(2024, 1, 31, 10, 0)
+        self.assertEqual(next_run(newsletter, after=at(2024, 1, 31, 10, 0)), at(2024, 3, 31, 10, 0))
+        newsletter.period = Newsletter.PERIOD_WEEKLY
+        self.assertEqual(next_run(newsletter, after=at(2024, 2, 1, 9, 0)), at(2024, 2, 7, 10, 0))
+        newsletter.period = Newsletter.PERIOD_DAILY
+        self.assertEqual(next_run(newsletter, after=at(2024, 2, 1, 9, 0)), at(2024, 2, 1, 10, 0))
+
+    def test_tick_sends_due_newsletters_once(self):
+        due, later, disabled = (create_newsletter(self.user, clients_count=2) for _ in range(3))
+        now = timezone.now()
+        Newsletter.objects.filter(pk=due.pk).update(next_run_at=now - datetime.timedelta(days=3))
+        Newsletter.objects.filter(pk=later.pk).update(next_run_at=now + datetime.timedelta(hours=1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(dispatch_due_newsletters.delay().get(), 1)
+        self.assertEqual({email.to[0] for email in mail.outbox}, set(due.client.values_list('email', flat=True)))
+        due.refresh_from_db()
+        self.assertTrue(now < due.next_run_at <= now + datetime.timedelta(days=1))
+        self.assertEqual(dispatch_due_newsletters.delay().get(), 0)
+
+    def test_send_does_not_restore_schedule_changed_meanwhile(self):
+        newsletter = create_newsletter(self.user, clients_count=2)
+
+        def disable_and_send(clients, *args):
+            # рассылку выключают, пока идёт отправка
+            Newsletter.objects.filter(pk=newsletter.pk).update(next_run_at=None)
+            return send_to_clients(clients, *args)
+
+        for fanout, target in ((False, 'clients.mail_sender.send_to_clients'),
+                               (True, 'clients.tasks.send_to_clients')):
+            Newsletter.objects.filter(pk=newsletter.pk).update(next_run_at=timezone.now())
+            with override_settings(MAILING_FANOUT=fanout), mock.patch(target, side_effect=disable_and_send):
+                mailing.delay(newsletter.pk)
+            newsletter.refresh_from_db()
+            self.assertEqual(newsletter.status, Newsletter.STATUS_DONE)
+            self.assertIsNone(newsletter.next_run_at)
+
+    def test_failed_enqueue_returns_the_run(self):
+        newsletter = create_newsletter(self.user, clients_count=2)
+        due_at = timezone.now() - datetime.timedelta(minutes=1)
+        Newsletter.objects.filter(pk=newsletter.pk).update(next_run_at=due_at)
+        with mock.patch.object(mailing, 'apply_async', side_effect=OSError), \
+                self.captureOnCommitCallbacks(execute=True):
+            dispatch_due_newsletters.delay()
+        newsletter.refresh_from_db()
+        self.assertEqual(newsletter.next_run_at, due_at)
+
+        # тот же запуск - тот же прогон: повторная постановка не шлёт письма второй раз
+        for _ in range(2):
+            Newsletter.objects.filter(pk=newsletter.pk).update(next_run_at=due_at)
+            with self.captureOnCommitCallbacks(execute=True):
+                dispatch_due_newsletters.delay()
+        self.assertEqual(len(mail.outbox), 2)
+
+
+class DeliveryLedgerTestCase(CeleryEagerTestCase):
+
+    def test_resumed_run_skips_delivered_recipients(self):
+        newsletter = create_newsletter(self.user, clients_count=5, messages_count=2)
+        run = mail_send(newsletters=[newsletter])
+
+        mail.outbox = []
+        mail_send(newsletters=[newsletter], run=run)
+
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(Delivery.objects.filter(run=run, status=Delivery.STATUS_SENT).count(), 10)
+
+    @override_settings(EMAIL_BACKEND='clients.tests.FlakyEmailBackend', MAIL_DELIVERY_RETRY_DELAY=0)
+    def test_retry_resends_only_failures(self):
+        newsletter = create_newsletter(self.user, clients_count=6)
+        flaky = set(newsletter.client.values_list('email', flat=True)[:2])
+        FlakyEmailBackend.failing = set(flaky)
+
+        mailing_newsletter.delay(newsletter.pk, chunk_size=3, concurrency=2)
+
+        self.assertEqual(
+            Counter(email.to[0] for email in mail.outbox),
+            Counter(newsletter.client.values_list('email', flat=True)),
+        )
+        deliveries = Delivery.objects.all()
+        self.assertEqual({delivery.status for delivery in deliveries}, {Delivery.STATUS_SENT})
+        self.assertEqual(
+            {delivery.client.email for delivery in deliveries if delivery.attempts == 2},
+            flaky,
+        )
+
+
+class RateLimitTestCase(CeleryEagerTestCase):
+
+    def test_token_bucket_in_redis_and_locally(self):
+        # второй клиент недоступен: ограничитель переходит на ведро в памяти процесса
+        for client in (fakeredis.FakeRedis(), redis.Redis(port=1, socket_connect_timeout=1)):
+            limiter = RateLimiter(global_rate=10, sender_rate=5, burst=1, client=client)
+            self.assertEqual(limiter.take('a@example.com', 5), 0)
+            self.assertAlmostEqual(limiter.take('a@example.com', 1), 0.2, delta=0.05)
+            self.assertEqual(limiter.take('b@example.com', 3), 0)  # в общем ведре осталось 10 - 6 - 3
+            with self.assertRaises(RateLimitExceeded):
+                limiter.admit('a@example.com', max_wait=0.1)
+            limiter.admit('b@example.com', max_wait=0.1)
+            self.assertEqual(limiter.metrics['requeued'], 1)
+        self.assertEqual(limiter.metrics['redis_errors'], 1)
+
+    def test_metrics_are_counted_from_threads(self):
+        limiter = RateLimiter(global_rate=10 ** 6, sender_rate=10 ** 6, client=fakeredis.FakeRedis())
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(limiter.acquire, ['a@example.com'] * 400))
+        self.assertEqual(limiter.metrics['acquired'], 400)
+
+    def test_limited_chunk_is_requeued_without_building_the_rest(self):
+        newsletter = create_newsletter(self.user, clients_count=6)
+        client_ids = sorted(newsletter.client.values_list('pk', flat=True))
+        limiter = RateLimiter(client=fakeredis.FakeRedis())
+        # вторая пачка упирается в лимит, после повтора лимит свободен
+        admits = [None, RateLimitExceeded(retry_after=0), None, None]
+
+        with override_settings(MAIL_RATE_LIMIT_ENABLED=True, MAIL_SENDER_BATCH_SIZE=2), \
+                mock.patch('clients.rate_limit._rate_limiter', limiter), \
+                mock.patch.object(limiter, 'admit', side_effect=admits), \
+                mock.patch('clients.mail_sender.build_email', wraps=build_email) as built:
+            result = mailing_chunk.apply(({'sent': 0, 'failed': 0}, newsletter.pk, client_ids, 'limited')).get()
+
+        self.assertEqual(result, {'sent': 6, 'failed': 0})
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox),
+                         sorted(newsletter.client.values_list('email', flat=True)))
+        # письма собраны для двух пачек до остановки и для четырёх клиентов повтора
+        self.assertEqual(built.call_count, 8)
+
+
+class ThreadedMailEngineTestCase(CeleryEagerTestCase):
+
+    def test_every_session_gets_its_own_thread(self):
+        # сессий больше, чем потоков в пуле по умолчанию на этой машине: каждой нужен свой поток
+        concurrency = min(32, (os.cpu_count() or 1) + 4) + 2
+        BarrierEmailBackend.barrier = threading.Barrier(concurrency, timeout=5)
+        emails = [EmailMessage('Тема', 'Письмо', to=[f'c{i}@example.com']) for i in range(concurrency)]
+        engine = ThreadedMailEngine(concurrency=concurrency, batch_size=1, backend='clients.tests.BarrierEmailBackend')
+        with engine:
+            self.assertEqual(engine.send(emails), [None] * concurrency)
+        self.assertEqual(len(mail.outbox), concurrency)
+
+
+class RenderingTestCase(TestCase):
+
+    def setUp(self):
+        self.newsletter = create_newsletter(User.objects.create(email='owner@example.com', username='owner'), 1)
+        self.recipient = self.newsletter.client.get()
+
+    def test_templates_follow_message_changes(self):
+        message = Message.objects.create(theme='Привет, {{ full_name }}', letter='Письмо для {{ email }}',
+                                         newsletter=self.newsletter)
+        self.assertEqual(render_message(message, self.recipient), (
+            f'Привет, {self.recipient.full_name}', f'Письмо для {self.recipient.email}',
+        ))
+        message.letter = 'Новое письмо для {{ full_name }}'
+        message.save()
+        self.assertEqual(render_message(message, self.recipient)[1], f'Новое письмо для {self.recipient.full_name}')
+        self.assertEqual(render_message(Message.objects.get(pk=message.pk), self.recipient)[1],
+                         f'Новое письмо для {self.recipient.full_name}')
+
+    def test_broken_template_is_rejected_by_form_and_sent_as_is(self):
+        form = MessageForm(data={'theme': 'Тема', 'letter': 'Скидка {% if %}', 'newsletter': self.newsletter.pk})
+        self.assertIn('letter', form.errors)
+
+        message = Message.objects.create(theme='Тема {{ full_name', letter='Скидка {% if %}',
+                                         newsletter=self.newsletter)
+        with self.assertLogs('clients.rendering', 'WARNING'):
+            self.assertEqual(render_message(message, self.recipient), ('Тема {{ full_name', 'Скидка {% if %}'))
+
+    def test_only_client_fields_are_substituted(self):
+        for letter in ('{% debug %}', '{{ full_name|ljust:"100000000" }}', '{{ settings }}', '{% load static %}'):
+            form = MessageForm(data={'theme': 'Тема', 'letter': letter, 'newsletter': self.newsletter.pk})
+            self.assertIn('letter', form.errors)
+            message = Message.objects.create(theme='Тема', letter=letter, newsletter=self.newsletter)
+            with self.assertLogs('clients.rendering', 'WARNING'):
+                self.assertEqual(render_message(message, self.recipient)[1], letter)
+
+        message = Message.objects.create(theme='{{full_name}}', letter='{{ email }}: {{ email }} {# #} {',
+                                         newsletter=self.newsletter)
+        self.assertEqual(render_message(message, self.recipient), (
+            self.recipient.full_name, f'{self.recipient.email}: {self.recipient.email} {{# #}} {{',
+        ))
+
+
+class DeliveryStatTestCase(CeleryEagerTestCase):
+
+    @override_settings(EMAIL_BACKEND='clients.tests.FlakyEmailBackend', MAIL_DELIVERY_RETRY_DELAY=0)
+    def test_rollups_match_rebuild_from_logs(self):
+        newsletter = create_newsletter(self.user, clients_count=5, messages_count=2)
+        FlakyEmailBackend.failing = set(newsletter.client.values_list('email', flat=True)[:1])
+        mailing_newsletter.delay(newsletter.pk, chunk_size=2, concurrency=2)
+
+        fields = ('message_id', 'day', 'attempted', 'delivered', 'failed')
+        incremental = set(DeliveryStat.objects.values_list(*fields))
+        self.assertEqual(sum(row[2] for row in incremental), 11)
+        self.assertEqual(sum(row[4] for row in incremental), 1)
+
+        call_command('rebuild_stats', stdout=StringIO())
+        self.assertEqual(set(DeliveryStat.objects.values_list(*fields)), incremental)
+
+
+class ListViewQueriesTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@example.com', username='owner')
+        self.client.force_login(self.user)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_depend_on_list_size(self):
+        create_newsletter(self.user, clients_count=2, messages_count=1)
+        few = [self.count_queries(reverse(name)) for name in ('clients:newsletter_view', 'clients:home')]
+        for _ in range(9):
+            create_newsletter(self.user, clients_count=4, messages_count=3)
+        many = [self.count_queries(reverse(name)) for name in ('clients:newsletter_view', 'clients:home')]
+        self.assertEqual(few, many)
+
+
+class LogPagingTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@example.com', username='owner')
+        self.client.force_login(self.user)
+
+    def pages(self, query=''):
+        pages = []
+        while query is not None:
+            response = self.client.get(reverse('clients:log_view') + '?' + query)
+            pages.append([log.pk for log in response.context['object_list']])
+            query = response.context.get('next_query')
+        return pages
+
+    def test_cursor_walks_every_log_once(self):
+        newsletter = create_newsletter(self.user, clients_count=3)
+        message = newsletter.messages.get()
+        now = timezone.now()
+        for minutes_ago in (1, 2, 2, 2, 3, 4, 4):  # одинаковое время: порядок решает id
+            Log.objects.create(date_attempt=now - datetime.timedelta(minutes=minutes_ago),
+                               state=Newsletter.STATUS_DONE, response_server='ok', message=message)
+        expected = list(Log.objects.order_by('-date_attempt', '-pk').values_list('pk', flat=True))
+
+        with mock.patch.object(LogListView, 'paginate_by', 3):
+            pages = self.pages()
+            self.assertEqual([len(page) for page in pages], [3, 3, 1])
+            self.assertEqual([pk for page in pages for pk in page], expected)
+            # испорченный курсор - первая страница, а не ошибка
+            for cursor in ('2024-13-45T10:00:00|5', 'мусор|1', f'{now.isoformat()}|x'):
+                self.assertEqual(self.pages(f'cursor={cursor}')[0], expected[:3])
+
+    def test_row_left_in_database_and_archive_is_shown_once(self):
+        newsletter = create_newsletter(self.user, clients_count=1)
+        log = Log.objects.create(date_attempt=timezone.now() - datetime.timedelta(days=200),
+                                 state=Newsletter.STATUS_DONE, response_server='ok',
+                                 message=newsletter.messages.get(), client=newsletter.client.get())
+        with tempfile.TemporaryDirectory() as archive, override_settings(LOG_ARCHIVE_DIR=archive):
+            # сбой между записью пачки в архив и удалением из базы
+            with mock.patch.object(QuerySet, 'delete', side_effect=OSError):
+                with self.assertRaises(OSError):
+                    log_archive.archive_logs(days=90)
+            self.assertTrue(Log.objects.filter(pk=log.pk).exists())
+            self.assertEqual(self.pages('archive=on'), [[log.pk]])
+
+
+@override_settings(
+    CACHE_ENABLED=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}},
+)
+class NewsletterCacheTestCase(TestCase):
+
+    def setUp(self):
+        caching._down_until = 0
+        caching._pending.clear()
+        caching._pending_keys.clear()
+        self.user = User.objects.create(email='owner@example.com', username='owner')
+        self.client.force_login(self.user)
+
+    def detail(self, newsletter):
+        response = self.client.get(reverse('clients:newsletter_detail', args=[newsletter.pk]))
+        return response.context['message_'], response.context['client_list']
+
+    def test_changes_invalidate_cached_detail(self):
+        newsletter = create_newsletter(self.user, clients_count=2, messages_count=1)
+        self.detail(newsletter)
+        hits = caching.metrics['hits']
+        self.detail(newsletter)
+        self.assertEqual(caching.metrics['hits'], hits + 2)
+
+        message = newsletter.messages.get()
+        message.theme = 'Новая тема'
+        message.save()
+        extra = Client.objects.create(email='extra@example.com', full_name='Ещё', comment='', user=self.user)
+        newsletter.client.add(extra)
+
+        messages, clients = self.detail(newsletter)
+        self.assertEqual([m.theme for m in messages], ['Новая тема'])
+        self.assertIn('extra@example.com', [c.email for c in clients])
+
+    def test_events_are_counted_from_threads(self):
+        before = caching.events()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: caching.get_or_set('threads', i % 10, lambda: i), range(400)))
+        after = caching.events()
+        self.assertEqual(sum(after.get(event, 0) - before.get(event, 0) for event in ('hits', 'misses')), 400)
+
+    def test_failed_invalidation_is_retried(self):
+        newsletter = create_newsletter(self.user, clients_count=1, messages_count=1)
+        self.detail(newsletter)
+        message = newsletter.messages.get()
+        message.theme = 'Новая тема'
+        with mock.patch.object(caching.cache, 'incr', side_effect=redis.ConnectionError):
+            message.save()
+        self.assertTrue(caching._pending)
+
+        caching._down_until = 0  # Redis вернулся
+        messages, clients = self.detail(newsletter)
+        self.assertEqual([m.theme for m in messages], ['Новая тема'])
+        self.assertFalse(caching._pending)
+
+
+class ClientSearchTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@example.com', username='owner')
+        self.client.force_login(self.user)
+
+    def search(self, query):
+        response = self.client.get(reverse('clients:client_search'), {'q': query})
+        return [row['email'] for row in response.json()['results']]
+
+    def test_search_follows_client_changes(self):
+        ivanov = Client.objects.create(email='ivanov@example.com', full_name='Иван Иванов', comment='', user=self.user)
+        Client.objects.create(email='petrov@example.com', full_name='Пётр Петров', comment='', user=self.user)
+        other = User.objects.create(email='other@example.com', username='other')
+        Client.objects.create(email='ivanov2@example.com', full_name='Иван Иванов', comment='', user=other)
+
+        self.assertEqual(self.search('иван'), ['ivanov@example.com'])
+        self.assertEqual(self.search('petr'), ['petrov@example.com'])
+
+        ivanov.full_name = 'Сидор Сидоров'
+        ivanov.save()
+        self.assertEqual(self.search('иван'), [])
+        self.assertEqual(self.search('сидор'), ['ivanov@example.com'])
+
+        ivanov.delete()
+        self.assertEqual(self.search('сидор'), [])
+
+    def test_only_ranked_search_is_limited(self):
+        for i in range(3):
+            Client.objects.create(email=f'anna{i}@example.com', full_name='Анна', comment='', user=self.user)
+        clients = Client.objects.filter(user=self.user)
+        with mock.patch.object(search, 'RANK_LIMIT', 2):
+            self.assertEqual(search.search_clients(clients, 'анна', user=self.user).count(), 2)
+            self.assertEqual(search.search_clients(clients, 'анна', user=self.user, ranked=False).count(), 3)
+
+
+class ClientImportExportTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@example.com', username='owner')
+        self.client.force_login(self.user)
+
+    def test_import_upserts_and_export_round_trips(self):
+        Client.objects.create(email='old@example.com', full_name='Старое имя', comment='', user=self.user)
+        other = User.objects.create(email='other@example.com', username='other')
+        Client.objects.create(email='taken@example.com', full_name='Чужой', comment='', user=other)
+        upload = SimpleUploadedFile('clients.csv', (
+            'email,full_name,comment\n'
+            'new@EXAMPLE.com,Новый,первый\n'
+            'old@example.com,Новое имя,\n'
+            'not-an-email,Ошибка,\n'
+            'nameless@example.com,,\n'
+            'taken@example.com,Захват,\n'
+            'new@example.com,Новый клиент,повтор\n'
+        ).encode())
+
+        response = self.client.post(reverse('clients:client_import'), {'file': upload})
+
+        result = response.context['result']
+        self.assertEqual((result['rows'], result['invalid'], result['conflicts']), (6, 2, 1))
+        self.assertTrue(result['errors'][1].startswith('строка 5: ФИО: '))
+        self.assertEqual(
+            dict(Client.objects.values_list('email', 'full_name')),
+            {'old@example.com': 'Новое имя', 'new@example.com': 'Новый клиент', 'taken@example.com': 'Чужой'},
+        )
+
+        response = self.client.get(reverse('clients:client_export'), {'format': 'jsonl'})
+        exported = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual({row['email'] for row in exported}, {'old@example.com', 'new@example.com'})
+
+
+class ClientBulkTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email='owner@example.com', username='owner')
+        self.user.user_permissions.add(*Permission.objects.filter(
+            codename__in=('change_client', 'delete_client', 'change_newsletter'),
+        ))
+        self.client.force_login(self.user)
+
+    def bulk(self, **data):
+        response = self.client.post(reverse('clients:client_bulk'), data)
+        return response.json()['affected']
+
+    def test_bulk_actions_touch_only_own_clients(self):
+        newsletter = create_newsletter(self.user, clients_count=5)
+        extra = create_newsletter(self.user, clients_count=3)
+        other = create_newsletter(User.objects.create(email='other@example.com', username='other'), clients_count=2)
+        own = list(newsletter.client.values_list('pk', flat=True))
+        foreign = list(other.client.values_list('pk', flat=True))
+        ids = ','.join(map(str, own[:3] + foreign))
+
+        self.assertEqual(self.bulk(action='block', ids=ids), 3)
+        self.assertEqual(self.bulk(action='block', ids=ids), 0)
+        self.assertEqual(Client.objects.filter(is_blocked=True).count(), 3)
+
+        self.assertEqual(self.bulk(action='add_to_newsletter', select_all='on', newsletter=extra.pk), 5)
+        self.assertEqual(extra.client.count(), 8)
+
+        self.assertEqual(self.bulk(action='delete', select_all='on', is_blocked='true'), 3)
+        self.assertEqual(Client.objects.filter(pk__in=foreign).count(), 2)
+        self.assertEqual(extra.client.count(), 5)
+
+    def test_checked_cards_send_several_ids(self):
+        newsletter = create_newsletter(self.user, clients_count=4)
+        own = list(newsletter.client.values_list('pk', flat=True))
+
+        self.assertEqual(self.bulk(action='block', ids=[str(pk) for pk in own[:3]]), 3)
+        self.assertEqual(Client.objects.filter(is_blocked=True).count(), 3)
+
+    def test_add_to_newsletter_is_one_insert(self):
+        create_newsletter(self.user, clients_count=7)
+        newsletter = create_newsletter(self.user, clients_count=2)
+        with self.assertNumQueries(1):
+            self.assertEqual(bulk.add_to_newsletter(Client.objects.filter(user=self.user), newsletter), 7)
+        self.assertEqual(newsletter.client.count(), 9)
+        self.assertEqual(bulk.add_to_newsletter(Client.objects.filter(user=self.user), newsletter), 0)
+
+    def test_delete_does_not_load_clients(self):
+        newsletter = create_newsletter(self.user, clients_count=20)
+        Log.objects.create(
+            date_attempt=timezone.now(), state='ok', response_server='250',
+            message=Message.objects.filter(newsletter=newsletter).first(), client=newsletter.client.first(),
+        )
+        # id, миниатюры, рассылки, связи, доставки, логи, клиенты и поисковый индекс - независимо от числа клиентов
+        with self.assertNumQueries(10):
+            self.assertEqual(bulk.delete_clients(Client.objects.filter(user=self.user)), 20)
+        self.assertFalse(Client.objects.exists())
+        self.assertFalse(newsletter.client.exists())
+        self.assertFalse(Log.objects.filter(client__isnull=False).exists())
+
+
+class AvatarThumbnailTestCase(CeleryEagerTestCase):
+
+    def test_thumbnails_replace_original_once_built(self):
+        buffer = BytesIO()
+        Image.new('RGB', (1200, 800), 'red').save(buffer, 'PNG')
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            client = Client(email='pic@example.com', full_name='С аватаром', comment='', user=self.user)
+            client.avatar.save('pic.png', ContentFile(buffer.getvalue()), save=False)
+            self.assertIn('users/pic', avatar(client))
+            with self.captureOnCommitCallbacks(execute=True):
+                client.save()
+
+            client.refresh_from_db()
+            self.assertEqual(client.thumbnails_for, client.avatar.name)
+            small = thumbnail_name(client.avatar.name, 'small', 'jpeg')
+            with Image.open(os.path.join(media_root, small)) as image:
+                self.assertEqual(image.size, (96, 96))
+            self.assertTrue(small.endswith('pic.png.thumb_small.jpg'))
+            self.assertIn(small, avatar(client))
+            self.assertIn('image/webp', avatar(client))
+            with override_settings(AVATAR_THUMBNAIL_FORMATS=('jpeg',)):
+                self.assertNotIn('<source', avatar(client))
+
+            with self.captureOnCommitCallbacks(execute=True):
+                client.delete()
+            self.assertFalse(os.path.exists(os.path.join(media_root, small)))
+
+
+@override_settings(METRICS_SAMPLE_RATE=1, CACHE_ENABLED=False)
+class MetricsTestCase(CeleryEagerTestCase):
+
+    def test_mailing_and_requests_are_measured(self):
+        def sent_total():
+            return sum(metrics.collect()['task_emails_sent_total'].values())
+
+        newsletter = create_newsletter(self.user, clients_count=3)
+        sent_before = sent_total()
+        mailing.delay(newsletter.pk)
+        self.assertEqual(sent_total() - sent_before, 3)
+        # сессии многопоточного движка отправляют из потоков пула, но считаются в замере задачи
+        with override_settings(MAIL_SENDER_ENGINE='clients.threaded_engine.ThreadedMailEngine',
+                               MAIL_SENDER_BATCH_SIZE=1):
+            mailing.delay(newsletter.pk)
+        self.assertEqual(sent_total() - sent_before, 6)
+
+        self.assertEqual(self.client.get(reverse('clients:metrics')).status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.client.get(reverse('clients:newsletter_view'))
+        response = self.client.get(reverse('clients:metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('requests_total{view="clients:newsletter_view"}', response.content.decode())
+
+    @override_settings(METRICS_SAMPLE_RATE=1, CACHE_ENABLED=False)
+    def test_request_gets_only_its_own_cache_events(self):
+        def view(request):
+            caching.count('hits')
+            # другой запрос того же процесса в соседнем потоке
+            other = threading.Thread(target=lambda: [caching.count('hits') for _ in range(5)])
+            other.start()
+            other.join()
+            return HttpResponse()
+
+        def hits():
+            return metrics.collect()['request_cache_hits_total'][(('view', 'unresolved'),)]
+
+        before = hits()
+        metrics.MetricsMiddleware(view)(RequestFactory().get('/'))
+        self.assertEqual(hits() - before, 1)
+
+
+class LogArchiveTestCase(TestCase):
+
+    def test_old_logs_move_to_archive_and_stay_visible(self):
+        user = User.objects.create(email='owner@example.com', username='owner')
+        newsletter = create_newsletter(user, clients_count=2)
+        message = newsletter.messages.get()
+        now = timezone.now()
+        for days_ago in (1, 100, 100, 200):
+            for client in newsletter.client.all():
+                Log.objects.create(date_attempt=now - datetime.timedelta(days=days_ago), state=Newsletter.STATUS_DONE,
+                                   response_server='ok', message=message, client=client)
+
+        with tempfile.TemporaryDirectory() as archive, override_settings(LOG_ARCHIVE_DIR=archive):
+            call_command('archive_logs', days=90, batch_size=3, stdout=StringIO())
+            self.assertEqual(Log.objects.count(), 2)
+            self.assertEqual(len(log_archive.archived_days()), 2)
+
+            self.client.force_login(user)
+            response = self.client.get(reverse('clients:log_view'))
+            self.assertEqual(len(response.context['object_list']), 2)
+            pages = []
+            query = 'archive=on'
+            with mock.patch.object(LogListView, 'paginate_by', 3):
+                while query:
+                    response = self.client.get(reverse('clients:log_view') + '?' + query)
+                    pages.append(response.context['object_list'])
+                    query = response.context.get('next_query')
+            self.assertEqual(len(pages), 3)
+            logs = [log for page in pages for log in page]
+            self.assertEqual(len(logs), 8)
+            self.assertEqual(len({log.pk for log in logs}), 8)
+            dates = [log.date_attempt for log in logs]
+            self.assertEqual(dates, sorted(dates, reverse=True))
+
+
+class MailSenderCommandTestCase(CeleryEagerTestCase):
+
+    def test_dry_run_limit_and_resume(self):
+        newsletter = create_newsletter(self.user, clients_count=7, messages_count=2)
+
+        out = StringIO()
+        call_command('mail_sender', newsletter=[newsletter.pk], dry_run=True, workers=1, stdout=out)
+        self.assertIn('Собрано писем: 14', out.getvalue())
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertFalse(Log.objects.exists())
+
+        out = StringIO()
+        call_command('mail_sender', newsletter=[newsletter.pk], limit=3, workers=1, chunk_size=2, stdout=out)
+        self.assertEqual(len(mail.outbox), 6)
+        run = Delivery.objects.values_list('run', flat=True).first()
+
+        call_command('mail_sender', run=run, workers=1, stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 14)
+        self.assertEqual(len({(email.subject, email.to[0]) for email in mail.outbox}), 14)
+        newsletter.refresh_from_db()
+        self.assertEqual(newsletter.status, Newsletter.STATUS_DONE)
+
+    def test_failed_chunk_is_counted_and_run_finishes(self):
+        newsletter = create_newsletter(self.user, clients_count=5)
+        chunk_results = [ConnectionError('SMTP недоступен'), send_chunk, send_chunk]
+
+        def flaky_chunk(*args):
+            outcome = chunk_results.pop(0)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome(*args)
+
+        out = StringIO()
+        with mock.patch('clients.management.commands.mail_sender.send_chunk', side_effect=flaky_chunk):
+            call_command('mail_sender', newsletter=[newsletter.pk], workers=1, chunk_size=2,
+                         stdout=out, stderr=StringIO())
+        self.assertIn('Отправлено писем: 3, с ошибкой: 2', out.getvalue())
+        self.assertIn('Пачек с ошибкой: 1', out.getvalue())
+        self.assertEqual(len(mail.outbox), 3)
+        newsletter.refresh_from_db()
+        self.assertEqual(newsletter.status, Newsletter.STATUS_DONE)
+
+
+class NewsletterCreateTestCase(CeleryEagerTestCase):
+
+    def test_initial_send_runs_after_commit(self):
+        clients = [
+            Client.objects.create(email=f'new{i}@example.com', full_name='', comment='', user=self.user)
+            for i in range(3)
+        ]
+        self.client.force_login(self.user)
+        data = {
+            'time': '00:00', 'period': Newsletter.PERIOD_DAILY, 'user': self.user.pk,
+            'client': [client.pk for client in clients],
+            'messages-TOTAL_FORMS': 1, 'messages-INITIAL_FORMS': 0,
+            'messages-0-theme': 'Тема', 'messages-0-letter': 'Письмо',
+        }
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('clients:newsletter_create'), data)
+        newsletter = Newsletter.objects.get()
+        self.assertRedirects(response, reverse('clients:newsletter_detail', args=[newsletter.pk]))
+        self.assertEqual(len(mail.outbox), 0)
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(mail.outbox), 3)
+        progress = self.client.get(reverse('clients:newsletter_progress', args=[newsletter.pk])).json()
+        self.assertEqual((progress['sent'], progress['failed'], progress['total']), (3, 0, 3))
+        self.assertEqual((progress['state'], progress['finished']), ('done', True))
+        # законченный прогон убран из сессии
+        self.assertEqual(self.client.get(reverse('clients:newsletter_progress', args=[newsletter.pk])).status_code, 404)
+
+    def test_lost_send_is_reported_as_stopped(self):
+        newsletter = create_newsletter(self.user, clients_count=2)
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['newsletter_runs'] = {str(newsletter.pk): {
+            'run': 'lost', 'started': time.time() - settings.NEWSLETTER_PROGRESS_STALE_AFTER - 1,
+        }}
+        session.save()
+
+        progress = self.client.get(reverse('clients:newsletter_progress', args=[newsletter.pk])).json()
+        self.assertEqual((progress['sent'], progress['total'], progress['state']), (0, 2, 'stale'))
+        self.assertTrue(progress['finished'])
+
+
+@override_settings(EMAIL_BACKEND='clients.tests.FlakyEmailBackend', ACCOUNT_EMAIL_RETRY_DELAY=0)
+class AccountOutboxTestCase(CeleryEagerTestCase):
+
+    def test_registration_email_is_sent_after_commit_with_retries(self):
+        FlakyEmailBackend.failing = {'new@example.com'}
+        data = {'email': 'new@example.com', 'password1': 'Secret-pass-123', 'password2': 'Secret-pass-123'}
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('clients:register'), data)
+        self.assertRedirects(response, reverse('clients:confirm'), fetch_redirect_response=False)
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutboxEmail.objects.get(to='new@example.com')
+        self.assertEqual(email.status, OutboxEmail.STATUS_PENDING)
+
+        for callback in callbacks:
+            callback()
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.STATUS_SENT, 2))
+        self.assertEqual(len(mail.outbox), 1)
+        code = mail.outbox[0].body.split()[-1]
+        self.assertEqual(verification.check(User.objects.get(email='new@example.com').pk, code), verification.OK)
+
+        self.assertEqual(email.body, '')
+
+        # воркер упал посреди отправки: письмо не возьмёт вторая задача, но подберёт drain_outbox
+        stuck = OutboxEmail.objects.create(
+            to='stuck@example.com', subject='Тема', body='Код 123456', status=OutboxEmail.STATUS_SENDING,
+            attempts=1, next_attempt_at=timezone.now(),
+        )
+        self.assertFalse(outbox.deliver(stuck.pk))
+        self.assertEqual(drain_outbox.delay().get(), 0)
+        OutboxEmail.objects.filter(pk=stuck.pk).update(next_attempt_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(drain_outbox.delay().get(), 1)
+        self.assertEqual(mail.outbox[-1].body, 'Код 123456')
+        stuck.refresh_from_db()
+        self.assertEqual((stuck.status, stuck.attempts, stuck.body), (OutboxEmail.STATUS_SENT, 2, ''))
+
+
+@override_settings(
+    CACHE_ENABLED=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'verification'}},
+)
+class VerificationTestCase(TestCase):
+
+    def setUp(self):
+        caching._down_until = 0
+        caching._pending.clear()
+        caching._pending_keys.clear()
+        caching.metrics.clear()
+        self.user = User.objects.create(email='new@example.com', username='new', is_active=False)
+
+    def test_cached_code_attempts_and_db_fallback(self):
+        code = verification.issue(self.user)
+        self.assertFalse(Code.objects.exists())
+        wrong = '000000' if code != '000000' else '111111'
+        for _ in range(settings.VERIFICATION_MAX_ATTEMPTS - 1):
+            self.assertEqual(verification.check(self.user.pk, wrong), verification.INVALID)
+        self.assertEqual(verification.check(self.user.pk, code), verification.OK)
+        self.assertEqual(verification.check(self.user.pk, code), verification.INVALID)
+
+        code = verification.issue(self.user)
+        for _ in range(settings.VERIFICATION_MAX_ATTEMPTS):
+            verification.check(self.user.pk, wrong)
+        self.assertEqual(verification.check(self.user.pk, code), verification.LOCKED)
+
+        with override_settings(CACHE_ENABLED=False):
+            code = verification.issue(self.user)
+            self.assertEqual(Code.objects.get(user=self.user).code, code)
+            self.assertEqual(verification.check(self.user.pk, code), verification.OK)
+            self.assertFalse(Code.objects.exists())
+
+    def test_permissions_are_cached_until_changed(self):
+        self.user.is_active = True
+        self.user.save()
+        permission = Permission.objects.get(codename='change_client')
+
+        def has_perm():
+            with CaptureQueriesContext(connection) as queries:
+                allowed = User.objects.get(pk=self.user.pk).has_perm('clients.change_client')
+            return allowed, len(queries)
+
+        self.assertEqual(has_perm(), (False, 3))
+        self.assertEqual(has_perm(), (False, 1))
+        self.user.user_permissions.add(permission)
+        self.assertEqual(has_perm(), (True, 3))
+        self.assertEqual(has_perm(), (True, 1))
+
+        self.user.user_permissions.clear()
+        group = Group.objects.create(name='managers')
+        group.permissions.add(permission)
+        self.user.groups.add(group)
+        self.assertEqual(has_perm(), (True, 3))
+        group.delete()
+        self.assertEqual(has_perm(), (False, 3))
+
+
+@override_settings(
+    CACHE_ENABLED=True,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'sessions'}},
+    SESSION_ENGINE='clients.sessions',
+)
+class SessionStoreTestCase(TestCase):
+
+    def setUp(self):
+        caching._down_until = 0
+        caching._pending.clear()
+        caching._pending_keys.clear()
+
+    def test_sessions_are_cached_and_survive_redis_outage(self):
+        user = User.objects.create(email='owner@example.com', username='owner')
+        self.client.force_login(user)
+        key = self.client.session.session_key
+        with self.assertNumQueries(0):
+            self.assertEqual(SessionStore(key).load()['_auth_user_id'], str(user.pk))
+
+        # Redis недоступен: сессия читается из базы, а выход не может удалить её из кеша
+        with mock.patch('clients.caching.cache') as broken, self.assertLogs('clients.caching', 'WARNING'):
+            broken.get.side_effect = broken.set.side_effect = broken.delete_many.side_effect = redis.ConnectionError
+            with self.assertNumQueries(1):
+                self.assertEqual(SessionStore(key).load()['_auth_user_id'], str(user.pk))
+            self.client.logout()
+
+        # Redis вернулся: удаление повторяется до чтения, и вышедшая сессия не оживает из кеша
+        caching._down_until = 0
+        self.assertEqual(SessionStore(key).load(), {})
+        self.assertFalse(caching._pending_keys)
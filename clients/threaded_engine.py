@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+
+from clients import metrics
+from clients.engine import MailEngine
+from clients.rate_limit import get_rate_limiter
+
+
+class ThreadedMailEngine:
+    '''
+    Движок отправки писем в несколько потоков:
+    письма режутся на пачки, пачки отправляются одновременно
+    не более чем через concurrency SMTP-сессий (пул из concurrency потоков),
+    внутри сессии письма идут подряд по уже открытому соединению.
+    SMTP-клиент (smtplib) блокирующий, асинхронного ввода-вывода здесь нет:
+    одновременность сессий дают потоки, пока одна сессия ждёт сервер, работают другие.
+    '''
+
+    def __init__(self, concurrency=None, batch_size=None, rate_limiter=None, max_wait=None, **engine_kwargs):
+        self.concurrency = concurrency or settings.MAIL_SENDER_CONCURRENCY
+        self.session_batch_size = batch_size or settings.MAIL_SENDER_BATCH_SIZE
+        # вызывающий код копит письма по batch_size, чтобы загрузить сразу все сессии
+        self.batch_size = self.session_batch_size * self.concurrency
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.max_wait = max_wait
+        self.engine_kwargs = dict(engine_kwargs, rate_limiter=self.rate_limiter)
+        self.sessions = []  # простаивающие сессии, переиспользуются между пачками и вызовами send
+        self.lock = threading.Lock()  # сессии берут и возвращают потоки пула
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        while self.sessions:
+            self.sessions.pop().close()
+
+    def admit(self, email_messages):
+        if self.rate_limiter is not None and email_messages:
+            self.rate_limiter.admit(email_messages[0].from_email, self.max_wait)
+
+    def send(self, email_messages):
+        '''
+        Возвращает список ошибок в порядке писем (None - письмо отправлено)
+        '''
+        email_messages = list(email_messages)
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='smtp')
+        batches = [
+            email_messages[start:start + self.session_batch_size]
+            for start in range(0, len(email_messages), self.session_batch_size)
+        ]
+        task = metrics.current_task()  # замер задачи передаётся в потоки сессий явно
+        results = self.executor.map(partial(self._send_batch, task=task), batches)
+        return [error for errors in results for error in errors]
+
+    def _send_batch(self, batch, task):
+        with self.lock:
+            session = self.sessions.pop() if self.sessions else None
+        if session is None:
+            session = MailEngine(batch_size=self.session_batch_size, **self.engine_kwargs)
+        try:
+            with metrics.in_task(task):
+                return session.send_batch(batch)
+        finally:
+            with self.lock:
+                self.sessions.append(session)
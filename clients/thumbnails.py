@@ -0,0 +1,52 @@
+import io
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# Миниатюры лежат рядом с оригиналом: users/photo.png -> users/photo.png.thumb_small.webp.
+# Расширение оригинала остаётся в имени, чтобы photo.png и photo.jpg не делили миниатюры
+PIL_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+MIME_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+def thumbnail_name(name, size, fmt):
+    return f'{name}.thumb_{size}.{"jpg" if fmt == "jpeg" else fmt}'
+
+
+def make_thumbnails(name, storage=None):
+    '''
+    Строит миниатюры всех размеров и форматов для картинки name из хранилища,
+    возвращает имена созданных файлов
+    '''
+    storage = storage or default_storage
+    with storage.open(name, 'rb') as original:
+        image = Image.open(original)
+        image = ImageOps.exif_transpose(image)  # фото с телефона хранят поворот в EXIF
+        image.load()
+    created = []
+    for size, dimensions in settings.AVATAR_THUMBNAIL_SIZES.items():
+        thumbnail = ImageOps.fit(image, dimensions, Image.LANCZOS)
+        for fmt in settings.AVATAR_THUMBNAIL_FORMATS:
+            converted = thumbnail
+            if fmt == 'jpeg' and thumbnail.mode != 'RGB':
+                converted = thumbnail.convert('RGB')
+            elif fmt == 'webp' and thumbnail.mode not in ('RGB', 'RGBA'):
+                converted = thumbnail.convert('RGBA')
+            buffer = io.BytesIO()
+            converted.save(buffer, PIL_FORMATS[fmt], quality=settings.AVATAR_THUMBNAIL_QUALITY, optimize=True)
+            target = thumbnail_name(name, size, fmt)
+            if storage.exists(target):  # иначе хранилище сохранит под другим именем
+                storage.delete(target)
+            created.append(storage.save(target, ContentFile(buffer.getvalue())))
+    return created
+
+
+def delete_thumbnails(name, storage=None):
+    storage = storage or default_storage
+    for size in settings.AVATAR_THUMBNAIL_SIZES:
+        for fmt in settings.AVATAR_THUMBNAIL_FORMATS:
+            target = thumbnail_name(name, size, fmt)
+            if storage.exists(target):
+                storage.delete(target)
@@ -2,7 +2,9 @@ from django.contrib.auth.views import LogoutView
 from django.urls import path
 from clients.views import ClientListView, ClientCreateView, Client_cardDetailView, NewsletterListView, ClientUpdateView, \
     ClientDeleteView, NewsletterCreateView, Newsletter_cardDetailView, LogListView, UserLoginView, RegisterView, \
-    ProfileView, ConfirmView, user_gen_password, NewsletterDeleteView, TaskToggleView, ClientBlockView
+    ProfileView, ConfirmView, user_gen_password, NewsletterDeleteView, NewsletterToggleView, NewsletterProgressView, \
+    ClientBlockView, StatsView, ClientSearchView, ClientImportView, ClientImportStatusView, ClientExportView, \
+    ClientBulkView, MetricsView
 from clients.apps import ClientsConfig
 
 app_name = ClientsConfig.name
@@ -14,11 +16,20 @@ urlpatterns = [
     path("client_update/<int:pk>/", ClientUpdateView.as_view(), name="client_update"),
     path("client_delete/<int:pk>/", ClientDeleteView.as_view(), name="client_delete"),
     path("client_block/<int:pk>/", ClientBlockView.as_view(), name="client_block"),
+    path("client_search/", ClientSearchView.as_view(), name="client_search"),
+    path("client_bulk/", ClientBulkView.as_view(), name="client_bulk"),
+    path("client_import/", ClientImportView.as_view(), name="client_import"),
+    path("client_import/<str:task_id>/", ClientImportStatusView.as_view(), name="client_import_status"),
+    path("client_export/", ClientExportView.as_view(), name="client_export"),
     path("newsletter_view/", NewsletterListView.as_view(), name="newsletter_view"),
     path("newsletter_detail/<int:pk>/", Newsletter_cardDetailView.as_view(), name="newsletter_detail"),
     path("newsletter_create/", NewsletterCreateView.as_view(), name="newsletter_create"),
     path("newsletter_delete/<int:pk>/", NewsletterDeleteView.as_view(), name="newsletter_delete"),
+    path("newsletter_progress/<int:pk>/", NewsletterProgressView.as_view(), name="newsletter_progress"),
+    path("newsletter_toggle/<int:pk>/", NewsletterToggleView.as_view(), name="newsletter_toggle"),
     path("log_view/", LogListView.as_view(), name="log_view"),
+    path("stats/", StatsView.as_view(), name="stats"),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
 
     path('', UserLoginView.as_view(template_name='clients/login.html'), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
@@ -27,6 +38,4 @@ urlpatterns = [
     path('confirm/', ConfirmView.as_view(), name='confirm'),
     path('login/genpassword/', user_gen_password, name='genpassword'),
 
-
-    path('task/<int:pk>/toggle/', TaskToggleView.as_view(), name='toggle_task'),
 ]
@@ -0,0 +1,65 @@
+from django.conf import settings
+from django.utils.crypto import constant_time_compare, get_random_string, salted_hmac
+
+from clients import caching
+from clients.models import Code
+
+# Коды подтверждения почты. Если кеш включён, код хранится в нём (как HMAC, а не сам код)
+# VERIFICATION_CODE_TTL секунд, попытки ввода считаются там же: после VERIFICATION_MAX_ATTEMPTS
+# неверных попыток ввод закрыт до конца окна. Если кеш выключен или недоступен,
+# код пишется в таблицу Code, как раньше, и проверяется одним запросом.
+OK = 'ok'
+INVALID = 'invalid'
+LOCKED = 'locked'
+
+
+def _code_key(user_id):
+    return f'verify:{user_id}'
+
+
+def _attempts_key(user_id):
+    return f'verify:{user_id}:attempts'
+
+
+def _digest(user_id, code):
+    return salted_hmac('clients.verification', f'{user_id}:{code}').hexdigest()
+
+
+def issue(user):
+    '''
+    Выдаёт пользователю новый код (старый перестаёт действовать), возвращает код для письма
+    '''
+    code = get_random_string(6, '1234567890')
+    if caching.store(_code_key(user.pk), _digest(user.pk, code), settings.VERIFICATION_CODE_TTL):
+        caching.discard(_attempts_key(user.pk))
+    else:
+        Code.objects.filter(user=user).delete()
+        Code.objects.create(code=code, user=user)
+    return code
+
+
+def check(user_id, code):
+    '''
+    Проверяет введённый код, возвращает OK (код погашен), INVALID или LOCKED (слишком много попыток)
+    '''
+    attempts = caching.hit(_attempts_key(user_id), settings.VERIFICATION_CODE_TTL)
+    if attempts is not None and attempts > settings.VERIFICATION_MAX_ATTEMPTS:
+        return LOCKED
+    digest = caching.fetch(_code_key(user_id))
+    if digest is not None:
+        if not constant_time_compare(digest, _digest(user_id, code)):
+            return INVALID
+        caching.discard(_code_key(user_id), _attempts_key(user_id))
+        return OK
+    # в кеше кода нет: он мог быть выдан, когда кеш был выключен или недоступен
+    deleted, _ = Code.objects.filter(user_id=user_id, code=code).delete()
+    return OK if deleted else INVALID
+
+
+def limited(name, limit):
+    '''
+    Учитывает ещё одно действие name и сообщает, превышен ли limit за VERIFICATION_RATE_WINDOW.
+    Без кеша ограничения нет
+    '''
+    count = caching.hit(f'ratelimit:{name}', settings.VERIFICATION_RATE_WINDOW)
+    return count is not None and count > limit
@@ -1,36 +1,92 @@
 import datetime
-import json
+import time
+import uuid
+from itertools import islice
 
+from celery.result import AsyncResult
 from django.contrib.auth import login
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 from django.contrib.auth.models import Permission
 from django.contrib.auth.views import LoginView
 from django.contrib.contenttypes.models import ContentType
-from django.core.cache import cache
-from django.core.mail import send_mail
+from django.core.exceptions import PermissionDenied
+from django.core.files.storage import default_storage
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Q, Sum, Count, OuterRef, Subquery
 from django.forms import inlineformset_factory
-from django.http import Http404
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse_lazy, reverse
-from django.utils.crypto import get_random_string
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, get_random_string
+from django.utils.dateparse import parse_datetime
 from django.views import View
-from django.views.generic import CreateView, ListView, DetailView, UpdateView, DeleteView
-from django_celery_beat.models import PeriodicTask, CrontabSchedule
+from django.views.generic import CreateView, ListView, DetailView, UpdateView, DeleteView, FormView
 
 from cw_dj import settings
-from clients.forms import ClientForm, MessageForm, NewsletterForm, LoginUserForm, UserRegisterForm, UserProfileForm
-from clients.mail_sender import mail_send
-from clients.models import Client, Newsletter, Log, Message, User, Code
+from clients import bulk, caching, log_archive, metrics, outbox, verification
+from clients.client_io import FORMATS, guess_format, import_clients, export_clients
+from clients.forms import ClientForm, MessageForm, NewsletterForm, LoginUserForm, UserRegisterForm, UserProfileForm, \
+    LogFilterForm, StatsFilterForm, ClientImportForm, ClientBulkForm
+from clients.ledger import DeliveryLedger
+from clients.mail_sender import new_run
+from clients.models import Client, Newsletter, Log, Message, User, DeliveryStat
+from clients.scheduling import schedule
+from clients.search import search_clients
+from clients.tasks import import_clients_file, mailing
+
+
+def day_start(date):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+def count_subquery(queryset, field):
+    '''
+    Количество связанных записей подзапросом: в отличие от Count по join,
+    несколько таких счётчиков не перемножают строки друг друга
+    '''
+    counts = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(count=Count('pk'))
+    return Subquery(counts.values('count'))
 
 
 class ClientListView(LoginRequiredMixin, ListView):
     model = Client
+    paginate_by = 30
     extra_context = {
         'title': 'Клиенты'
     }
 
     def get_queryset(self):
-        return Client.objects.filter(user=self.request.user)
+        queryset = Client.objects.filter(user=self.request.user).order_by('pk')
+        return search_clients(queryset, self.request.GET.get('q', ''), user=self.request.user)
+
+    def get_context_data(self, **kwargs):
+        context_data = super().get_context_data(**kwargs)
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context_data['query'] = query.urlencode()
+        context_data['bulk_form'] = ClientBulkForm(user=self.request.user, initial={'q': self.request.GET.get('q', '')})
+        return context_data
+
+
+class ClientSearchView(LoginRequiredMixin, View):
+    '''
+    Поиск клиентов по почте и ФИО в JSON: ?q=запрос&page=номер
+    '''
+    paginate_by = 20
+
+    def get(self, request):
+        clients = search_clients(Client.objects.filter(user=request.user), request.GET.get('q', ''), user=request.user)
+        page = Paginator(clients.only('id', 'email', 'full_name'), self.paginate_by).get_page(request.GET.get('page'))
+        return JsonResponse({
+            'results': [
+                {'id': client.pk, 'email': client.email, 'full_name': client.full_name}
+                for client in page
+            ],
+            'page': page.number,
+            'has_next': page.has_next(),
+        })
 
 
 class ClientCreateView(LoginRequiredMixin, CreateView):
@@ -42,6 +98,59 @@ class ClientCreateView(LoginRequiredMixin, CreateView):
     }
 
 
+class ClientImportView(LoginRequiredMixin, FormView):
+    '''
+    Импорт клиентов из CSV/JSONL: небольшой файл импортируется сразу,
+    большой сохраняется и импортируется задачей Celery, прогресс - в ClientImportStatusView
+    '''
+    form_class = ClientImportForm
+    template_name = 'clients/client_import.html'
+    extra_context = {
+        'title': 'Импорт клиентов'
+    }
+
+    def form_valid(self, form):
+        upload = form.cleaned_data['file']
+        fmt = form.cleaned_data['format'] or guess_format(upload.name)
+        if upload.size <= settings.CLIENT_IMPORT_SYNC_LIMIT:
+            result = import_clients(upload, fmt, self.request.user)
+            return self.render_to_response(self.get_context_data(form=form, result=result))
+        path = default_storage.save(f'imports/{uuid.uuid4().hex}.{fmt}', upload)
+        task = import_clients_file.delay(path, fmt, self.request.user.pk)
+        # смотреть прогресс может только тот, кто запустил импорт
+        self.request.session['client_imports'] = self.request.session.get('client_imports', [])[-9:] + [task.id]
+        return self.render_to_response(self.get_context_data(form=form, task_id=task.id))
+
+
+class ClientImportStatusView(LoginRequiredMixin, View):
+
+    def get(self, request, task_id):
+        if task_id not in request.session.get('client_imports', []):
+            raise Http404
+        task = AsyncResult(task_id)
+        info = task.info if isinstance(task.info, dict) else {}
+        if task.failed():
+            info = {'error': str(task.info)}
+        return JsonResponse(dict(info, state=task.state))
+
+
+class ClientExportView(LoginRequiredMixin, View):
+    '''
+    Выгрузка клиентов пользователя: ?format=csv или jsonl, файл отдаётся по мере чтения базы
+    '''
+
+    def get(self, request):
+        fmt = request.GET.get('format', 'csv')
+        if fmt not in FORMATS:
+            raise Http404
+        response = StreamingHttpResponse(
+            export_clients(Client.objects.filter(user=request.user), fmt),
+            content_type='text/csv; charset=utf-8' if fmt == 'csv' else 'application/x-ndjson; charset=utf-8',
+        )
+        response['Content-Disposition'] = f'attachment; filename="clients.{fmt}"'
+        return response
+
+
 class ClientUpdateView(LoginRequiredMixin, PermissionRequiredMixin, UpdateView):
     model = Client
     form_class = ClientForm
@@ -75,6 +184,45 @@ class ClientBlockView(LoginRequiredMixin, PermissionRequiredMixin, UpdateView):
         return self.object
 
 
+class ClientBulkView(LoginRequiredMixin, View):
+    '''
+    Массовые блокировка, удаление и изменение рассылок для выборки клиентов пользователя,
+    отвечает JSON с количеством затронутых записей
+    '''
+    permissions = {
+        'block': 'clients.change_client',
+        'unblock': 'clients.change_client',
+        'delete': 'clients.delete_client',
+        'add_to_newsletter': 'clients.change_newsletter',
+        'remove_from_newsletter': 'clients.change_newsletter',
+    }
+
+    def post(self, request):
+        form = ClientBulkForm(request.POST, user=request.user)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+        data = form.cleaned_data
+        action = data['action']
+        if not request.user.has_perm(self.permissions[action]):
+            return JsonResponse({'errors': {'action': ['Недостаточно прав']}}, status=403)
+        clients = Client.objects.filter(user=request.user)
+        if data['select_all']:
+            if data['is_blocked'] is not None:
+                clients = clients.filter(is_blocked=data['is_blocked'])
+            clients = search_clients(clients, data['q'], user=request.user, ranked=False)
+        else:
+            clients = clients.filter(pk__in=data['ids'])
+        if action in ('block', 'unblock'):
+            affected = bulk.set_blocked(clients, action == 'block')
+        elif action == 'delete':
+            affected = bulk.delete_clients(clients)
+        elif action == 'add_to_newsletter':
+            affected = bulk.add_to_newsletter(clients, data['newsletter'])
+        else:
+            affected = bulk.remove_from_newsletter(clients, data['newsletter'])
+        return JsonResponse({'action': action, 'affected': affected})
+
+
 class Client_cardDetailView(LoginRequiredMixin, DetailView):
     model = Client
 
@@ -112,10 +260,18 @@ class ClientDeleteView(LoginRequiredMixin, PermissionRequiredMixin, DeleteView):
 
 class NewsletterListView(LoginRequiredMixin, ListView):
     model = Newsletter
+    paginate_by = 30
     extra_context = {
         'title': 'Рассылки'
     }
 
+    def get_queryset(self):
+        # пользователь и счётчики приходят в том же запросе, что и рассылки: без запроса на каждую карточку
+        return Newsletter.objects.filter(user=self.request.user).select_related('user').annotate(
+            recipients_count=count_subquery(Newsletter.client.through.objects.all(), 'newsletter'),
+            messages_count=count_subquery(Message.objects.all(), 'newsletter'),
+        ).order_by('pk')
+
 
 class Newsletter_cardDetailView(LoginRequiredMixin, DetailView):
     model = Newsletter
@@ -128,47 +284,28 @@ class Newsletter_cardDetailView(LoginRequiredMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
-        if settings.CACHE_ENABLED:
-            key = f'message_list_{self.object.pk}'
-            message_list = cache.get(key)
-            if message_list is None:
-                message_list = self.object.messages.all()
-                cache.set(key, message_list)
-        else:
-            message_list = self.object.messages.all()
-        context_data['message_'] = message_list
-        try:
-            context_data['task'] = PeriodicTask.objects.get(name=kwargs['object'].id)
-        except PeriodicTask.DoesNotExist:
-            pass
+        context_data['message_'] = caching.newsletter_messages(self.object)
+        context_data['client_list'] = caching.newsletter_recipients(self.object)
+        if str(self.object.pk) in self.request.session.get('newsletter_runs', {}):
+            context_data['progress_url'] = reverse('clients:newsletter_progress', args=[self.object.pk])
         return context_data
 
 
-class TaskToggleView(LoginRequiredMixin, UpdateView):
-    model = PeriodicTask
-    success_url = reverse_lazy('clients:newsletter_view')
-    fields = []  # Полей для редактирования нет, так как мы меняем только поле enabled
+class NewsletterToggleView(LoginRequiredMixin, View):
+    '''
+    Включает и отключает отправку рассылки по расписанию
+    '''
 
-    def form_valid(self, form):
-        instance = form.save(commit=False)
-        instance.enabled = not instance.enabled
-        instance.save()
-        return super().form_valid(form)
-
-
-# class TaskToggleView(LoginRequiredMixin, View):
-#
-#     def post(self, request, *args, **kwargs):
-#         try:
-#             task = PeriodicTask.objects.get(name=kwargs['pk'])
-#         except PeriodicTask.DoesNotExist:
-#             return reverse_lazy('clients:newsletter_view')
-#         if task.enabled:
-#             task.enabled = False
-#         else:
-#             task.enabled = True
-#         task.save()
-#         return reverse_lazy('clients:newsletter_view')
+    def post(self, request, pk):
+        newsletter = Newsletter.objects.filter(pk=pk, user=request.user).first()
+        if newsletter is None:
+            raise Http404
+        if newsletter.next_run_at:
+            newsletter.next_run_at = None
+        else:
+            schedule(newsletter)
+        newsletter.save(update_fields=['next_run_at'])
+        return redirect('clients:newsletter_view')
 
 
 class NewsletterCreateView(LoginRequiredMixin, CreateView):
@@ -201,44 +338,69 @@ class NewsletterCreateView(LoginRequiredMixin, CreateView):
         if formset.is_valid():
             formset.instance = self.object
             formset.save()
+            schedule(self.object)  # дальше рассылку отправляет тик расписания
             super().form_valid(form)
             if datetime.datetime.now().time() > self.object.time:
-                mail_send(newsletters=[self.object, ])
-            cron = None
-            if self.object.period == Newsletter.PERIOD_DAILY:
-                cron = CrontabSchedule(
-                    minute=str(self.object.time.minute),
-                    hour=str(self.object.time.hour),
-                    day_of_week='*',
-                    day_of_month='*',
-                    month_of_year='*',
-                )
-            elif self.object.period == Newsletter.PERIOD_WEEKLY:
-                cron = CrontabSchedule(
-                    minute=str(self.object.time.minute),
-                    hour=str(self.object.time.hour),
-                    day_of_month='*',
-                    month_of_year='*',
-                    day_of_week=datetime.datetime.now().weekday() + 1
-                )
-            elif self.object.period == Newsletter.PERIOD_MONTHLY:
-                cron = CrontabSchedule(
-                    minute=str(self.object.time.minute),
-                    hour=str(self.object.time.hour),
-                    day_of_week='*',
-                    month_of_year='*',
-                    day_of_month=str(datetime.datetime.now().day)
-                )
-            if cron:
-                cron.save()
-                PeriodicTask.objects.create(
-                    name=f"{self.object.id}",
-                    task="clients.tasks.mailing",
-                    crontab=cron,
-                    args=json.dumps([self.object.period]),
-                )
+                self.start_sending()
         return super().form_valid(form)
 
+    def start_sending(self):
+        '''
+        Время рассылки сегодня уже прошло: первая отправка уходит в Celery после коммита,
+        страница не ждёт SMTP. Прогон запоминается в сессии для страницы хода отправки
+        '''
+        newsletter_id, run = self.object.pk, new_run()
+        transaction.on_commit(lambda: mailing.delay(newsletter_id, run))
+        runs = self.request.session.get('newsletter_runs', {})
+        runs[str(newsletter_id)] = {'run': run, 'started': time.time()}
+        self.request.session['newsletter_runs'] = runs
+        self.success_url = reverse('clients:newsletter_detail', args=[newsletter_id])
+
+
+class NewsletterProgressView(LoginRequiredMixin, View):
+    '''
+    Ход отправки, запущенной при создании рассылки: доставлено, с ошибкой и всего писем.
+    Отправка закончена, если рассылка завершена, по каждому письму есть итог (доставлено
+    или попытки исчерпаны) или прогон ничего не записывал NEWSLETTER_PROGRESS_STALE_AFTER секунд
+    (задача потерялась или упала). Законченный прогон убирается из сессии
+    '''
+    states = {
+        'sending': 'Идёт отправка',
+        'done': 'Отправка завершена',
+        'failed': 'Отправка завершена, часть писем не доставлена',
+        'stale': 'Отправка остановлена',
+    }
+
+    def get(self, request, pk):
+        runs = request.session.get('newsletter_runs', {})
+        entry = runs.get(str(pk))
+        newsletter = Newsletter.objects.filter(pk=pk, user=request.user).first()
+        if entry is None or newsletter is None:
+            raise Http404
+        progress = DeliveryLedger(entry['run']).progress()
+        total = newsletter.client.filter(is_blocked=False).count() * newsletter.messages.count()
+        last_activity = progress.pop('updated_at') or datetime.datetime.fromtimestamp(
+            entry['started'], datetime.timezone.utc,
+        )
+        if progress['sent'] + progress.pop('exhausted') >= total or newsletter.status == Newsletter.STATUS_DONE:
+            # рассылка, прерванная упавшей пачкой, завершена, но часть писем не отправлялась
+            state = 'failed' if progress['failed'] or progress['sent'] < total else 'done'
+        elif (timezone.now() - last_activity).total_seconds() > settings.NEWSLETTER_PROGRESS_STALE_AFTER:
+            state = 'stale'
+        else:
+            state = 'sending'
+        if state != 'sending':
+            del runs[str(pk)]
+            request.session['newsletter_runs'] = runs
+        return JsonResponse(dict(
+            progress,
+            total=total,
+            status=newsletter.status,
+            state=state,
+            state_label=self.states[state],
+            finished=state != 'sending',
+        ))
+
 
 class NewsletterDeleteView(LoginRequiredMixin, DeleteView):
     model = Newsletter
@@ -256,10 +418,153 @@ class NewsletterDeleteView(LoginRequiredMixin, DeleteView):
 
 class LogListView(LoginRequiredMixin, ListView):
     model = Log
+    paginate_by = 50
     extra_context = {
         'title': 'Лог'
     }
 
+    def get_queryset(self):
+        queryset = Log.objects.filter(
+            message__newsletter__user=self.request.user,
+        ).select_related('message', 'client').order_by('-date_attempt', '-pk')
+        self.filter_form = LogFilterForm(self.request.GET or None, user=self.request.user)
+        self.filters = self.filter_form.cleaned_data if self.filter_form.is_valid() else {}
+        data = self.filters
+        if data:
+            if data['newsletter']:
+                queryset = queryset.filter(message__newsletter=data['newsletter'])
+            if data['message']:
+                queryset = queryset.filter(message=data['message'])
+            if data['state']:
+                queryset = queryset.filter(state=data['state'])
+            # границы дат переводим в диапазон по date_attempt, чтобы работал индекс
+            if data['date_from']:
+                queryset = queryset.filter(date_attempt__gte=day_start(data['date_from']))
+            if data['date_to']:
+                queryset = queryset.filter(date_attempt__lt=day_start(data['date_to'] + datetime.timedelta(days=1)))
+        return queryset
+
+    def paginate_queryset(self, queryset, page_size):
+        '''
+        Постраничный вывод по курсору (дата и id последней записи предыдущей страницы)
+        вместо OFFSET и COUNT: каждая страница - диапазон по индексу, сколько бы логов ни было
+        '''
+        before = self.parse_cursor(self.request.GET.get('cursor', ''))
+        if before:
+            date_attempt, pk = before
+            queryset = queryset.filter(
+                Q(date_attempt__lt=date_attempt) | Q(date_attempt=date_attempt, pk__lt=pk)
+            )
+        page = list(queryset[:page_size + 1])
+        if self.filters.get('archive'):
+            page = self.add_archived(page, page_size, before)
+        has_next = len(page) > page_size
+        page = page[:page_size]
+        self.next_cursor = f'{page[-1].date_attempt.isoformat()}|{page[-1].pk}' if has_next else None
+        return None, None, page, has_next
+
+    @staticmethod
+    def parse_cursor(cursor):
+        '''
+        (дата и время, id) из курсора или None, если курсор испорчен (тогда показывается первая страница)
+        '''
+        date_attempt, _, pk = cursor.partition('|')
+        try:
+            date_attempt = parse_datetime(date_attempt)
+        except ValueError:  # формат верный, но дата невозможная: 2024-13-45
+            return None
+        if date_attempt is None or not pk.isdigit():
+            return None
+        if timezone.is_naive(date_attempt):
+            date_attempt = timezone.make_aware(date_attempt)
+        return date_attempt, int(pk)
+
+    def add_archived(self, page, page_size, before):
+        '''
+        Дополняет страницу логами из архива. Архив читается, только если страница
+        из базы не заполнена или доходит до дней, которые уже есть в архиве.
+        Строка, которая после сбоя архивации осталась и в базе, и в архиве, показывается один раз
+        '''
+        days = log_archive.archived_days()
+        if not days or len(page) > page_size and timezone.localdate(page[-1].date_attempt) > days[-1]:
+            return page
+        data = self.filters
+        archived = log_archive.iter_archived(
+            user=self.request.user, newsletter=data['newsletter'], message=data['message'], state=data['state'],
+            date_from=data['date_from'], date_to=data['date_to'], before=before,
+        )
+        in_page = {log.pk for log in page}
+        page = page + list(islice((log for log in archived if log.pk not in in_page), page_size + 1))
+        page.sort(key=lambda log: (log.date_attempt, log.pk), reverse=True)
+        return page
+
+    def get_context_data(self, **kwargs):
+        context_data = super().get_context_data(**kwargs)
+        context_data['filter_form'] = self.filter_form
+        query = self.request.GET.copy()
+        query.pop('cursor', None)
+        context_data['first_query'] = query.urlencode()
+        if self.next_cursor:
+            query['cursor'] = self.next_cursor
+            context_data['next_query'] = query.urlencode()
+        return context_data
+
+
+class StatsView(LoginRequiredMixin, ListView):
+    '''
+    Статистика отправки по рассылкам и дням,
+    читается только из заранее посчитанной DeliveryStat, а не из логов
+    '''
+    model = DeliveryStat
+    paginate_by = 50
+    template_name = 'clients/stats.html'
+    extra_context = {
+        'title': 'Статистика'
+    }
+
+    def get_queryset(self):
+        queryset = DeliveryStat.objects.filter(newsletter__user=self.request.user)
+        self.filter_form = StatsFilterForm(self.request.GET or None, user=self.request.user)
+        data = self.filter_form.cleaned_data if self.filter_form.is_valid() else {}
+        if data.get('newsletter'):
+            queryset = queryset.filter(newsletter=data['newsletter'])
+        if data.get('message'):
+            queryset = queryset.filter(message=data['message'])
+        # по умолчанию показываем последние 30 дней
+        date_from = data.get('date_from') or timezone.localdate() - datetime.timedelta(days=30)
+        queryset = queryset.filter(day__gte=date_from)
+        if data.get('date_to'):
+            queryset = queryset.filter(day__lte=data['date_to'])
+        self.totals = queryset.aggregate(
+            attempted=Sum('attempted'), delivered=Sum('delivered'), failed=Sum('failed'),
+        )
+        return queryset.values('newsletter', 'day').annotate(
+            attempted=Sum('attempted'), delivered=Sum('delivered'), failed=Sum('failed'),
+        ).order_by('-day', 'newsletter')
+
+    def get_context_data(self, **kwargs):
+        context_data = super().get_context_data(**kwargs)
+        context_data['filter_form'] = self.filter_form
+        context_data['totals'] = self.totals
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        context_data['query'] = query.urlencode()
+        return context_data
+
+
+class MetricsView(View):
+    '''
+    Метрики всех процессов в текстовом формате Prometheus.
+    Доступны персоналу или по заголовку Authorization: Bearer <METRICS_TOKEN>
+    '''
+
+    def get(self, request):
+        token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        allowed = settings.METRICS_TOKEN and constant_time_compare(token, settings.METRICS_TOKEN)
+        if not allowed and not request.user.is_staff:
+            raise PermissionDenied
+        return HttpResponse(metrics.render(metrics.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 
 class UserLoginView(LoginView):
     form_class = LoginUserForm
@@ -270,14 +575,24 @@ class UserLoginView(LoginView):
     }
 
 
+def send_verification_code(user):
+    code = verification.issue(user)
+    # письмо уйдёт из очереди служебных писем после коммита
+    outbox.enqueue(
+        to=user.email,
+        subject='Верификация почты',
+        body=f'Для верификации почты введите данный код {code}',
+    )
+
+
 class RegisterView(CreateView):
     model = User
     form_class = UserRegisterForm
     template_name = 'clients/register.html'
     success_url = reverse_lazy('clients:confirm')
 
+    @transaction.atomic  # пользователь, код и письмо с кодом сохраняются вместе
     def form_valid(self, form):
-        code = get_random_string(6, '1234567890')  # Генерируем 6ти значный код для подтверждения
         user = form.save(commit=False)  # Создание объекта пользователя без сохранения в базу данных
         user.is_active = False  # Установка статуса активации на False
         user.save()
@@ -287,56 +602,67 @@ class RegisterView(CreateView):
             content_type=content_type,
         )
         user.user_permissions.add(permission)
-        Code.objects.create(
-            code=code,
-            user=user
-        )  # Создаём запись кода для пользователя в БД
+        send_verification_code(user)  # Генерируем 6ти значный код для подтверждения и отправляем его
         self.request.session['user_id'] = user.id
         # Сохраняем id пользователя в сессии, чтобы в подтверждении можно было найти этого пользователя
         # и при правильном вводе кода авторизовать
-        send_mail(
-            subject='Верификация почты',
-            message=f'Для верификации почты введите данный код {code}',
-            from_email=settings.EMAIL_HOST_USER,
-            recipient_list=[user.email],
-        )
         return redirect('clients:confirm')
 
 
 class ConfirmView(View):
+    messages = {
+        verification.INVALID: 'Не верно введенный код',
+        verification.LOCKED: 'Слишком много попыток, запросите новый код позже',
+    }
 
     def get(self, request, *args, **kwargs):
         return render(request, 'clients/confirm_account.html')
 
     def post(self, request, *args, **kwargs):
         user_id = request.session.get('user_id')
-        # Получаем id пользователя
-        user = User.objects.get(pk=user_id)  # Получаем пользователя по id
+        # Получаем id пользователя, которому отправлен код
+        if user_id is None:
+            return redirect('clients:register')
+        if request.POST.get('resend'):
+            return self.resend(request, user_id)
         code_user = request.POST.get('code_user')  # Получаем код(который ввел пользователь) с формы
         if not code_user:  # Если код не введен, перенаправляем снова на ввод
             return redirect('clients:confirm')
-        try:
-            Code.objects.get(code=code_user, user=user)
-            # Пытаемся найти код пользователя в таблице с кодами, и если код найден, то идем дальше
-        except Code.DoesNotExist:
-            # Если код не совпал, то перенаправляем на повторное подтверждение, но уже с ошибкой
+        # за прокси у всех один REMOTE_ADDR, поэтому попытки считаются по пользователю:
+        # новый код сбрасывает счётчик неверных вводов, а этот лимит - нет
+        if verification.limited(f'confirm:{user_id}', settings.VERIFICATION_CONFIRM_LIMIT):
             return render(request, 'clients/confirm_account.html', context={
-                'error': 'Не верно введенный код'
+                'error': 'Слишком много попыток, попробуйте позже'
             })
+        result = verification.check(user_id, code_user)
+        # Код сверяется с кешем (или с таблицей Code, если кеш выключен) и при совпадении гасится
+        if result != verification.OK:
+            # Если код не совпал, то перенаправляем на повторное подтверждение, но уже с ошибкой
+            return render(request, 'clients/confirm_account.html', context={'error': self.messages[result]})
+        user = User.objects.get(pk=user_id)
         user.is_active = True
         # Если код совпал, то пользователь имеет статус активного
         user.save()
-        Code.objects.get(
-            code=code_user,
-            user=user
-        ).delete()
-        # Удаляем код из БД, тк пользователь его ввёл
         login(request, user)
         # Авторизовываем пользователя в сессии
         del request.session['user_id']
         # Удаляем id пользователя из сессии
         return redirect('clients:login')
 
+    def resend(self, request, user_id):
+        '''
+        Новый код взамен истёкшего, не чаще VERIFICATION_RESEND_LIMIT раз за окно
+        '''
+        user = User.objects.filter(pk=user_id, is_active=False).first()
+        if user is None:
+            return redirect('clients:login')
+        if verification.limited(f'resend:{user_id}', settings.VERIFICATION_RESEND_LIMIT):
+            return render(request, 'clients/confirm_account.html', context={
+                'error': 'Код уже отправлялся несколько раз, попробуйте позже'
+            })
+        send_verification_code(user)
+        return render(request, 'clients/confirm_account.html', context={'info': 'Новый код отправлен на почту'})
+
 
 class ProfileView(UpdateView):
     model = User
@@ -353,6 +679,9 @@ def user_gen_password(request):
     if not user_email:
         return redirect(reverse('clients:login'))
         # Если почта не указана, то опять на логин
+    if verification.limited(f'genpassword:{user_email.lower()}', settings.PASSWORD_RESET_RATE_LIMIT):
+        return redirect(reverse('clients:login'))
+        # Пароль на эту почту недавно уже генерировали несколько раз
     try:
         # Пытаемся найти пользователя в БД по почте
         user = User.objects.get(email=user_email)
@@ -361,16 +690,16 @@ def user_gen_password(request):
         return redirect(reverse('clients:login'))
     # chars = 'abcdefghijklmnopqrstuvwxyz0123456789!@#$%^&*(-_=+)'
     new_password = get_random_string(6, '1234567890')
-    send_mail(
-        subject='Сгенерированн новый пароль',
-        message=f'Ваш пароль для авторизации {new_password}',
-        from_email=settings.EMAIL_HOST_USER,
-        recipient_list=[user_email]
-    )
-    # Отправляем на почту новый пароль
-    user.set_password(new_password)
-    # Для пользователя, которого нашли по введенной почте меняем пароль
-    user.save()
+    with transaction.atomic():
+        # Для пользователя, которого нашли по введенной почте меняем пароль
+        user.set_password(new_password)
+        user.save()
+        # Отправляем на почту новый пароль (через очередь служебных писем, после коммита)
+        outbox.enqueue(
+            to=user_email,
+            subject='Сгенерированн новый пароль',
+            body=f'Ваш пароль для авторизации {new_password}',
+        )
     return redirect(reverse('clients:login'))
 from django.shortcuts import render
 
@@ -32,4 +32,19 @@ app.conf.beat_schedule = {
             hour=0,
         ),
     },
+    "dispatch_due_newsletters": {
+        "task": "clients.tasks.dispatch_due_newsletters",
+        "schedule": crontab(),
+    },
+    "drain_outbox": {
+        "task": "clients.tasks.drain_outbox",
+        "schedule": crontab(),
+    },
+    "archive_logs": {
+        "task": "clients.tasks.archive_logs",
+        "schedule": crontab(
+            minute=30,
+            hour=3,
+        ),
+    },
 }
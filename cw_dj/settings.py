@@ -52,6 +52,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'clients.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'CW_6_Django.urls'
@@ -151,6 +152,12 @@ CELERY_ACCEPT_CONTENT = ['pickle']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_IMPORTS = ["clients.tasks"]
+# Служебные письма пользователям идут через свою очередь: её слушает отдельный воркер
+# (celery -A cw_dj worker -Q account_emails), и рассылки её не занимают
+CELERY_TASK_ROUTES = {
+    'clients.tasks.send_outbox_email': {'queue': 'account_emails'},
+    'clients.tasks.drain_outbox': {'queue': 'account_emails'},
+}
 
 # EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.yandex.ru'
@@ -162,6 +169,72 @@ EMAIL_HOST_PASSWORD = 'cakqtvelkwayqzen'
 # SERVER_EMAIL = EMAIL_HOST_USER
 # EMAIL_ADMIN = EMAIL_HOST_USER
 
+# Отправка рассылок: движок (clients.engine.MailEngine - последовательный,
+# clients.threaded_engine.ThreadedMailEngine - в MAIL_SENDER_CONCURRENCY потоков по SMTP-сессии),
+# писем в пачке, писем на одно SMTP-соединение, попыток переподключения
+MAIL_SENDER_ENGINE = 'clients.engine.MailEngine'
+MAIL_SENDER_CONCURRENCY = 10
+MAIL_SENDER_BATCH_SIZE = 100
+MAIL_SENDER_MESSAGES_PER_CONNECTION = 500
+MAIL_SENDER_RECONNECT_ATTEMPTS = 3
+# Получатели рассылки читаются из базы кусками по столько клиентов
+MAIL_RECIPIENTS_CHUNK_SIZE = 2000
+# Логи рассылки пишутся пачками: каждые MAIL_LOG_FLUSH_SIZE строк или MAIL_LOG_FLUSH_INTERVAL секунд
+MAIL_LOG_WRITER = 'clients.log_writer.LogWriter'
+MAIL_LOG_FLUSH_SIZE = 500
+MAIL_LOG_FLUSH_INTERVAL = 5
+# Параллельная отправка одной рассылки: получателей в пачке и пачек, отправляемых одновременно
+MAILING_FANOUT = True
+MAILING_CHUNK_SIZE = 500
+MAILING_CONCURRENCY = 8
+# Служебные письма (код подтверждения, новый пароль): очередь Celery, попыток отправки,
+# задержка перед первым повтором (каждый следующий ждёт вдвое дольше), через сколько секунд
+# после пропущенной попытки письмо считается потерянным и ставится в очередь заново
+ACCOUNT_EMAIL_QUEUE = 'account_emails'
+ACCOUNT_EMAIL_MAX_ATTEMPTS = 6
+ACCOUNT_EMAIL_RETRY_DELAY = 10
+ACCOUNT_EMAIL_STALE_AFTER = 300
+ACCOUNT_EMAIL_DRAIN_BATCH_SIZE = 500
+# Расписание рассылок: сколько наступивших рассылок тик забирает за одну транзакцию
+NEWSLETTER_SCHEDULER_BATCH_SIZE = 500
+# Лимит скорости отправки, общий для всех воркеров (хранится в Redis):
+# писем в секунду всего и на один аккаунт отправителя, запас на всплеск в секундах,
+# максимальное ожидание пачки в задаче Celery, после которого она возвращается в очередь
+MAIL_RATE_LIMIT_ENABLED = True
+MAIL_RATE_LIMIT_GLOBAL = 20
+MAIL_RATE_LIMIT_PER_SENDER = 10
+MAIL_RATE_LIMIT_BURST = 2
+MAIL_RATE_LIMIT_MAX_WAIT = 60
+MAIL_RATE_LIMIT_REDIS_URL = CELERY_BROKER_URL
+# Повторная отправка писем с ошибкой: попыток всего и задержка перед первым повтором в секундах
+# (каждый следующий повтор ждёт вдвое дольше)
+MAIL_DELIVERY_MAX_ATTEMPTS = 4
+MAIL_DELIVERY_RETRY_DELAY = 60
+# Через сколько секунд без новых записей в журнале доставок страница хода отправки считает её остановленной
+NEWSLETTER_PROGRESS_STALE_AFTER = 15 * 60
+# Импорт клиентов из файла: размер пачки upsert и размер файла в байтах,
+# начиная с которого импорт уходит в задачу Celery
+CLIENT_IMPORT_BATCH_SIZE = 1000
+CLIENT_IMPORT_SYNC_LIMIT = 1024 * 1024
+# Миниатюры аватаров клиентов: размеры (ширина, высота) и форматы, качество сжатия
+AVATAR_THUMBNAIL_SIZES = {'small': (96, 96), 'medium': (320, 320)}
+AVATAR_THUMBNAIL_FORMATS = ('webp', 'jpeg')
+AVATAR_THUMBNAIL_QUALITY = 82
+# Архив логов рассылки: сколько дней логи хранятся в базе, каталог сжатых файлов архива,
+# сколько строк переносится и удаляется за одну транзакцию
+LOG_RETENTION_DAYS = 90
+LOG_ARCHIVE_DIR = BASE_DIR / 'log_archive'
+LOG_ARCHIVE_BATCH_SIZE = 5000
+# Метрики: доля запросов и задач рассылки, которые замеряются (0 - замеры выключены),
+# бюджеты времени, сверх которых запрос или задача пишется в лог,
+# как часто процесс публикует свои метрики в кеш, токен для страницы /metrics/
+METRICS_SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', '0.1'))
+METRICS_SLOW_REQUEST_SECONDS = 0.5
+METRICS_SLOW_TASK_SECONDS = 300
+METRICS_TASK_PREFIX = 'clients.tasks.mailing'
+METRICS_PUBLISH_INTERVAL = 15
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
 LOGIN_URL = '/users/'
 
 CACHE_ENABLED = True
@@ -172,5 +245,23 @@ if CACHE_ENABLED:
             "LOCATION": 'redis://127.0.0.1:6379'  # os.getenv("CACHE_LOCASHION"),
         }
     }
+# время жизни версионных ключей кеша (clients.caching), секунд
+CACHE_TIMEOUT = 60 * 60
+# Сессии читаются из кеша, база - основное хранилище (cached_db). clients.sessions при недоступном
+# Redis работает только с базой и повторяет не удавшееся удаление сессии из кеша; без кеша - только база
+SESSION_ENGINE = 'clients.sessions' if CACHE_ENABLED else 'django.contrib.sessions.backends.db'
+# Права пользователей для проверок PermissionRequiredMixin кешируются (clients.caching)
+# на PERMISSIONS_CACHE_TIMEOUT секунд
+AUTHENTICATION_BACKENDS = ['clients.backends.CachedModelBackend']
+PERMISSIONS_CACHE_TIMEOUT = 5 * 60
+# Коды подтверждения почты: время жизни кода и попыток ввода за это время (хранятся в кеше),
+# окно ограничений в секундах и сколько за окно можно: повторно запросить код,
+# ввести код для одного пользователя (с учётом новых кодов), сгенерировать новый пароль на одну почту
+VERIFICATION_CODE_TTL = 15 * 60
+VERIFICATION_MAX_ATTEMPTS = 5
+VERIFICATION_RATE_WINDOW = 60 * 60
+VERIFICATION_RESEND_LIMIT = 3
+VERIFICATION_CONFIRM_LIMIT = 15
+PASSWORD_RESET_RATE_LIMIT = 3
 
 TEMPLATE_CONTEXT_PROCESSORS = 'django.core.context_processors.request'